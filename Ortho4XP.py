@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import sys
 import os
+import multiprocessing
 from pyproj import datadir
 Ortho4XP_dir='..' if getattr(sys,'frozen',False) else '.'
 sys.path.append(os.path.join(Ortho4XP_dir,'src'))
@@ -12,8 +13,8 @@ import O4_Vector_Map as VMAP
 import O4_Mesh_Utils as MESH
 import O4_Mask_Utils as MASK
 import O4_Tile_Utils as TILE
-import O4_GUI_Utils as GUI
 import O4_Config_Utils as CFG  # CFG imported last because it can modify other modules variables
+import O4_Batch_Utils as BATCH
 
 # Check if running as a PyInstaller bundle and set PROJ_DATA environment
 if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
@@ -25,9 +26,10 @@ if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
     os.environ["PROJ_DATA"] = proj_data_path
     datadir.set_data_dir(proj_data_path)
 
-cmd_line="USAGE: Ortho4XP.py lat lon imagery zl (won't read a tile config)\n  OR:  Ortho4XP.py lat lon (with existing tile config file)"
+cmd_line="USAGE: Ortho4XP.py lat lon imagery zl (won't read a tile config)\n  OR:  Ortho4XP.py lat lon (with existing tile config file)\n  OR:  Ortho4XP.py --job job_file (headless batch, resumable)\n  OR:  Ortho4XP.py --benchmark [results.json [baseline.json]] (offline, synthetic tile)"
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # batch builds use worker processes
     if not os.path.isdir(FNAMES.Utils_dir):
         print("Missing ",FNAMES.Utils_dir,"directory, check your install. Exiting.")
         sys.exit()   
@@ -46,9 +48,19 @@ if __name__ == '__main__':
     IMG.initialize_providers_dict()
     IMG.initialize_combined_providers_dict()
     if len(sys.argv)==1: # switch to the graphical interface
+        import O4_GUI_Utils as GUI
         Ortho4XP = GUI.Ortho4XP_GUI()
         Ortho4XP.mainloop()	    
         print("Bon vol!")
+    elif sys.argv[1]=='--job': # headless batch build from a job file
+        if len(sys.argv)!=3:
+            print(cmd_line); sys.exit(1)
+        sys.exit(0 if BATCH.run_job(sys.argv[2]) else 1)
+    elif sys.argv[1]=='--benchmark': # timings of the pipeline stages
+        if len(sys.argv)>4:
+            print(cmd_line); sys.exit(1)
+        import O4_Benchmark as BENCH
+        BENCH.run_benchmark(*sys.argv[2:])
     else: # sequel is only concerned with command line 
         if len(sys.argv)<3:
             print(cmd_line); sys.exit()
@@ -0,0 +1,190 @@
+"""Headless batch builds driven by a job file, with a checkpoint journal.
+
+A job file uses the same key=value syntax as the Ortho4XP config files:
+
+    # Tiles to build, as a list of (lat, lon)
+    tiles=[(45, 5), (45, 6), (46, 5)]
+    # Steps (defaults shown)
+    do_osm=True
+    do_mesh=True
+    do_mask=True
+    do_dsf=True
+    do_ovl=False
+    # Use the global config instead of existing tile configs
+    override_cfg=False
+    custom_build_dir=
+    # Checkpoint journal, defaults to the job file name + ".checkpoint"
+    checkpoint=
+    # Any application variable, e.g.
+    max_batch_slots=8
+    # Any tile variable, applied on top of each tile config, e.g.
+    curvature_tol=2.5
+
+Completed steps are appended to the checkpoint journal as they finish, so
+that running the same job again after a crash only redoes what is missing.
+"""
+
+import ast
+import os
+import threading
+import O4_UI_Utils as UI
+import O4_Tile_Utils as TILE
+import O4_Config_Utils as CFG
+from O4_Cfg_Vars import cfg_app_vars, cfg_tile_vars
+
+batch_steps = ("osm", "mesh", "mask", "dsf", "ovl")
+
+job_defaults = {
+    "tiles": [],
+    "do_osm": True,
+    "do_mesh": True,
+    "do_mask": True,
+    "do_dsf": True,
+    "do_ovl": False,
+    "override_cfg": False,
+    "custom_build_dir": "",
+    "checkpoint": "",
+}
+
+################################################################################
+class Checkpoint:
+    """
+    Journal of the completed steps of a batch build.
+
+    Each line reads "lat lon step". Recording a step also invalidates the
+    later steps of the same tile, since they were built from older data.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.done = {}
+        self.lock = threading.Lock()
+        try:
+            with open(file_name, "r") as f:
+                for line in f:
+                    try:
+                        (lat, lon, step) = line.split()
+                        self._update(int(lat), int(lon), step)
+                    except ValueError:
+                        # typically the last line of an interrupted run
+                        UI.vprint(2, "Skipping checkpoint line:", line)
+        except FileNotFoundError:
+            pass
+
+    def _update(self, lat, lon, step):
+        if step not in batch_steps:
+            raise ValueError
+        done = self.done.setdefault((lat, lon), set())
+        done.add(step)
+        done.difference_update(batch_steps[batch_steps.index(step) + 1 :])
+
+    def pending_steps(self, lat, lon, requested):
+        """
+        Filter the requested steps (booleans ordered as batch_steps) down to
+        those still needed. Once a step needs to be built, all the
+        following requested steps do too.
+        """
+        done = self.done.get((lat, lon), set())
+        pending = []
+        forced = False
+        for (step, wanted) in zip(batch_steps, requested):
+            todo = bool(wanted) and (forced or step not in done)
+            forced = forced or todo
+            pending.append(todo)
+        return tuple(pending)
+
+    def record(self, lat, lon, step):
+        with self.lock:
+            self._update(lat, lon, step)
+            with open(self.file_name, "a") as f:
+                f.write(str(lat) + " " + str(lon) + " " + step + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+################################################################################
+def read_job_file(job_file):
+    """
+    Parse a job file.
+
+    :returns: (job, overrides) where job holds the job_defaults keys and
+        overrides the tile variables to apply on each tile, or None if the
+        job file is invalid
+    """
+    job = dict(job_defaults)
+    overrides = {}
+    try:
+        f = open(job_file, "r")
+    except OSError:
+        UI.lvprint(0, "ERROR: Could not open job file", job_file)
+        return None
+    with f:
+        for (nbr, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line or line[0] == "#":
+                continue
+            try:
+                (var, value) = [x.strip() for x in line.split("=", 1)]
+                if var == "tiles":
+                    job[var] = [
+                        (int(lat), int(lon))
+                        for (lat, lon) in ast.literal_eval(value)
+                    ]
+                elif var in ("custom_build_dir", "checkpoint"):
+                    job[var] = value
+                elif var in job_defaults:
+                    job[var] = bool(ast.literal_eval(value))
+                elif var in cfg_app_vars:
+                    CFG.set_global_variables(var, value)
+                elif var in cfg_tile_vars:
+                    if cfg_tile_vars[var]["type"] in (bool, list):
+                        overrides[var] = ast.literal_eval(value)
+                    else:
+                        overrides[var] = cfg_tile_vars[var]["type"](value)
+                else:
+                    raise KeyError(var)
+            except Exception as e:
+                UI.lvprint(
+                    0,
+                    "ERROR: Invalid line",
+                    nbr,
+                    "in job file",
+                    job_file,
+                    ":",
+                    line,
+                    "(" + str(e) + ")",
+                )
+                return None
+    if not job["tiles"]:
+        UI.lvprint(0, "ERROR: The job file", job_file, "lists no tiles.")
+        return None
+    if not job["checkpoint"]:
+        job["checkpoint"] = job_file + ".checkpoint"
+    return (job, overrides)
+
+
+################################################################################
+def run_job(job_file):
+    """Run (or resume) the batch build described by a job file."""
+    parsed = read_job_file(job_file)
+    if not parsed:
+        return 0
+    (job, overrides) = parsed
+    checkpoint = Checkpoint(job["checkpoint"])
+    UI.lvprint(
+        1, "Job", job_file, "uses the checkpoint journal", job["checkpoint"]
+    )
+    (lat, lon) = job["tiles"][0]
+    tile = CFG.Tile(lat, lon, job["custom_build_dir"])
+    return TILE.build_tile_list(
+        tile,
+        job["tiles"],
+        job["do_osm"],
+        job["do_mesh"],
+        job["do_mask"],
+        job["do_dsf"],
+        job["do_ovl"],
+        job["override_cfg"],
+        checkpoint=checkpoint,
+        overrides=overrides,
+    )
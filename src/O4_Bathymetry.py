@@ -1,9 +1,8 @@
 import os
-import array
 import numpy
-from PIL import Image
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
+import O4_Mask_Utils as MASK
 
 def set_depth_ratio(n, node_is_coast, node_bathy, tile):
     if node_is_coast[n]:
@@ -13,220 +12,152 @@ def set_depth_ratio(n, node_is_coast, node_bathy, tile):
             min(10 * tile.ratio_bathy * node_bathy[n] / 255, 1),
             0.1)
 
+# Pieces of a cut water tri, as columns of its vertices (a, b, c), cut nodes
+# of its edges (C on ab, A on bc, B on ca) and barycenter G, indexed by
+# C + 2 * A + 4 * B (8 for a cut at the barycenter). The first piece takes
+# the place of the original tri, the others are appended at the end.
+(_a, _b, _c, _C, _A, _B, _G) = range(7)
+recut_pieces = (
+    ((_a, _b, _c),),
+    ((_C, _b, _c), (_C, _c, _a)),
+    ((_A, _c, _a), (_A, _a, _b)),
+    ((_c, _a, _C), (_C, _b, _A), (_c, _C, _A)),
+    ((_B, _a, _b), (_B, _b, _c)),
+    ((_b, _c, _B), (_B, _a, _C), (_b, _B, _C)),
+    ((_a, _b, _A), (_A, _c, _B), (_a, _A, _B)),
+    ((_B, _a, _C), (_C, _b, _A), (_A, _c, _B), (_B, _C, _A)),
+    ((_a, _b, _G), (_b, _c, _G), (_c, _a, _G)),
+)
+
 def recut_water_tris(node_coords, tri_idx, tri_types):
 
     assert(len(node_coords) % 5 == 0)
-    nbr_nodes = len(node_coords) // 5;
+    nbr_nodes = len(node_coords) // 5
     assert(len(tri_idx) % 3 == 0)
     assert(len(tri_idx) // 3 == len(tri_types))
-    nbr_tris  = len(tri_types)
+    nbr_tris = len(tri_types)
+    tris = numpy.asarray(tri_idx).reshape(nbr_tris, 3)
+    tri_bits = (1 << numpy.asarray(tri_types, dtype=numpy.int64)).astype(
+            numpy.uint8)
 
     # Fill node types using a boolean or on a bit field.
-    # Coastline nodes are those that will have both a land and water bits set. 
+    # Coastline nodes are those that will have both a land and water bits set.
     # Assumes that tri_types[n] is already in the range {0, 1, 2}
     node_types = numpy.zeros(nbr_nodes, dtype = numpy.uint8)
-    for i in range(nbr_tris):
-        t = 1 << tri_types[i]
-        node_types[tri_idx[3 * i + 0]] |= t 
-        node_types[tri_idx[3 * i + 1]] |= t 
-        node_types[tri_idx[3 * i + 2]] |= t
+    numpy.bitwise_or.at(node_types, tris.ravel(), tri_bits.repeat(3))
     node_is_coast = ((node_types & 1) != 0) & ((node_types & 6) != 0)
 
-    # Count the number of coastline tris (i.e. with at least one coastline vtx)
-    # The latter are the only ones with a potential recut).
-    tri_is_coast = numpy.zeros(nbr_tris, dtype = bool)
-    for i in range(nbr_tris):
-        tri_is_coast[i] |= node_is_coast[tri_idx[3 * i + 0]]
-        tri_is_coast[i] |= node_is_coast[tri_idx[3 * i + 1]]
-        tri_is_coast[i] |= node_is_coast[tri_idx[3 * i + 2]]
-    coast_tri_count = numpy.sum(tri_is_coast)
-
-    # Classify edges of coastline tris
-    edge_type = {}
-    for i in range(nbr_tris):
-        if not tri_is_coast[i]:
-            continue
-        t = 1 << tri_types[i]
-        (a,b,c) = tri_idx[3 * i: 3 * i + 3]
-        for (m,n) in ((a,b), (b,c), (c,a)):
-            if (m,n) in edge_type or (n,m) in edge_type:
-                edge_type[(m,n)] |= t
-                edge_type[(n,m)] |= t
-            else:
-                edge_type[(m,n)] = t
-                edge_type[(n,m)] = t
-
-    # Copy and increase size for node_coords, node_types, node_is_coast
-    node_max_count = nbr_nodes + 3 * coast_tri_count
-    node_coords = numpy.resize(node_coords, 5 * node_max_count)
-    node_types   = numpy.resize(node_types, node_max_count)
-    node_is_coast = numpy.resize(node_is_coast, node_max_count)
-
-    # Cut edges that need to : i.e. have no land bit but their 
+    # Coastline tris (i.e. with at least one coastline vtx) are the only ones
+    # with a potential recut.
+    coast_tris = numpy.flatnonzero(node_is_coast[tris].any(axis=1))
+
+    # Classify edges (ab, bc, ca) of coastline tris, as sorted node pairs
+    # numbered by first use.
+    edge_ends = numpy.stack(
+            (tris[coast_tris], numpy.roll(tris[coast_tris], -1, axis=1)),
+            axis=2).astype(numpy.int64).reshape(-1, 2)
+    edge_ends.sort(axis=1)
+    (_, first_use, edge_ids) = numpy.unique(
+            (edge_ends[:, 0] << 32) | edge_ends[:, 1],
+            return_index=True, return_inverse=True)
+    rank = numpy.argsort(first_use)
+    renumber = numpy.empty(len(rank), dtype=numpy.int64)
+    renumber[rank] = numpy.arange(len(rank))
+    edge_ids = renumber[edge_ids.ravel()].reshape(-1, 3)
+    edge_ends = edge_ends[first_use[rank]]
+    edge_type = numpy.zeros(len(rank), dtype=numpy.uint8)
+    numpy.bitwise_or.at(edge_type, edge_ids.ravel(),
+            tri_bits[coast_tris].repeat(3))
+
+    # Cut edges that need to : i.e. have no land bit but their
     # end-points are coastline.
-    edge_cut = {}
-    next_n = nbr_nodes
-    for ((a, b), t) in edge_type.items():
-        if b < a:
-            # do not do twice the work we have both pairs anyway
-            continue
-        if (t & 1 == 0) and node_is_coast[a] and node_is_coast[b]:
-            edge_cut[(a,b)] = next_n
-            edge_cut[(b,a)] = next_n
-            node_coords[5 * next_n: 5 * next_n + 5] = (
-                    node_coords[5 * a: 5 * a + 5] +
-                    node_coords[5 * b: 5 * b + 5]
-                    ) / 2.0
-            node_types[next_n] = t
-            node_is_coast[next_n] = False
-            next_n += 1
-
-    # Copy and increase size for node_coords, node_types, node_is_coast
-    tri_max_count = nbr_tris + 3 * coast_tri_count
-    tri_idx = numpy.resize(tri_idx, 3 * tri_max_count)
-    tri_types = numpy.resize(tri_types, tri_max_count)
-
-    next_t = nbr_tris
-
-    # Cut the tris that need to.
-    # When cutting a tri, its place in tri_idx is taken by one of the 
-    # newly created ones, and the other ones are appended at the end.
-    for i in range(nbr_tris):
-        if not tri_types[i] or not tri_is_coast[i]:
-            continue
-        (a,b,c) = tri_idx[3 * i: 3 * i + 3]
-        C = (a,b) in edge_cut
-        A = (b,c) in edge_cut
-        B = (c,a) in edge_cut
-        cuts = A + B + C
-        if (not cuts):
-            # We might still need to cut the tri if all its edges are coastline 
-            # Note : this is a water tri so edges surely have water bit(s)
-            if ((edge_type[(a,b)] & 1 == 0) or (edge_type[(b,c)] & 1 == 0) or 
-               (edge_type[(c,a)] & 1 == 0)):
-                   continue
-            # Cut the tri at its barycenter
-            node_coords[5 * next_n: 5 * next_n + 5] = (
-                   node_coords[5 * a: 5 * a + 5] + 
-                   node_coords[5 * b: 5 * b + 5] +
-                   node_coords[5 * c: 5 * c + 5]
-                   ) / 3.0
-            node_types[next_n] = tri_types[i]
-            node_is_coast[next_n] = False
-            tri_idx[3 * i: 3 * i + 3] = (a,b,next_n)
-            tri_idx[3 * next_t: 3 * next_t + 6] = (b,c,next_n,c,a,next_n)
-            tri_types[next_t] = tri_types[next_t + 1] = tri_types[i]
-            next_n += 1
-            next_t += 2
-        else:
-            # Make a drawing ! a, b, c are the triangles vertices, A, B, C
-            # are the potential cut vertices opposed respectively to a, b, c.
-            L = array.array('i')
-            L.append(a)
-            if C:
-                s1 = len(L)
-                L.append(edge_cut[(a,b)])
-            else:
-                s2 = len(L) - 1
-            L.append(b)
-            if A:
-                s1 = len(L)
-                L.append(edge_cut[(b,c)])
-            else:
-                s2 = len(L) - 1
-            L.append(c)
-            if B:
-                s1 = len(L)
-                L.append(edge_cut[(c,a)])
-            else:
-                s2 = len(L) - 1
-            L = L + L
-            
-            if (cuts == 2):
-                # By def of s2 (x,y) is the one edge with no cut
-                # Make a drawing !
-                (x,y,z,t,u) = L[s2:s2+5]
-                tri_idx[3 * i: 3 * i + 3] = (x,y,z)
-                tri_idx[3 * next_t: 3 * next_t + 6] = (z,t,u,x,z,u)
-                tri_types[next_t: next_t + 2] = tri_types[i]
-                next_t += 2
-            elif (cuts == 1):
-                # By def of s1 x is the cut node
-                # Make a drawing !
-                (x,y,z,t) = L[s1:s1+4]
-                tri_idx[3 * i: 3 * i + 3] = (x,y,z)
-                tri_idx[3 * next_t: 3 * next_t + 3] = (x,z,t)
-                tri_types[next_t] = tri_types[i]
-                next_t += 1
-            else: # cuts == 3
-                # By def of s1 x is some cut node
-                # Make a drawing !
-                (x,y,z,t,u,v) = L[s1:s1+6]
-                tri_idx[3 * i: 3 * i + 3] = (x,y,z)
-                tri_idx[3 * next_t: 3 * next_t + 9] = (z,t,u,u,v,x,x,z,u)
-                tri_types[next_t: next_t + 3] = tri_types[i]
-                next_t += 3
+    cut_edges = numpy.flatnonzero(
+            (edge_type & 1 == 0) & node_is_coast[edge_ends].all(axis=1))
+    edge_cut = numpy.full(len(rank), -1, dtype=numpy.int64)
+    edge_cut[cut_edges] = nbr_nodes + numpy.arange(len(cut_edges))
+    (a, b) = edge_ends[cut_edges].T
+    cut_coords = (node_coords.reshape(-1, 5)[a]
+            + node_coords.reshape(-1, 5)[b]) / 2.0
+    next_n = nbr_nodes + len(cut_edges)
+
+    # Water tris with cut edges are recut along them, the other ones are cut
+    # at their barycenter if all their edges are coastline.
+    # Note : these are water tris so edges surely have water bit(s)
+    water = tri_types[coast_tris] != 0
+    coast_tris = coast_tris[water]
+    edge_ids = edge_ids[water]
+    cuts = edge_cut[edge_ids] >= 0
+    code = cuts @ numpy.array([1, 2, 4])
+    code[(code == 0) & (edge_type[edge_ids] & 1 != 0).all(axis=1)] = 8
+    cut = code != 0
+    (coast_tris, edge_ids, code) = (coast_tris[cut], edge_ids[cut], code[cut])
+    bary = numpy.flatnonzero(code == 8)
+    (a, b, c) = tris[coast_tris[bary]].T
+    bary_coords = (node_coords.reshape(-1, 5)[a]
+            + node_coords.reshape(-1, 5)[b]
+            + node_coords.reshape(-1, 5)[c]) / 3.0
+    bary_nodes = numpy.full(len(code), -1, dtype=numpy.int64)
+    bary_nodes[bary] = next_n + numpy.arange(len(bary))
+    next_n += len(bary)
+
+    vertices = numpy.column_stack((tris[coast_tris], edge_cut[edge_ids],
+            bary_nodes))
+    piece_count = numpy.array([len(pieces) for pieces in recut_pieces])
+    extra_start = nbr_tris + numpy.cumsum(piece_count[code] - 1) - (
+            piece_count[code] - 1)
+    next_t = nbr_tris + int((piece_count[code] - 1).sum())
+    tri_idx = numpy.resize(tri_idx, 3 * next_t)
+    tri_types = numpy.resize(tri_types, next_t)
+    new_tris = tri_idx.reshape(next_t, 3)
+    for (k, pieces) in enumerate(recut_pieces[1:], 1):
+        rows = numpy.flatnonzero(code == k)
+        new_tris[coast_tris[rows]] = vertices[rows][:, pieces[0]]
+        for (j, piece) in enumerate(pieces[1:]):
+            new_tris[extra_start[rows] + j] = vertices[rows][:, piece]
+            tri_types[extra_start[rows] + j] = tri_types[coast_tris[rows]]
 
     nbr_nodes = next_n
-    assert(node_max_count >= nbr_nodes)
-    node_coords = numpy.resize(node_coords, 5 * nbr_nodes)
-    node_types  = numpy.resize(node_types, nbr_nodes)
-    node_is_coast = numpy.resize(node_is_coast, nbr_nodes)
-    
+    node_coords = numpy.concatenate(
+            (node_coords, cut_coords.ravel(), bary_coords.ravel()))
+    node_types = numpy.concatenate((node_types, edge_type[cut_edges],
+            tri_types[coast_tris[bary]].astype(numpy.uint8)))
+    node_is_coast = numpy.concatenate(
+            (node_is_coast, numpy.zeros(next_n - len(node_is_coast), bool)))
     nbr_tris = next_t
-    assert(tri_max_count >= nbr_tris)
-    tri_idx = numpy.resize(tri_idx, 3 * nbr_tris)
-    tri_types = numpy.resize(tri_types, nbr_tris)
 
-    return (nbr_nodes, node_coords, node_types, node_is_coast, 
+    return (nbr_nodes, node_coords, node_types, node_is_coast,
             nbr_tris, tri_idx, tri_types)
-    
-
 
 
 def compute_depth_ratio_bounds_from_masks(
         nbr_nodes, node_coords, node_types, tile):
 
-    water_nodes = [n for n in range(nbr_nodes) if (node_types[n] & 4 != 0)]
+    water_nodes = numpy.flatnonzero(node_types[:nbr_nodes] & 4)
 
     node_bathy = 255 * numpy.ones(nbr_nodes, dtype = numpy.uint8)
 
-    # Key is texture attribute at mask_zl
-    # Value is an array of vertex integers
-    mask_to_nodes = {}
-
-    for n in water_nodes:
-        lon = node_coords[5 * n + 0]
-        lat = node_coords[5 * n + 1]
-        mask_attr = GEO.wgs84_to_orthogrid(lat, lon, tile.mask_zl)
-        if (mask_attr) in mask_to_nodes:
-            mask_to_nodes[mask_attr].append(n)
-        else:
-            mask_to_nodes[mask_attr] = array.array('i',(n,))
-
-    for mask_attr in mask_to_nodes:
+    # Water nodes grouped by texture attribute at mask_zl (sorted keys,
+    # x in the high bits)
+    lon = node_coords[5 * water_nodes]
+    lat = node_coords[5 * water_nodes + 1]
+    (til_x, til_y) = GEO.wgs84_to_orthogrid_array(lat, lon, tile.mask_zl)
+    order = numpy.argsort((til_x << 32) | til_y, kind="stable")
+    (water_nodes, lon, lat, til_x, til_y) = (water_nodes[order], lon[order],
+            lat[order], til_x[order], til_y[order])
+    (_, mask_starts) = numpy.unique((til_x << 32) | til_y, return_index=True)
+    mask_ends = numpy.append(mask_starts[1:], len(water_nodes))
+
+    for (start, end) in zip(mask_starts.tolist(), mask_ends.tolist()):
+        mask_attr = (int(til_x[start]), int(til_y[start]))
         mask_file = os.path.join(FNAMES.mask_dir(tile.lat, tile.lon),
                 FNAMES.distance_mask(*mask_attr))
-        if not os.path.isfile(mask_file):
+        if not MASK.mask_exists(mask_file):
             continue
-        img = Image.open(mask_file)
-        mask_val = numpy.array(img, dtype=numpy.uint8)
-        mask_nodes = mask_to_nodes[mask_attr]
-        for n in mask_nodes:
-            lon = node_coords[5 * n + 0]
-            lat = node_coords[5 * n + 1]
-            (s, t) = GEO.st_coord(lat, lon, *mask_attr, tile.mask_zl, None)
-            pixx = int(s * 4095)
-            pixy = int((1-t) * 4095)
-            node_bathy[n] = mask_val[pixy, pixx]
+        (s, t) = GEO.st_coord_array(lat[start:end], lon[start:end],
+                *mask_attr, tile.mask_zl)
+        pixx = (s * 4095).astype(numpy.int64)
+        pixy = ((1 - t) * 4095).astype(numpy.int64)
+        node_bathy[water_nodes[start:end]] = MASK.read_mask_pixels(
+                mask_file, pixy, pixx)
 
     return node_bathy
-            
-
-
-
-
-
-
-
-
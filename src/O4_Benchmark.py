@@ -0,0 +1,586 @@
+"""Offline benchmark of the build pipeline stages on synthetic inputs.
+
+    Ortho4XP.py --benchmark [results.json [baseline.json]]
+
+A synthetic tile (OSM water layer, DEM raster, .mesh file, masks, JPEG
+orthophotos and a Global Scenery DSF) is generated in a temporary directory,
+then each stage below is timed in isolation, without any network access:
+
+    update_dicosm, encode_MultiPolygon, read_mesh_file, record_water_tris,
+    blur_mask (one run per masking mode), build_dsf, combine_textures,
+    convert_texture
+
+Results (wall and CPU times of each run, plus a few size figures) are written
+to a JSON file. When a baseline results file is given, the ratios of the best
+wall times are printed so that two versions can be compared.
+"""
+
+import datetime
+import json
+import os
+import platform
+import queue
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import types
+import numpy
+from PIL import Image
+import O4_UI_Utils as UI
+import O4_File_Names as FNAMES
+import O4_Geo_Utils as GEO
+import O4_OSM_Utils as OSM
+import O4_Vector_Utils as VECT
+import O4_DEM_Utils as DEM
+import O4_Mesh_Utils as MESH
+import O4_Mask_Utils as MASK
+import O4_DSF_Utils as DSF
+import O4_Imagery_Utils as IMG
+import O4_Overlay_Utils as OVL
+from O4_Cfg_Vars import cfg_tile_vars
+
+benchmark_format = 1
+benchmark_lat = 45
+benchmark_lon = 5
+benchmark_seed = 4242
+benchmark_provider = "BENCH"
+
+# Sizes at scale 1
+mesh_grid = 301
+nbr_lakes = 400
+lake_vertices = 48
+pre_mask_size = 6144
+dem_size = 3601
+
+masking_modes = (("sand", 100), ("rocks", 100), ("3steps", [30, 60, 90]))
+
+redirected_dirs = (
+    "OSM_dir",
+    "Mask_dir",
+    "Imagery_dir",
+    "Elevation_dir",
+    "Geotiff_dir",
+    "Patch_dir",
+    "Tile_dir",
+    "Tmp_dir",
+)
+
+
+################################################################################
+def terrain_altitude(x, y):
+    # x, y in [0,1] within the tile, smooth hills between 0 and ~900m
+    return (
+        450
+        + 250 * numpy.sin(7 * x + 1) * numpy.cos(5 * y)
+        + 150 * numpy.sin(23 * x * y)
+    )
+
+
+################################################################################
+def benchmark_tile():
+    tile = types.SimpleNamespace(
+        **{var: cfg_tile_vars[var]["default"] for var in cfg_tile_vars}
+    )
+    tile.lat = benchmark_lat
+    tile.lon = benchmark_lon
+    tile.custom_build_dir = ""
+    tile.grouped = False
+    tile.build_dir = FNAMES.build_dir(tile.lat, tile.lon, "")
+    tile.dem = None
+    tile.default_website = benchmark_provider
+    tile.default_zl = 16
+    tile.zone_list = []
+    for sub_dir in (
+        "terrain",
+        "textures",
+        os.path.join("Earth nav data", FNAMES.round_latlon(tile.lat, tile.lon)),
+    ):
+        os.makedirs(os.path.join(tile.build_dir, sub_dir), exist_ok=True)
+    return tile
+
+
+################################################################################
+def make_lakes(rng, scale):
+    # (x, y, radius) of round-ish lakes, away from the sea band (x<0.12)
+    nbr = max(1, int(nbr_lakes * scale))
+    return [
+        (x, y, r)
+        for (x, y, r) in zip(
+            rng.uniform(0.15, 0.97, nbr),
+            rng.uniform(0.03, 0.97, nbr),
+            rng.uniform(0.002, 0.02, nbr),
+        )
+    ]
+
+
+################################################################################
+def make_osm_file(tile, lakes, rng, file_name):
+    layer = OSM.OSM_layer()
+    for (x, y, r) in lakes:
+        angles = numpy.linspace(0, 2 * numpy.pi, lake_vertices, endpoint=False)
+        radii = r * rng.uniform(0.8, 1.2, lake_vertices)
+        way = []
+        for (angle, radius) in zip(angles, radii):
+            node = (
+                round(tile.lon + x + radius * numpy.cos(angle), 7),
+                round(tile.lat + y + radius * numpy.sin(angle), 7),
+            )
+            layer.dicosmn[layer.next_node_id] = node
+            way.append(layer.next_node_id)
+            layer.next_node_id -= 1
+        way.append(way[0])
+        layer.dicosmw[layer.next_way_id] = way
+        layer.dicosmfirst["w"].add(layer.next_way_id)
+        layer.dicosmtags["w"][layer.next_way_id] = {"natural": "water"}
+        layer.next_way_id -= 1
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    layer.write_to_file(file_name)
+
+
+################################################################################
+def make_dem_file(file_name, size):
+    (x, y) = numpy.meshgrid(
+        numpy.linspace(0, 1, size), numpy.linspace(1, 0, size)
+    )
+    terrain_altitude(x, y).astype(">i2").tofile(file_name)
+
+
+################################################################################
+def make_mesh_file(tile, lakes, grid):
+    (x, y) = numpy.meshgrid(
+        numpy.linspace(0, 1, grid), numpy.linspace(0, 1, grid)
+    )
+    (x, y) = (x.ravel(), y.ravel())
+    alt = terrain_altitude(x, y)
+    (dzdy, dzdx) = numpy.gradient(alt.reshape(grid, grid), 1 / (grid - 1))
+    norm = numpy.sqrt(1 + (dzdx / 111000) ** 2 + (dzdy / 111000) ** 2)
+    nx = (-dzdx / 111000 / norm).ravel()
+    ny = (-dzdy / 111000 / norm).ravel()
+    (i, j) = numpy.meshgrid(numpy.arange(grid - 1), numpy.arange(grid - 1))
+    (i, j) = (i.ravel(), j.ravel())
+    n0 = j * grid + i
+    tris = numpy.vstack(
+        [
+            numpy.column_stack((n0, n0 + 1, n0 + grid + 1)),
+            numpy.column_stack((n0, n0 + grid + 1, n0 + grid)),
+        ]
+    )
+    bary_x = x[tris].mean(axis=1)
+    bary_y = y[tris].mean(axis=1)
+    tri_types = numpy.zeros(len(tris), dtype=int)
+    for (lx, ly, r) in lakes:
+        tri_types[(bary_x - lx) ** 2 + (bary_y - ly) ** 2 < r ** 2] = 1
+    tri_types[bary_x < 0.12] = 2
+    with open(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon), "w") as f:
+        f.write("MeshVersionFormatted 2\n")
+        f.write("Dimension 3\n\n")
+        f.write("Vertices\n")
+        f.write(str(len(x)) + "\n")
+        for k in range(len(x)):
+            f.write(
+                "{:.15f}".format(x[k] + tile.lon)
+                + " "
+                + "{:.15f}".format(y[k] + tile.lat)
+                + " "
+                + "{:.15f}".format(alt[k] / 100000)
+                + " 0\n"
+            )
+        f.write("\n")
+        f.write("Normals\n")
+        f.write(str(len(x)) + "\n")
+        for k in range(len(x)):
+            f.write(
+                "{:.2f}".format(nx[k]) + " " + "{:.2f}".format(ny[k]) + " 0\n"
+            )
+        f.write("\n")
+        f.write("Triangles\n")
+        f.write(str(len(tris)) + "\n")
+        for (tri, tri_type) in zip(tris + 1, tri_types):
+            f.write(" ".join(str(n) for n in tri) + " " + str(tri_type) + "\n")
+    return (len(x), len(tris))
+
+
+################################################################################
+def make_pre_mask(size):
+    # land (255) east of a wavy coastline, sea (0) west of it
+    (x, y) = numpy.meshgrid(numpy.arange(size), numpy.arange(size))
+    coast = size / 3 + size / 20 * numpy.sin(y / (size / 15))
+    return ((x > coast) * 255).astype(numpy.uint8)
+
+
+################################################################################
+def make_masks(tile):
+    # legacy and distance masks over the sea band of the mesh
+    mask_dir = FNAMES.mask_dir(tile.lat, tile.lon)
+    os.makedirs(mask_dir, exist_ok=True)
+    (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
+        tile.lat + 1, tile.lon, tile.mask_zl
+    )
+    (til_x_max, til_y_max) = GEO.wgs84_to_orthogrid(
+        tile.lat, tile.lon + 0.12, tile.mask_zl
+    )
+    gradient = numpy.tile(
+        numpy.linspace(0, 255, 4096).astype(numpy.uint8), (4096, 1)
+    )
+    nbr_masks = 0
+    for til_x in range(til_x_min, til_x_max + 1, 16):
+        for til_y in range(til_y_min, til_y_max + 1, 16):
+            # stored as PNG or tiled as Step 2.5 would do
+            for (file_name, file_data) in (
+                MASK.encode_mask(FNAMES.legacy_mask(til_x, til_y), gradient),
+                MASK.encode_mask(
+                    FNAMES.distance_mask(til_x, til_y), 255 - gradient
+                ),
+            ):
+                with open(os.path.join(mask_dir, file_name), "wb") as f:
+                    f.write(file_data)
+            nbr_masks += 1
+    return nbr_masks
+
+
+################################################################################
+def make_global_scenery_dsf(file_name, size=201):
+    # Just what extract_elevation_and_bathymetry_data reads: a DEFN atom with
+    # the raster names and a DEMS atom with an elevation and a bathymetry
+    # raster (the small DEMI sub-atoms are skipped).
+    def atom(name, data):
+        return (
+            name[::-1].encode("ascii")
+            + struct.pack("<I", 8 + len(data))
+            + data
+        )
+
+    (x, y) = numpy.meshgrid(
+        numpy.linspace(0, 1, size), numpy.linspace(0, 1, size)
+    )
+    elevation = terrain_altitude(x, y).astype(numpy.int16)
+    bathymetry = (elevation - 50).astype(numpy.int16)
+    defn = atom("DEMN", b"sim/elevation\0sim/bathymetry\0")
+    dems = (
+        atom("DEMI", bytes(20))
+        + atom("DEMD", elevation.tobytes())
+        + atom("DEMI", bytes(20))
+        + atom("DEMD", bathymetry.tobytes())
+    )
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, "wb") as f:
+        f.write(b"XPLNEDSF" + struct.pack("<I", 1))
+        f.write(atom("DEFN", defn))
+        f.write(atom("DEMS", dems))
+        f.write(bytes(16))
+
+
+################################################################################
+def make_providers(tile):
+    # A combined provider of two local layers, its orthophotos are written
+    # for one texture by make_orthos.
+    layers = []
+    for (layer_code, priority) in (("BENCHB", "high"), ("BENCHA", "high")):
+        IMG.providers_dict[layer_code] = {
+            "code": layer_code,
+            "imagery_dir": "normal",
+            "color_filters": "none",
+        }
+        layers.append(
+            {
+                "layer_code": layer_code,
+                "extent_code": "global",
+                "color_code": "none",
+                "priority": priority,
+            }
+        )
+    IMG.combined_providers_dict[benchmark_provider] = layers
+    IMG.local_combined_providers_dict[benchmark_provider] = layers
+    IMG.color_filters_dict.setdefault("none", [])
+
+
+################################################################################
+def make_orthos(tile, texture_attributes, rng):
+    (til_x_left, til_y_top, zoomlevel, _) = texture_attributes
+    (x, y) = numpy.meshgrid(
+        numpy.linspace(0, 1, 4096), numpy.linspace(0, 1, 4096)
+    )
+    base = numpy.dstack(
+        [
+            90 + 60 * numpy.sin(20 * x) * numpy.cos(13 * y),
+            110 + 50 * numpy.cos(17 * x * y),
+            70 + 40 * numpy.sin(9 * y),
+        ]
+    )
+    for layer_code in ("BENCHA", "BENCHB"):
+        noise = rng.normal(0, 25, (4096, 4096, 1))
+        im = Image.fromarray(
+            numpy.clip(base + noise, 0, 255).astype(numpy.uint8)
+        )
+        file_dir = FNAMES.jpeg_file_dir_from_attributes(
+            tile.lat, tile.lon, zoomlevel, IMG.providers_dict[layer_code]
+        )
+        os.makedirs(file_dir, exist_ok=True)
+        im.save(
+            os.path.join(
+                file_dir,
+                FNAMES.jpeg_file_name_from_attributes(
+                    til_x_left, til_y_top, zoomlevel, layer_code
+                ),
+            ),
+            quality=90,
+        )
+
+
+################################################################################
+def time_stage(results, name, func, repeat, setup=None):
+    """
+    Run func repeat times (after setup, which is not timed) and record the
+    wall and CPU times in results. func returns a dict of size figures.
+    """
+    record = {"wall": [], "cpu": []}
+    UI.vprint(0, "   ", name, "...")
+    try:
+        for _ in range(repeat):
+            args = setup() if setup else ()
+            UI.red_flag = False
+            (wall, cpu) = (time.perf_counter(), time.process_time())
+            info = func(*args)
+            record["wall"].append(round(time.perf_counter() - wall, 4))
+            record["cpu"].append(round(time.process_time() - cpu, 4))
+    except Exception as e:
+        UI.vprint(0, "    ERROR in stage", name, ":", e)
+        results[name] = {"error": str(e)}
+        return None
+    record["best_wall"] = min(record["wall"])
+    record["median_wall"] = float(numpy.median(record["wall"]))
+    record["info"] = info or {}
+    results[name] = record
+    UI.vprint(0, "      best wall time", record["best_wall"], "s")
+    return info
+
+
+################################################################################
+def revision():
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+        )
+    except Exception:
+        return ""
+
+
+################################################################################
+def compare(results, baseline):
+    UI.vprint(0, "")
+    UI.vprint(
+        0,
+        "Stage".ljust(31),
+        "best wall".rjust(10),
+        "baseline".rjust(10),
+        "speedup".rjust(8),
+    )
+    for name, record in results["stages"].items():
+        base = baseline.get("stages", {}).get(name, {})
+        if "best_wall" not in record or "best_wall" not in base:
+            continue
+        if not record["best_wall"]:
+            continue
+        ratio = base["best_wall"] / record["best_wall"]
+        UI.vprint(
+            0,
+            name.ljust(31),
+            "{:10.3f}".format(record["best_wall"]),
+            "{:10.3f}".format(base["best_wall"]),
+            "{:7.2f}x".format(ratio),
+        )
+
+
+################################################################################
+def run_benchmark(output_file=None, baseline_file=None, scale=1, repeat=3):
+    """
+    Time each pipeline stage on a synthetic tile. Returns the results dict,
+    also written to output_file (default benchmark_<date>.json).
+    """
+    started = datetime.datetime.now()
+    if not output_file:
+        output_file = "benchmark_" + started.strftime("%Y%m%d_%H%M%S") + ".json"
+    rng = numpy.random.default_rng(benchmark_seed)
+    work_dir = tempfile.mkdtemp(prefix="Ortho4XP_benchmark_")
+    saved_dirs = {name: getattr(FNAMES, name) for name in redirected_dirs}
+    saved_overlay_src = OVL.custom_overlay_src
+    saved_verbosity = UI.verbosity
+    stages = {}
+    try:
+        for name in redirected_dirs:
+            setattr(FNAMES, name, os.path.join(work_dir, name))
+            os.makedirs(getattr(FNAMES, name))
+        OVL.custom_overlay_src = os.path.join(work_dir, "Global Scenery")
+        UI.vprint(0, "Generating synthetic inputs in", work_dir)
+        UI.verbosity = 0
+        tile = benchmark_tile()
+        lakes = make_lakes(rng, scale)
+        osm_file = FNAMES.osm_cached(tile.lat, tile.lon, "water")
+        make_osm_file(tile, lakes, rng, osm_file)
+        dem_file = os.path.join(FNAMES.Elevation_dir, "N45E005.hgt")
+        make_dem_file(dem_file, dem_size)
+        (nbr_nodes, nbr_tris) = make_mesh_file(
+            tile, lakes, int((mesh_grid - 1) * scale ** 0.5) + 1
+        )
+        make_masks(tile)
+        make_global_scenery_dsf(
+            os.path.join(
+                OVL.custom_overlay_src,
+                "Earth nav data",
+                FNAMES.long_latlon(tile.lat, tile.lon) + ".dsf",
+            ),
+        )
+        make_providers(tile)
+        texture_attributes = DSF.zone_list_to_ortho_dico(tile)[
+            GEO.wgs84_to_orthogrid(tile.lat + 0.5, tile.lon + 0.5, tile.mesh_zl)
+        ]
+        make_orthos(tile, texture_attributes, rng)
+        tile.dem = DEM.DEM(tile.lat, tile.lon, dem_file, fill_nodata=True)
+        mesh_file = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+        im = Image.open(os.path.join(FNAMES.Utils_dir, "water_transition.png"))
+        sea_level = im.getpixel((0, 127 * (1 - min(1, 0.1 + tile.ratio_water))))
+        UI.verbosity = saved_verbosity
+
+        UI.vprint(0, "Timing the stages (" + str(repeat) + " runs each):")
+        UI.verbosity = 0
+
+        def update_dicosm():
+            layer = OSM.OSM_layer()
+            layer.update_dicosm(osm_file, input_tags=None, target_tags=None)
+            return {"nodes": len(layer.dicosmn), "ways": len(layer.dicosmw)}
+
+        time_stage(stages, "update_dicosm", update_dicosm, repeat)
+
+        layer = OSM.OSM_layer()
+        layer.update_dicosm(osm_file, input_tags=None, target_tags=None)
+        water_area = OSM.OSM_to_MultiPolygon(layer, tile.lat, tile.lon)
+        (_, dico_water) = VECT.MultiPolygon_to_Indexed_Polygons(
+            water_area, merge_overlappings=tile.clean_bad_geometries
+        )
+
+        def encode_MultiPolygon(vector_map):
+            vector_map.encode_MultiPolygon(
+                dico_water,
+                tile.dem.alt_vec,
+                "WATER",
+                area_limit=tile.min_area / 10000,
+                simplify=tile.water_simplification * GEO.m_to_lat,
+                check=True,
+            )
+            return {
+                "polygons": len(dico_water),
+                "nodes": len(vector_map.dico_nodes),
+            }
+
+        time_stage(
+            stages,
+            "encode_MultiPolygon",
+            encode_MultiPolygon,
+            repeat,
+            setup=lambda: (VECT.Vector_Map(),),
+        )
+
+        def read_mesh_file():
+            (_, nodes, _, tris, _, _) = MESH.read_mesh_file(mesh_file)
+            return {"nodes": nodes, "tris": tris}
+
+        time_stage(stages, "read_mesh_file", read_mesh_file, repeat)
+
+        def record_water_tris():
+            MASK._water_tris_cache.clear()
+            (dico_sea, dico_inland) = MASK.record_water_tris(tile)
+            return {"masks": len(dico_sea)}
+
+        time_stage(stages, "record_water_tris", record_water_tris, repeat)
+
+        pre_mask = make_pre_mask(pre_mask_size)
+        for (masking_mode, masks_width) in masking_modes:
+
+            def blur_mask(mask_tile):
+                MASK.blur_mask(pre_mask, mask_tile, sea_level)
+                return {"size": pre_mask_size}
+
+            mask_tile = types.SimpleNamespace(**vars(tile))
+            mask_tile.masking_mode = masking_mode
+            mask_tile.masks_width = masks_width
+            time_stage(
+                stages,
+                "blur_mask[" + masking_mode + "]",
+                blur_mask,
+                repeat,
+                setup=lambda: (mask_tile,),
+            )
+
+        def build_dsf(download_queue):
+            DSF.build_dsf(tile, download_queue)
+            textures = 0
+            while download_queue.get() != "quit":
+                textures += 1
+            return {"nodes": nbr_nodes, "tris": nbr_tris, "textures": textures}
+
+        time_stage(
+            stages,
+            "build_dsf",
+            build_dsf,
+            repeat,
+            setup=lambda: (queue.Queue(),),
+        )
+
+        def combine_textures():
+            IMG.combine_textures(tile, *texture_attributes)
+            return {"layers": 2}
+
+        time_stage(stages, "combine_textures", combine_textures, repeat)
+
+        if os.access(IMG.dds_convert_cmd, os.X_OK):
+
+            def convert_texture():
+                IMG.convert_texture(tile, *texture_attributes)
+                return {"layers": 2}
+
+            time_stage(stages, "convert_texture", convert_texture, repeat)
+        else:
+            stages["convert_texture"] = {
+                "skipped": IMG.dds_convert_cmd + " is not available"
+            }
+    finally:
+        UI.verbosity = saved_verbosity
+        for name in saved_dirs:
+            setattr(FNAMES, name, saved_dirs[name])
+        OVL.custom_overlay_src = saved_overlay_src
+        for code in ("BENCHA", "BENCHB"):
+            IMG.providers_dict.pop(code, None)
+        IMG.combined_providers_dict.pop(benchmark_provider, None)
+        IMG.local_combined_providers_dict.pop(benchmark_provider, None)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    results = {
+        "format": benchmark_format,
+        "date": started.isoformat(timespec="seconds"),
+        "revision": revision(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": scale,
+        "repeat": repeat,
+        "stages": stages,
+    }
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=1)
+    UI.vprint(0, "Results written to", output_file)
+    if baseline_file:
+        try:
+            with open(baseline_file, "r") as f:
+                compare(results, json.load(f))
+        except (OSError, ValueError) as e:
+            UI.vprint(
+                0, "ERROR: Could not read the baseline", baseline_file, ":", e
+            )
+    return results
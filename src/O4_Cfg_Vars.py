@@ -47,6 +47,69 @@ cfg_app_vars = {
         "values": (1, 2, 3, 4, 5, 6, 7, 8),
         "hint": "Number of parallel threads for dds conversion. Should be mainly dictated by the number of cores in your CPU.",
     },
+    "max_batch_slots": {
+        "module": "TILE",
+        "type": int,
+        "default": 1,
+        "values": (1, 2, 3, 4, 6, 8, 12, 16, 24, 32),
+        "hint": "Number of tiles whose Step 1 and Step 2 are built simultaneously (in separate processes) during a batch build. Masks, DSF and overlays still run one tile at a time, masks only once the neighbouring meshes of the batch are available. A value of 1 keeps the sequential behaviour.",
+    },
+    "max_batch_ram": {
+        "module": "TILE",
+        "type": float,
+        "default": 0.0,
+        "hint": "Approximate upper bound (in GB) on the RAM used by the tiles built simultaneously during a batch build, estimated from limit_tris. No new tile is started while the bound would be exceeded. 0 means no limit.",
+    },
+    "prefetch_tiles": {
+        "module": "TILE",
+        "type": int,
+        "default": 0,
+        "values": (0, 1, 2, 3, 4),
+        "hint": "During a batch build, number of tiles ahead of the current one(s) for which OSM and elevation data are downloaded in the background, so that network waits overlap with the mesh computations. 0 disables prefetching.",
+    },
+    "trace_builds": {
+        "module": "TRACE",
+        "type": bool,
+        "default": False,
+        "hint": "When set, the wall time, CPU time and peak memory of each stage of the build steps are recorded as nested spans in the files Trace+lat+lon.json and Trace+lat+lon.csv of the tile build directory.",
+    },
+    "skip_unchanged_steps": {
+        "module": "INCR",
+        "type": bool,
+        "default": False,
+        "hint": "When set, the content of the files and the config variables each step depends on are recorded after it runs, and a step whose inputs did not change since (and whose results are still there) is skipped. Useful to resume or re-run large batches after changing a few settings.",
+    },
+    "global_scenery_cache_size": {
+        "module": "DSF",
+        "type": int,
+        "default": 2000,
+        "hint": "Size in MB of the cache (in the tmp directory) of the elevation and bathymetry rasters extracted from X-Plane's Global Scenery at Step 3, which saves copying and uncompressing the Global Scenery DSF again when a tile is rebuilt. Least recently used entries are removed beyond that size. 0 disables the cache.",
+    },
+    "masks_build_slots": {
+        "module": "MASK",
+        "type": int,
+        "default": 4,
+        "values": (1, 2, 3, 4, 6, 8, 12, 16),
+        "hint": "Number of masks of a tile built at the same time at Step 2.5. Each one needs about 1GB of RAM.",
+    },
+    "masks_build_processes": {
+        "module": "MASK",
+        "type": bool,
+        "default": False,
+        "hint": "If checked, the masks of Step 2.5 are built in separate processes rather than in threads of the main one, each being sent the water triangles of its own mask only. Polygon filling, blurs and distance computations then run truly in parallel, at the cost of starting the processes.",
+    },
+    "mask_cache_size": {
+        "module": "MASK",
+        "type": int,
+        "default": 256,
+        "hint": "Size in MB of the in-memory cache of decoded masks (16MB each at the usual 4096x4096), which Step 3 and the texture conversions read to know if and how a texture is masked. Least recently used masks are dropped beyond that size.",
+    },
+    "masks_tiled_storage": {
+        "module": "MASK",
+        "type": bool,
+        "default": False,
+        "hint": "If checked, the masks of Step 2.5 are stored as .o4m files made of 256x256 zlib compressed blocks, uniform ones being only flagged in their index, rather than as PNG. Step 3 and the texture conversions then decode only the blocks under the textures they deal with. Unlike PNG masks, these cannot be edited by hand (a PNG mask present next to one is used instead).",
+    },
     "check_tms_response": {
         "module": "IMG",
         "type": bool,
@@ -354,6 +417,16 @@ list_app_vars = [
     "skip_downloads",
     "skip_converts",
     "max_convert_slots",
+    "max_batch_slots",
+    "max_batch_ram",
+    "prefetch_tiles",
+    "trace_builds",
+    "skip_unchanged_steps",
+    "global_scenery_cache_size",
+    "masks_build_slots",
+    "masks_build_processes",
+    "mask_cache_size",
+    "masks_tiled_storage",
     "check_tms_response",
     "http_timeout",
     "max_connect_retries",
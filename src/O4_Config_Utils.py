@@ -4,9 +4,13 @@ import ast
 import logging
 import os
 from math import ceil
-import tkinter as tk
-import tkinter.ttk as ttk
-from tkinter import N, S, E, W, filedialog, messagebox
+try:
+    import tkinter as tk
+    import tkinter.ttk as ttk
+    from tkinter import N, S, E, W, filedialog, messagebox
+except ImportError:
+    # Headless installs (job files) only need the Tile class
+    tk = None
 from O4_Cfg_Vars import (
     cfg_app_vars,
     cfg_global_tile_vars,
@@ -36,6 +40,10 @@ import O4_Vector_Map as VMAP
 import O4_Imagery_Utils as IMG
 import O4_Tile_Utils as TILE
 import O4_Overlay_Utils as OVL
+import O4_DSF_Utils as DSF
+import O4_Mask_Utils as MASK
+import O4_Trace_Utils as TRACE
+import O4_Incremental_Utils as INCR
 
 _LOGGER = logging.getLogger(__name__)
 _LOGGER.setLevel(logging.INFO)
@@ -298,7 +306,7 @@ class Tile:
 ################################################################################
 
 ################################################################################
-class Ortho4XP_Config(tk.Toplevel):
+class Ortho4XP_Config(tk.Toplevel if tk else object):
     """Ortho4XP configuration window."""
     def __init__(self, parent):
 
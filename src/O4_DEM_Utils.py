@@ -17,6 +17,7 @@ except:
 from PIL import Image
 import O4_UI_Utils as UI
 import O4_File_Names as FNAMES
+import O4_Filter_Utils as FILTER
 
 available_sources = (
     "View",
@@ -800,6 +801,74 @@ def ensure_elevation(source, lat, lon, verbose=True):
         return 0
     return 1
 
+################################################################################
+def elevation_files(lat, lon, source=""):
+    """
+    Local files read by DEM(lat, lon, source), whether they exist or not.
+    """
+    source = source.replace("{latlon}", FNAMES.hem_latlon(lat, lon))
+    (source, *local_sources) = source.split(";")
+    if not source:
+        if os.path.exists(FNAMES.generic_tif(lat, lon)):
+            source = FNAMES.generic_tif(lat, lon)
+        else:
+            source = available_sources[1]
+    files = []
+    if source in available_sources[1::2]:
+        short_source = available_sources[available_sources.index(source) - 1]
+        if short_source in global_sources:
+            for (lat0, lon0) in itertools.product(
+                (lat, lat - 1, lat + 1), (lon, lon - 1, lon + 1)
+            ):
+                files.append(
+                    FNAMES.elevation_data(
+                        short_source, lat0, (lon0 + 180) % 360 - 180
+                    )
+                )
+        else:
+            files.append(FNAMES.elevation_data(short_source, lat, lon))
+    else:
+        files.append(source)
+    return files + [
+        local_source for local_source in local_sources if local_source
+    ]
+
+################################################################################
+def prefetch_elevation(lat, lon, source=""):
+    """
+    Download (if needed) the elevation files which DEM(lat, lon, source)
+    will read, without loading them. Local sources are left untouched.
+    """
+    source = source.replace("{latlon}", FNAMES.hem_latlon(lat, lon))
+    source = source.split(";")[0]
+    if not source:
+        if os.path.exists(FNAMES.generic_tif(lat, lon)):
+            return 1
+        source = available_sources[1]
+    if source not in available_sources[1::2]:
+        return 1
+    short_source = available_sources[available_sources.index(source) - 1]
+    if short_source not in global_sources:
+        return ensure_elevation(short_source, lat, lon, verbose=False)
+    world_tiles = numpy.array(
+        Image.open(os.path.join(FNAMES.Utils_dir, "world_tiles.png"))
+    )
+    success = 1
+    for (lat0, lon0) in itertools.product(
+        (lat, lat - 1, lat + 1), (lon, lon - 1, lon + 1)
+    ):
+        if not world_tiles[89 - lat0, (180 + lon0) % 360]:
+            continue
+        if UI.red_flag:
+            return 0
+        success = (
+            ensure_elevation(
+                short_source, lat0, (lon0 + 180) % 360 - 180, verbose=False
+            )
+            and success
+        )
+    return success
+
 ################################################################################
 def http_request(url, source, verbose=False):
     s = requests.Session()
@@ -936,21 +1005,9 @@ def smoothen(raster, pix_width, mask_im, preserve_boundary=True):
         return raster
     tmp = numpy.array(raster)
     mask_array = numpy.array(mask_im, dtype=numpy.float32) / 255
-    kernel = numpy.array(range(1, 2 * (pix_width + 1)))
-    kernel[pix_width + 1 :] = range(pix_width, 0, -1)
-    kernel = kernel / (pix_width + 1) ** 2
     tmp = tmp * mask_array
-    tmpw = numpy.array(mask_array)
-    for i in range(0, len(tmp)):
-        tmp[i] = numpy.convolve(tmp[i], kernel)[pix_width:-pix_width]
-        tmpw[i] = numpy.convolve(tmpw[i], kernel)[pix_width:-pix_width]
-    tmp = tmp.transpose()
-    tmpw = tmpw.transpose()
-    for i in range(0, len(tmp)):
-        tmp[i] = numpy.convolve(tmp[i], kernel)[pix_width:-pix_width]
-        tmpw[i] = numpy.convolve(tmpw[i], kernel)[pix_width:-pix_width]
-    tmp = tmp.transpose()
-    tmpw = tmpw.transpose()
+    tmp = FILTER.hat_filter(tmp, pix_width + 1, tmp.dtype)
+    tmpw = FILTER.hat_filter(mask_array, pix_width + 1, mask_array.dtype)
     tmp[mask_array != 0] = (
         mask_array[mask_array != 0]
         * tmp[mask_array != 0]
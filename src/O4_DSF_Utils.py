@@ -6,7 +6,6 @@ import os
 import pickle
 import shutil
 import struct
-from collections import defaultdict
 from math import ceil, floor
 from PIL import Image, ImageDraw
 import subprocess
@@ -17,6 +16,7 @@ import O4_Mask_Utils as MASK
 import O4_Mesh_Utils as MESH
 import O4_Overlay_Utils as OVL
 import O4_UI_Utils as UI
+import O4_Trace_Utils as TRACE
 
 quad_init_level = 3
 quad_capacity_high = 50000
@@ -25,87 +25,108 @@ quad_capacity_low = 35000
 # For Laminar test suite
 use_test_texture = False
 
+# in MB, for the rasters extracted from the Global Scenery
+global_scenery_cache_size = 2000
+global_scenery_cache_magic = b"O4XPGSR1"
+global_scenery_cache_header = struct.Struct("<8sQQ")
+
 ################################################################################
-def float2qquad(x):
-    if x >= 1:
-        return "111111111111111111111111"
-    return numpy.binary_repr(int(16777216 * x)).zfill(24)  # 2**24 == 16777216
+def quantize_coords(x):
+    """24 bits fixed point version of coordinates within the tile ([0,1])."""
+    # 2**24 == 16777216
+    return numpy.clip(numpy.floor(16777216 * x), 0, 16777215).astype(
+        numpy.uint32
+    )
 
 
 ################################################################################
+def morton_codes(qx, qy):
+    """
+    Interleave the bits of the quantized coordinates, x bits first: the nodes
+    of a quadtree bucket at level L share the first 2*L bits of their codes,
+    and sorting by code lists the buckets in (x, y) order.
+    """
+
+    def spread(q):
+        q = numpy.asarray(q, dtype=numpy.uint64)
+        for shift, mask in (
+            (16, 0x0000FFFF0000FFFF),
+            (8, 0x00FF00FF00FF00FF),
+            (4, 0x0F0F0F0F0F0F0F0F),
+            (2, 0x3333333333333333),
+            (1, 0x5555555555555555),
+        ):
+            q = (q | (q << numpy.uint64(shift))) & numpy.uint64(mask)
+        return q
 
-################################################################################
-class QuadTree(dict):
-    class Bucket(dict):
-        def __init__(self):
-            self["size"] = 0
-            self["idx_nodes"] = set()
-
-    def __init__(self, level, bucket_size):
-        self.bucket_size = bucket_size
-        if level == 0:
-            self[("", "")] = self.Bucket()
-        else:
-            for i in range(2 ** level):
-                for j in range(2 ** level):
-                    key = (
-                        numpy.binary_repr(i).zfill(level),
-                        numpy.binary_repr(j).zfill(level),
-                    )
-                    self[key] = self.Bucket()
-        self.nodes = {}
-        self.levels = {}
-        self.last_node = 0
-
-    def split_bucket(self, key):
-        level = len(key[0]) + 1
-        self[(key[0] + "0", key[1] + "0")] = self.Bucket()
-        self[(key[0] + "0", key[1] + "1")] = self.Bucket()
-        self[(key[0] + "1", key[1] + "0")] = self.Bucket()
-        self[(key[0] + "1", key[1] + "1")] = self.Bucket()
-        for idx in self[key]["idx_nodes"]:
-            new_key = (self.nodes[idx][0][:level], self.nodes[idx][1][:level])
-            self[new_key]["idx_nodes"].add(idx)
-            self[new_key]["size"] += 1
-            self.levels[idx] += 1
-        del self[key]
-
-    def insert(self, bx, by, level):
-        while True:
-            key = (bx[:level], by[:level])
-            if key in self:
-                break
-            level += 1
-        if self[key]["size"] < self.bucket_size:
-            self[key]["idx_nodes"].add(self.last_node)
-            self[key]["size"] += 1
-            self.nodes[self.last_node] = (bx, by)
-            self.levels[self.last_node] = level
-            self.last_node += 1
-        else:
-            self.split_bucket(key)
-            self.insert(bx, by, level + 1)
-
-    def clean(self):
-        for key in list(self.keys()):
-            if not self[key]["size"]:
-                del self[key]
-
-    def statistics(self):
-        lengths = numpy.array([self[key]["size"] for key in self])
-        depths = numpy.array([len(key[0]) for key in self])
-        UI.vprint(2, "     Number of buckets:", len(lengths))
-        UI.vprint(
-            2,
-            "     Average depth:",
-            depths.mean(),
-            ", Average bucket size:",
-            lengths.mean(),
-        )
-        UI.vprint(2, "     Largest depth:", numpy.max(depths))
+    return (spread(qx) << numpy.uint64(1)) | spread(qy)
 
 
 ################################################################################
+def pool_quadtree(qx, qy, init_level, bucket_size):
+    """
+    Split the tile in quadtree buckets (the point pools) of at most
+    bucket_size nodes, starting from a regular grid at init_level. Nodes are
+    sorted once by Morton code, so that each bucket is a range of that order
+    and its size a difference of two searchsorted.
+
+    Returns the non empty buckets as (level, ix, iy, nodes) tuples, ordered
+    as an insertion of the nodes one by one would order them (initial
+    buckets first, then the children of split buckets by time of overflow),
+    and the list of the pool index of each node.
+    """
+    order = numpy.argsort(morton_codes(qx, qy), kind="stable")
+    codes = morton_codes(qx[order], qy[order])
+    buckets = []
+    stack = [
+        (init_level, ix, iy, (-1, 0, ix * 2 ** init_level + iy))
+        for ix in range(2 ** init_level)
+        for iy in range(2 ** init_level)
+    ]
+    while stack:
+        (level, ix, iy, rank) = stack.pop()
+        shift = 24 - level
+        code_min = int(morton_codes(ix << shift, iy << shift))
+        (lo, hi) = numpy.searchsorted(
+            codes,
+            numpy.array(
+                [code_min, code_min + (1 << (2 * shift))], dtype=numpy.uint64
+            ),
+        )
+        if hi - lo > bucket_size and level < 24:
+            # the bucket overflows when its (bucket_size+1)th node comes in
+            overflow = numpy.partition(order[lo:hi], bucket_size)[bucket_size]
+            for child in range(4):
+                stack.append(
+                    (
+                        level + 1,
+                        2 * ix + (child >> 1),
+                        2 * iy + (child & 1),
+                        (overflow, level + 1, child),
+                    )
+                )
+        elif hi > lo:
+            buckets.append((rank, level, ix, iy, order[lo:hi]))
+    buckets.sort(key=lambda bucket: bucket[0])
+    node_to_pool = numpy.zeros(len(qx), dtype=numpy.int64)
+    for idx_pool, (_, _, _, _, nodes) in enumerate(buckets):
+        node_to_pool[nodes] = idx_pool
+    lengths = numpy.array([len(bucket[4]) for bucket in buckets])
+    depths = numpy.array([bucket[1] for bucket in buckets])
+    UI.vprint(2, "     Number of buckets:", len(lengths))
+    UI.vprint(
+        2,
+        "     Average depth:",
+        depths.mean(),
+        ", Average bucket size:",
+        lengths.mean(),
+    )
+    UI.vprint(2, "     Largest depth:", numpy.max(depths))
+    return (
+        [bucket[1:] for bucket in buckets],
+        node_to_pool.tolist(),
+    )
+
 
 ################################################################################
 def zone_list_to_ortho_dico(tile):
@@ -357,6 +378,94 @@ def create_terrain_file(
 
 ################################################################################
 
+################################################################################
+def global_scenery_cache_file(global_scenery_dsf, lat, lon):
+    """
+    Cache file of the rasters of a Global Scenery DSF, keyed by its path,
+    size and modification time. None if the cache is disabled.
+    """
+    if global_scenery_cache_size <= 0:
+        return None
+    stat = os.stat(global_scenery_dsf)
+    source_key = hashlib.sha1(
+        os.path.abspath(global_scenery_dsf).encode()
+    ).hexdigest()[:12]
+    stamp_key = hashlib.sha1(
+        "{}|{}".format(stat.st_size, stat.st_mtime_ns).encode()
+    ).hexdigest()[:12]
+    return FNAMES.global_scenery_cache_file(lat, lon, source_key, stamp_key)
+
+
+################################################################################
+def read_cached_rasters(cache_file):
+    try:
+        with open(cache_file, "rb") as f:
+            (magic, len_DEMN, len_DEMS) = global_scenery_cache_header.unpack(
+                f.read(global_scenery_cache_header.size)
+            )
+            bDEMN = f.read(len_DEMN)
+            bDEMS = f.read(len_DEMS)
+        if (
+            magic != global_scenery_cache_magic
+            or len(bDEMN) != len_DEMN
+            or len(bDEMS) != len_DEMS
+        ):
+            raise ValueError
+        # most recently used entries are kept first by the eviction
+        os.utime(cache_file)
+    except (OSError, ValueError, struct.error):
+        return None
+    return (bDEMN, bDEMS)
+
+
+################################################################################
+def write_cached_rasters(cache_file, bDEMN, bDEMS):
+    cache_dir = os.path.dirname(cache_file)
+    tmp_file = cache_file + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # entries of former versions of the same DSF are outdated
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(
+                os.path.basename(cache_file).rsplit("_", 1)[0] + "_"
+            ):
+                os.remove(os.path.join(cache_dir, file_name))
+        with open(tmp_file, "wb") as f:
+            f.write(
+                global_scenery_cache_header.pack(
+                    global_scenery_cache_magic, len(bDEMN), len(bDEMS)
+                )
+            )
+            f.write(bDEMN)
+            f.write(bDEMS)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        UI.vprint(1, "     WARNING: Could not cache the rasters:", e)
+        return
+    evict_cached_rasters(cache_dir)
+
+
+################################################################################
+def evict_cached_rasters(cache_dir):
+    """Remove least recently used entries beyond global_scenery_cache_size."""
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        try:
+            stat = os.stat(os.path.join(cache_dir, file_name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file_name))
+    total_size = sum(size for (_, size, _) in entries)
+    for (_, size, file_name) in sorted(entries):
+        if total_size <= global_scenery_cache_size * 2 ** 20:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, file_name))
+            total_size -= size
+        except OSError:
+            pass
+
+
 ################################################################################
 def extract_elevation_and_bathymetry_data(lat, lon):
     UI.vprint(1, "     Extracting some rasters from X-Plane's Global Scenery")
@@ -379,6 +488,22 @@ def extract_elevation_and_bathymetry_data(lat, lon):
             "window first.",
         )
         return (b"", b"")
+    cache_file = global_scenery_cache_file(global_scenery_dsf, lat, lon)
+    if cache_file:
+        rasters = read_cached_rasters(cache_file)
+        if rasters:
+            UI.vprint(2, "     Using the cached rasters of", cache_file)
+            return rasters
+    (bDEMN, bDEMS) = read_elevation_and_bathymetry_data(
+        global_scenery_dsf, lat, lon
+    )
+    if cache_file and (bDEMN or bDEMS):
+        write_cached_rasters(cache_file, bDEMN, bDEMS)
+    return (bDEMN, bDEMS)
+
+
+################################################################################
+def read_elevation_and_bathymetry_data(global_scenery_dsf, lat, lon):
     tmp_file = os.path.join(
         FNAMES.Tmp_dir, FNAMES.short_latlon(lat, lon) + ".dsf"
     )
@@ -464,32 +589,129 @@ def extract_elevation_and_bathymetry_data(lat, lon):
 
 
 ################################################################################
+def encode_pool_atoms(
+    dsf_pools, dsf_pool_length, dsf_pool_plane, pool_param, pool_nbr
+):
+    """
+    POOL and SCAL atoms of the non empty point pools, each pool being
+    stored plane by plane.
+    """
+    bPOOL = bytearray()
+    bSCAL = bytearray()
+    for k in numpy.flatnonzero(dsf_pool_length).tolist():
+        (length, plane) = (int(dsf_pool_length[k]), int(dsf_pool_plane[k]))
+        planes = numpy.zeros((plane, 1 + 2 * length), dtype=numpy.uint8)
+        # the first byte of each plane is its encoding (0 = raw)
+        planes[:, 1:] = (
+            numpy.frombuffer(dsf_pools[k], dtype=numpy.uint16)
+            .reshape(length, plane)
+            .T.astype("<u2", order="C")
+            .view(numpy.uint8)
+        )
+        bPOOL += b"LOOP" + struct.pack(
+            "<IIB", 13 + plane + 2 * plane * length, length, plane
+        )
+        bPOOL += planes.tobytes()
+        bSCAL += b"LACS" + struct.pack("<I", 8 + 8 * plane)
+        bSCAL += struct.pack(
+            "<" + str(2 * plane) + "f", *pool_param[k % pool_nbr][: 2 * plane]
+        )
+    return (bytes(bPOOL), bytes(bSCAL))
+
+
+################################################################################
+def encode_patch_triangles(command, coords, coords_per_command):
+    """
+    Patch triangle commands (23 = PATCH TRIANGLE, 24 = ... CROSS-POOL) for
+    the uint16 array coords, coords_per_command at most per command, each
+    command being followed by its coordinate count and its coordinates.
+    """
+    coords = numpy.asarray(coords, dtype="<u2")
+    counts = numpy.full(len(coords) // coords_per_command, coords_per_command)
+    if len(coords) % coords_per_command:
+        counts = numpy.append(counts, len(coords) % coords_per_command)
+    per_vertex = coords_per_command // 255
+    # command byte, count byte, then the coordinates of each command
+    cmd_starts = numpy.cumsum(2 + 2 * counts) - (2 + 2 * counts)
+    buffer = numpy.zeros(len(coords) * 2 + 2 * len(counts), dtype=numpy.uint8)
+    buffer[cmd_starts] = command
+    buffer[cmd_starts + 1] = counts // per_vertex
+    coord_bytes = numpy.ones(len(buffer), dtype=bool)
+    coord_bytes[cmd_starts] = False
+    coord_bytes[cmd_starts + 1] = False
+    buffer[coord_bytes] = coords.view(numpy.uint8)
+    return buffer.tobytes()
+
 
 ################################################################################
+def encode_terrain_commands(
+    textured_tris, overlay_terrains, new_dsf_pool, overlay_lod
+):
+    """
+    CMDS atom content for the triangles of each terrain, as grouped by
+    build_dsf: {terrain_idx: {idx_dsfpool or "cross-pool": coords}}.
+    """
+    bCMDS = bytearray()
+    for terrain_idx in textured_tris:
+        if len(textured_tris[terrain_idx]) == 0:
+            continue
+        bCMDS += struct.pack("<BH", 4, terrain_idx)  # SET DEFINITION 16
+        flag = (
+            1 if terrain_idx not in overlay_terrains else 2
+        )  # physical or overlay
+        lod = -1 if flag == 1 else overlay_lod
+        for idx_dsfpool in textured_tris[terrain_idx]:
+            coords = numpy.frombuffer(
+                textured_tris[terrain_idx][idx_dsfpool], dtype=numpy.uint16
+            )
+            if idx_dsfpool != "cross-pool":
+                pool_idx = new_dsf_pool[idx_dsfpool]
+            else:
+                # (pool, pos_in_pool) pairs
+                coords = coords.copy()
+                coords[0::2] = new_dsf_pool[coords[0::2]]
+                pool_idx = coords[0]
+            # POOL SELECT, TERRAIN PATCH FLAGS AND LOD
+            bCMDS += struct.pack("<BHBBff", 1, pool_idx, 18, flag, 0, lod)
+            if idx_dsfpool != "cross-pool":
+                bCMDS += encode_patch_triangles(23, coords, 255)
+            else:
+                bCMDS += encode_patch_triangles(24, coords, 510)
+    return bytes(bCMDS)
+
+
+################################################################################
+
+################################################################################
+@TRACE.traced("build_dsf")
 def build_dsf(tile, download_queue):
 
     
     dico_customzl = zone_list_to_ortho_dico(tile)
 
     # 1 Read mesh file
+    TRACE.phase("1 read mesh")
     UI.vprint(1, "-> Reading mesh file")
     mesh_filename = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
     (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types) \
             = MESH.read_mesh_file(mesh_filename)
 
     # 2 Remap tri_types in (0,1,2)
+    TRACE.phase("2 remap tri types")
     has_water = 7 if (mesh_version >= 1.3) else 3
-    for i in range(nbr_tris):
-        t = tri_types[i] & has_water
-        t = t and (2 * (t > 1 or tile.use_masks_for_inland) or 1)
-        tri_types[i] = t
+    t = tri_types & has_water
+    tri_types = numpy.where(
+        t == 0, 0, numpy.where((t > 1) | tile.use_masks_for_inland, 2, 1)
+    ).astype(tri_types.dtype)
 
     # 3 Recut water tris for XP12
+    TRACE.phase("3 recut water tris")
     UI.vprint(1, "-> Adapting water triangles to XP12 requirements")
     (nbr_nodes, node_coords, node_types, node_is_coast, nbr_tris, tri_idx, 
         tri_types) = BATHY.recut_water_tris(node_coords, tri_idx, tri_types)
 
     # 4 Compute bathymetry depth ratio bounds based on masks
+    TRACE.phase("4 depth ratio bounds")
     UI.vprint(1, "-> Computing bathymetry depth ratio bounds based on distance masks")
     node_bathy = BATHY.compute_depth_ratio_bounds_from_masks(
                             nbr_nodes, node_coords, node_types, tile)
@@ -497,45 +719,29 @@ def build_dsf(tile, download_queue):
     UI.vprint(1, "-> Computing point pools and texture requirements")
     
     # 5 Compute quadtree
+    TRACE.phase("5 quadtree")
     if (tile.use_masks_for_inland):
         quad_capacity = quad_capacity_low
     else:
         quad_capacity = quad_capacity_high
-    pool_quadtree = QuadTree(quad_init_level, quad_capacity)
-    for i in range(nbr_nodes):
-        pool_quadtree.insert(
-                float2qquad(node_coords[5 * i + 0] - tile.lon),
-                float2qquad(node_coords[5 * i + 1] - tile.lat),
-                quad_init_level)
-    pool_quadtree.clean()
-    pool_quadtree.statistics()
-    
+    qx = quantize_coords(node_coords[0::5] - tile.lon)
+    qy = quantize_coords(node_coords[1::5] - tile.lat)
+    (pools, idx_node_to_idx_pool) = pool_quadtree(
+        qx, qy, quad_init_level, quad_capacity
+    )
+
     # 6 Compute pool params
-    pool_nbr = len(pool_quadtree)
-    idx_node_to_idx_pool = {}
-    idx_pool = 0
-    key_to_idx_pool = {}
-    for key in pool_quadtree:
-        key_to_idx_pool[key] = idx_pool
-        for idx_node in pool_quadtree[key]["idx_nodes"]:
-            idx_node_to_idx_pool[idx_node] = idx_pool
-        idx_pool += 1
+    TRACE.phase("6 pool params")
+    pool_nbr = len(pools)
     pool_param = {}
     node_icoords = numpy.zeros(5 * nbr_nodes, dtype = numpy.uint16)
-    for key in pool_quadtree:
-        level = len(key[0])
-        plist = sorted(list(pool_quadtree[key]["idx_nodes"]))
-        node_icoords[[5 * idx_node for idx_node in plist]] = [
-            int(pool_quadtree.nodes[idx_node][0][level : level + 16], 2)
-            for idx_node in plist
-        ]
-        node_icoords[[5 * idx_node + 1 for idx_node in plist]] = [
-            int(pool_quadtree.nodes[idx_node][1][level : level + 16], 2)
-            for idx_node in plist
-        ]
-        altitudes = numpy.array(
-            [node_coords[5 * idx_node + 2] for idx_node in plist]
-        )
+    for idx_pool, (level, ix, iy, plist) in enumerate(pools):
+        # the 16 bits following the bucket prefix
+        shift = max(8 - level, 0)
+        mask = (1 << min(16, 24 - level)) - 1
+        node_icoords[5 * plist] = (qx[plist] >> shift) & mask
+        node_icoords[5 * plist + 1] = (qy[plist] >> shift) & mask
+        altitudes = node_coords[5 * plist + 2]
         altmin = floor(altitudes.min())
         altmax = ceil(altitudes.max())
         if altmax - altmin < 770:
@@ -551,14 +757,14 @@ def build_dsf(tile, download_queue):
             scale_z = 13107  # 65535=13107*5
             inv_stp = 5
         scal_x = scal_y = 2 ** (-level)
-        node_icoords[[5 * idx_node + 2 for idx_node in plist]] = numpy.round(
+        node_icoords[5 * plist + 2] = numpy.round(
             (altitudes - altmin) * inv_stp
         )
-        pool_param[key_to_idx_pool[key]] = (
+        pool_param[idx_pool] = (
             scal_x,
-            tile.lon + int(key[0], 2) * scal_x,
+            tile.lon + ix * scal_x,
             scal_y,
-            tile.lat + int(key[1], 2) * scal_y,
+            tile.lat + iy * scal_y,
             scale_z,
             altmin,
             2,
@@ -580,22 +786,14 @@ def build_dsf(tile, download_queue):
     node_icoords[4::5] = numpy.round(
         (1 - tile.normal_map_strength * node_coords[4::5]) / 2 * 65535
     )
-    node_icoords = array.array("H", node_icoords)
+    node_icoords = node_icoords.reshape(nbr_nodes, 5)
 
-    
-    
     ##########################
-    dico_terrains = {}
     overlay_terrains = set()
     treated_textures = set()
-    skipped_terrains_for_masking = set()
-    dsf_pools = {}
     # we need more pools for textured nodes than for nodes : land, UV masked
     # water, and XP water
     dsf_pool_nbr = 3 * pool_nbr
-    for idx_dsfpool in range(dsf_pool_nbr):
-        dsf_pools[idx_dsfpool] = array.array("H")
-    dsf_pool_length = numpy.zeros(dsf_pool_nbr, "int")
     if (tile.water_tech == "XP11 + bathy"):
         # Land with ortho
         dsf_pool_plane = 7 * numpy.ones(dsf_pool_nbr, "int")
@@ -612,10 +810,6 @@ def build_dsf(tile, download_queue):
         dsf_pool_plane[pool_nbr : 2 * pool_nbr] = 9
         # Regular XP water
         dsf_pool_plane[2 * pool_nbr : 3 * pool_nbr] = 7
-    textured_nodes = {}
-    len_textured_nodes = 0
-    textured_tris = {}
-    total_cross_pool = 0
     ##########################
 
     bPROP = b""
@@ -631,302 +825,145 @@ def build_dsf(tile, download_queue):
     nbr_dsfpools_yet_in = 0
     dico_terrains = {"terrain_Water": 0}
     bTERT = bytes("terrain_Water\0", "ascii")
-    textured_tris[0] = defaultdict(lambda: array.array("H"))
 
-    # Next, we build DSF mesh points (these take into accound texture 
-    # as well), point pools, etc.
-
-    step = nbr_tris // 100 + 1
-    
-    # Tri counter for progress_bars
-    done = 0
-    
+    # Next, we build DSF mesh points (these take into accound texture
+    # as well), point pools, etc. Triangles are processed in bulk, first
+    # the potentially masked water tris, then land and inland water tris.
+    # Everything below is ordered as if they were treated one by one in
+    # that order (terrains, and nodes within the pools, by first use).
+    proc_tris = numpy.concatenate(
+        (numpy.flatnonzero(tri_types == 2), numpy.flatnonzero(tri_types != 2))
+    )
+    proc_types = tri_types[proc_tris].astype(numpy.int64)
+    # beware of ordering for orientation !
+    proc_nodes = tri_idx.reshape(nbr_tris, 3)[proc_tris][:, [0, 2, 1]].astype(
+        numpy.int64
+    )
 
-    # First potentially masked water tris
-    for tri in range(nbr_tris):
-        tri_type = tri_types[tri]
-        if (tri_type != 2):
-            continue
-        (n1, n2, n3) = tri_idx[3 * tri: 3 * tri + 3]
-        if done % step == 0:
-            UI.progress_bar(1, int(done / step * 0.9))
-            if UI.red_flag:
-                UI.vprint(1, "DSF construction interrupted.")
-                return 0
-        done += 1
-        bary_lon = (
-            node_coords[5 * n1 + 0]
-            + node_coords[5 * n2 + 0]
-            + node_coords[5 * n3 + 0]
-        ) / 3
-        bary_lat = (
-            node_coords[5 * n1 + 1]
-            + node_coords[5 * n2 + 1]
-            + node_coords[5 * n3 + 1]
-        ) / 3
-        texture_attributes = dico_customzl[
-            GEO.wgs84_to_orthogrid(bary_lat, bary_lon, tile.mesh_zl)
-        ]
-        # The entries for the terrain and texture main dictionnaries
-        terrain_attributes = (texture_attributes, tri_type)
-        is_overlay = False
-        
-
-        # Do we need to build new terrain file(s) ?
-        if terrain_attributes in dico_terrains:
-            terrain_idx = dico_terrains[terrain_attributes]
-            is_overlay = terrain_idx in overlay_terrains
-        else:
-            needs_new_terrain = False
-            # if not we need to check with masks values
-            if terrain_attributes not in skipped_terrains_for_masking:
-                mask_im = MASK.needs_mask(tile, *texture_attributes)
-                if mask_im:
-                    UI.vprint(2, "      Use of an alpha mask.")
-                    needs_new_terrain = True
-                else:
-                    skipped_terrains_for_masking.add(terrain_attributes)
-                    # clean up potential old masks in the tile dir
-                    try:
-                        os.remove(
-                            os.path.join(
-                                tile.build_dir,
-                                "textures",
-                                FNAMES.mask_file(*texture_attributes),
-                            )
-                        )
-                    except:
-                        pass
-            if needs_new_terrain:
-                terrain_idx = len(dico_terrains)
-                textured_tris[terrain_idx] = defaultdict(
-                    lambda: array.array("H")
-                )
-                dico_terrains[terrain_attributes] = terrain_idx
-                
-                # Is it an overlay terrain or the new XP 12 phys water type ?
-                # XP11 style => overlay
-                is_overlay = (tile.water_tech == "XP11 + bathy") 
-                # No alpha channel in DDS => overlay
-                is_overlay |= not tile.imprint_masks_to_dds
-                
-                if is_overlay:
-                    overlay_terrains.add(terrain_idx)
-                
-                texture_file_name = FNAMES.dds_file_name_from_attributes(
-                    *texture_attributes
-                )
-                # do we need to (re)build a texture ?
-                if texture_attributes not in treated_textures:
-                    target_tex = os.path.join(
-                            tile.build_dir, "textures", texture_file_name
-                            )
-                    rebuild = False
-                    if (not os.path.isfile(target_tex)):
-                        rebuild = True
-                    elif (tile.imprint_masks_to_dds):
-                        # Maybe target_tex was a DXT1, we need DXT5
-                        if (os.path.getsize(target_tex) < 20000000):
-                            rebuild = True
-                        # Maybe masks were updated after target_tex was created
-                        target_mask = MASK.mask_name_for_texture(tile, 
-                                          *texture_attributes)
-                        if (os.path.isfile(target_mask)):
-                            mask_last_modified = os.path.getmtime(target_mask)
-                            tex_last_modified = os.path.getmtime(target_tex)
-                            if (tex_last_modified < mask_last_modified):
-                                rebuild = True
-                    else: 
-                        # maybe target_tex was a DXT5, it should ne a DXT1
-                        if (os.path.getsize(target_tex) > 20000000):
-                            rebuild = True
-                        else:
-                            print(os.path.getsize(target_tex))
-                    
-                    if (rebuild or not tile.imprint_masks_to_dds):
-                        mask_im.save(os.path.join(
+    # 7 Terrains
+    TRACE.phase("7 terrains")
+    lon = node_coords[0::5]
+    lat = node_coords[1::5]
+    bary_lon = (
+        lon[proc_nodes[:, 0]] + lon[proc_nodes[:, 2]] + lon[proc_nodes[:, 1]]
+    ) / 3
+    bary_lat = (
+        lat[proc_nodes[:, 0]] + lat[proc_nodes[:, 2]] + lat[proc_nodes[:, 1]]
+    ) / 3
+    (til_x, til_y) = GEO.wgs84_to_orthogrid_array(
+        bary_lat, bary_lon, tile.mesh_zl
+    )
+    (cells, proc_cells) = numpy.unique(
+        (til_x << 32) | til_y, return_inverse=True
+    )
+    texture_ids = {}
+    cell_textures = numpy.array(
+        [
+            texture_ids.setdefault(
+                dico_customzl[(cell >> 32, cell & 0xFFFFFFFF)],
+                len(texture_ids),
+            )
+            for cell in cells.tolist()
+        ],
+        dtype=numpy.int64,
+    )
+    textures = list(texture_ids)
+    proc_textures = cell_textures[proc_cells]
+    # terrain attributes (texture_attributes, tri_type) by first use
+    (terrain_keys, first_use) = numpy.unique(
+        4 * proc_textures + proc_types, return_index=True
+    )
+    terrain_keys = terrain_keys[numpy.argsort(first_use)]
+    key_terrain = {}
+    for (done, key) in enumerate(terrain_keys.tolist()):
+        UI.progress_bar(1, int(done / len(terrain_keys) * 50))
+        if UI.red_flag:
+            UI.vprint(1, "DSF construction interrupted.")
+            return 0
+        texture_attributes = textures[key // 4]
+        tri_type = key % 4
+        texture_file_name = FNAMES.dds_file_name_from_attributes(
+            *texture_attributes
+        )
+        if tri_type == 2:
+            # masked water, we need to check with masks values
+            mask_im = MASK.needs_mask(tile, *texture_attributes)
+            if not mask_im:
+                key_terrain[key] = 0
+                # clean up potential old masks in the tile dir
+                try:
+                    os.remove(
+                        os.path.join(
                             tile.build_dir,
                             "textures",
                             FNAMES.mask_file(*texture_attributes),
                         )
                     )
-
-                    if (rebuild):
-                            download_queue.put(texture_attributes)
-                    else:
-                        UI.vprint(
-                            2,
-                            "   Texture file "
-                            + texture_file_name
-                            + " already present.",
+                except:
+                    pass
+                continue
+            UI.vprint(2, "      Use of an alpha mask.")
+            # Is it an overlay terrain or the new XP 12 phys water type ?
+            # XP11 style => overlay
+            is_overlay = (tile.water_tech == "XP11 + bathy")
+            # No alpha channel in DDS => overlay
+            is_overlay |= not tile.imprint_masks_to_dds
+            # do we need to (re)build a texture ?
+            if texture_attributes not in treated_textures:
+                target_tex = os.path.join(
+                        tile.build_dir, "textures", texture_file_name
                         )
-                    treated_textures.add(texture_attributes)
-                terrain_file_name = create_terrain_file(
-                    tile,
-                    texture_file_name,
-                    *texture_attributes,
-                    tri_type,
-                    is_overlay
-                )
-                bTERT += bytes("terrain/" + terrain_file_name + "\0", "ascii")
-            else:
-                terrain_idx = 0
-        
-        # We put the tri in the right terrain
-        # First the ones associated to the dico_customzl
-        if terrain_idx:
-            tri_p = array.array("H")
-            for n in (n1, n3, n2):  # beware of ordering for orientation !
-                idx_pool = idx_node_to_idx_pool[n]
-                node_hash = (
-                    idx_pool,
-                    *node_icoords[5 * n : 5 * n + 2],
-                    terrain_idx,
-                )
-                if node_hash in textured_nodes:
-                    (idx_dsfpool, pos_in_pool) = textured_nodes[node_hash]
+                rebuild = False
+                if (not os.path.isfile(target_tex)):
+                    rebuild = True
+                elif (tile.imprint_masks_to_dds):
+                    # Maybe target_tex was a DXT1, we need DXT5
+                    if (os.path.getsize(target_tex) < 20000000):
+                        rebuild = True
+                    # Maybe masks were updated after target_tex was created
+                    target_mask = MASK.mask_name_for_texture(tile,
+                                      *texture_attributes)
+                    # the mask may be stored as PNG or tiled
+                    target_mask = (target_mask and
+                                   MASK.mask_stamp(target_mask)[0])
+                    if (target_mask):
+                        mask_last_modified = os.path.getmtime(target_mask)
+                        tex_last_modified = os.path.getmtime(target_tex)
+                        if (tex_last_modified < mask_last_modified):
+                            rebuild = True
                 else:
-                    (s, t) = GEO.st_coord(
-                        node_coords[5 * n + 1],
-                        node_coords[5 * n],
-                        *texture_attributes
+                    # maybe target_tex was a DXT5, it should ne a DXT1
+                    if (os.path.getsize(target_tex) > 20000000):
+                        rebuild = True
+                    else:
+                        print(os.path.getsize(target_tex))
+
+                if (rebuild or not tile.imprint_masks_to_dds):
+                    mask_im.save(os.path.join(
+                        tile.build_dir,
+                        "textures",
+                        FNAMES.mask_file(*texture_attributes),
                     )
-                    # BEWARE : normal coordinates are pointing (EAST,SOUTH)
-                    # in X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
-                    if is_overlay: 
-                        idx_dsfpool = idx_pool + pool_nbr
-                        # border_tex masks with original normal
-                        dsf_pools[idx_dsfpool].extend(
-                            node_icoords[5 * n : 5 * n + 5]
-                        )
-                        dsf_pools[idx_dsfpool].extend(
-                            (
-                                int(round(s * 65535)),
-                                int(round(t * 65535)),
-                                int(round(s * 65535)),
-                                int(round(t * 65535)),
-                            )
-                        )
-                    else:  # dtx5 dds with mask included
-                        idx_dsfpool = idx_pool + pool_nbr
-                        dsf_pools[idx_dsfpool].extend(
-                            node_icoords[5 * n : 5 * n + 5]
-                        )
-                        # TODO (improve fetch values)
-                        ratio_bathy = BATHY.set_depth_ratio(n, node_is_coast,
-                                                            node_bathy, tile)
-                        ratio_fetch = 1
-                        dsf_pools[idx_dsfpool].extend(
-                            (int(65535 * ratio_fetch), int(65535 * ratio_bathy), 
-                             int(round(s * 65535)), int(round(t * 65535)))
-                        )
-                    len_textured_nodes += 1
-                    pos_in_pool = dsf_pool_length[idx_dsfpool]
-                    textured_nodes[node_hash] = (idx_dsfpool, pos_in_pool)
-                    dsf_pool_length[idx_dsfpool] += 1
-                tri_p.extend((idx_dsfpool, pos_in_pool))
-            # some triangles could be reduced to nothing by the pool snapping,
-            # we skip thme (possible killer to X-Plane's drapping of roads ?)
-            if (
-                tri_p[:2] == tri_p[2:4]
-                or tri_p[2:4] == tri_p[4:]
-                or tri_p[4:] == tri_p[:2]
-            ):
-                continue
-            if tri_p[0] == tri_p[2] == tri_p[4]:
-                textured_tris[terrain_idx][tri_p[0]].extend(
-                    (tri_p[1], tri_p[3], tri_p[5])
                 )
-            else:
-                total_cross_pool += 1
-                textured_tris[terrain_idx]["cross-pool"].extend(tri_p)
-        # X-Plane water
-        if (not terrain_idx) or is_overlay: 
-            tri_p = array.array("H")
-            for n in (n1, n3, n2):  # beware of ordering for orientation !
-                node_hash = (n, 0)
-                if node_hash in textured_nodes:
-                    (idx_dsfpool, pos_in_pool) = textured_nodes[node_hash]
+
+                if (rebuild):
+                        download_queue.put(texture_attributes)
                 else:
-                    idx_dsfpool = idx_node_to_idx_pool[n] + 2 * pool_nbr
-                    len_textured_nodes += 1
-                    pos_in_pool = dsf_pool_length[idx_dsfpool]
-                    textured_nodes[node_hash] = [idx_dsfpool, pos_in_pool]
-                    # in some cases we might prefer to use normal shading for
-                    # some sea triangles too (albedo continuity with elevation
-                    # derived masks)
-                    # dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+5])
-                    dsf_pools[idx_dsfpool].extend(
-                        node_icoords[5 * n : 5 * n + 3]
+                    UI.vprint(
+                        2,
+                        "   Texture file "
+                        + texture_file_name
+                        + " already present.",
                     )
-                    dsf_pools[idx_dsfpool].extend((32768, 32768))
-                    ratio_bathy = BATHY.set_depth_ratio(n, node_is_coast,
-                                                        node_bathy, tile)
-                    # TODO improve bathy and fetch ratio variety
-                    ratio_fetch = 1
-                    dsf_pools[idx_dsfpool].extend((int(65535 * ratio_fetch),
-                                                   int(65535 * ratio_bathy))) 
-                    dsf_pool_length[idx_dsfpool] += 1
-                tri_p.extend((idx_dsfpool, pos_in_pool))
-            if tri_p[0] == tri_p[2] == tri_p[4]:
-                textured_tris[0][tri_p[0]].extend(
-                    (tri_p[1], tri_p[3], tri_p[5])
-                )
-            else:
-                total_cross_pool += 1
-                textured_tris[0]["cross-pool"].extend(tri_p)
-
-    # Second land and inland water tris with no mask
-    for tri in range(nbr_tris):
-        tri_type = tri_types[tri]
-        if (tri_type == 2):
-            continue
-        (n1, n2, n3) = tri_idx[3 * tri: 3 * tri + 3]
-        
-        if done % step == 0:
-            UI.progress_bar(1, int(done / step * 0.9))
-            if UI.red_flag:
-                UI.vprint(1, "DSF construction interrupted.")
-                return 0
-        done += 1
-        bary_lon = (
-            node_coords[5 * n1] + node_coords[5 * n2] + node_coords[5 * n3]
-        ) / 3
-        bary_lat = (
-            node_coords[5 * n1 + 1]
-            + node_coords[5 * n2 + 1]
-            + node_coords[5 * n3 + 1]
-        ) / 3
-        texture_attributes = dico_customzl[
-            GEO.wgs84_to_orthogrid(bary_lat, bary_lon, tile.mesh_zl)
-        ]
-        # The entries for the terrain and texture main dictionnaries
-        terrain_attributes = (texture_attributes, tri_type)
-        is_overlay = False
-
-        # Do we need to build new terrain file(s) ?
-        if terrain_attributes in dico_terrains:
-            terrain_idx = dico_terrains[terrain_attributes]
-            is_overlay = terrain_idx in overlay_terrains
+                treated_textures.add(texture_attributes)
         else:
-            terrain_idx = len(dico_terrains)
-            textured_tris[terrain_idx] = defaultdict(lambda: array.array("H"))
-            dico_terrains[terrain_attributes] = terrain_idx
             is_overlay = tri_type == 1
-            if is_overlay:
-                overlay_terrains.add(terrain_idx)
-            texture_file_name = FNAMES.dds_file_name_from_attributes(
-                *texture_attributes
-            )
             # do we need to download a new texture ?
             if texture_attributes not in treated_textures:
                 target_tex = os.path.join(
                             tile.build_dir, "textures", texture_file_name
                             )
-                rebuild = False
                 if (not os.path.isfile(target_tex)):
-                    rebuild = True
-                if (rebuild):
                     download_queue.put(texture_attributes)
                 else:
                     UI.vprint(
@@ -936,114 +973,242 @@ def build_dsf(tile, download_queue):
                         + " already present.",
                     )
                 treated_textures.add(texture_attributes)
-            terrain_file_name = create_terrain_file(
-                tile,
-                texture_file_name,
-                *texture_attributes,
-                tri_type,
-                is_overlay
+        terrain_idx = len(dico_terrains)
+        dico_terrains[(texture_attributes, tri_type)] = terrain_idx
+        key_terrain[key] = terrain_idx
+        if is_overlay:
+            overlay_terrains.add(terrain_idx)
+        terrain_file_name = create_terrain_file(
+            tile,
+            texture_file_name,
+            *texture_attributes,
+            tri_type,
+            is_overlay
+        )
+        bTERT += bytes("terrain/" + terrain_file_name + "\0", "ascii")
+    terrain_lut = numpy.zeros(4 * len(textures), dtype=numpy.int64)
+    terrain_lut[list(key_terrain)] = list(key_terrain.values())
+    proc_terrains = terrain_lut[4 * proc_textures + proc_types]
+    overlay_lut = numpy.zeros(len(dico_terrains), dtype=bool)
+    overlay_lut[list(overlay_terrains)] = True
+    proc_overlay = overlay_lut[proc_terrains]
+
+    # 8 Textured nodes and tris
+    TRACE.phase("8 textured nodes and tris")
+    UI.progress_bar(1, 60)
+    if UI.red_flag:
+        UI.vprint(1, "DSF construction interrupted.")
+        return 0
+    # Triangles are cut in pieces, each sent to a terrain: the textured
+    # piece (all but the unmasked sea tris) and the X-Plane water piece
+    # (sea tris which are unmasked or masked by an overlay, and inland
+    # water overlays). Nodes of the pieces are identified by a key, in
+    # increasing order of kind:
+    node_kinds = (
+        "land",  # land with ortho
+        "inland water",  # constant alpha overlay with flat shading
+        "masked overlay",  # border_tex masks with original normal
+        "masked water",  # dtx5 dds with mask included
+        "water",  # X-Plane water
+    )
+    textured = proc_terrains != 0
+    node_pools = numpy.asarray(idx_node_to_idx_pool, dtype=numpy.int64)
+    proc_pools = node_pools[proc_nodes]
+    # textured nodes are shared by pool, pool coordinates and terrain
+    tex_keys = (
+        (proc_terrains[:, None] << 47)
+        | (proc_pools << 32)
+        | (node_icoords[proc_nodes, 0].astype(numpy.int64) << 16)
+        | node_icoords[proc_nodes, 1]
+    )
+    # some triangles could be reduced to nothing by the pool snapping,
+    # we skip them (possible killer to X-Plane's drapping of roads ?)
+    degenerate = (
+        (tex_keys[:, 0] == tex_keys[:, 1])
+        | (tex_keys[:, 1] == tex_keys[:, 2])
+        | (tex_keys[:, 2] == tex_keys[:, 0])
+    )
+    tex_kinds = numpy.where(
+        proc_types == 2,
+        numpy.where(proc_overlay, 2, 3),
+        proc_types,
+    )
+    has_water = ~textured | (proc_overlay & ~degenerate)
+    # all pieces, in processing order
+    piece_rank = numpy.concatenate(
+        (2 * numpy.flatnonzero(textured), 2 * numpy.flatnonzero(has_water) + 1)
+    )
+    piece_order = numpy.argsort(piece_rank)
+    piece_nodes = numpy.concatenate(
+        (proc_nodes[textured], proc_nodes[has_water])
+    )[piece_order]
+    piece_keys = numpy.concatenate(
+        # water nodes are shared by node index
+        (tex_keys[textured], -1 - proc_nodes[has_water])
+    )[piece_order]
+    piece_kinds = numpy.concatenate(
+        (tex_kinds[textured], numpy.full(has_water.sum(), 4))
+    )[piece_order]
+    piece_terrains = numpy.concatenate(
+        (proc_terrains[textured], numpy.zeros(has_water.sum(), numpy.int64))
+    )[piece_order]
+    piece_skipped = numpy.concatenate(
+        (degenerate[textured], numpy.zeros(has_water.sum(), bool))
+    )[piece_order]
+    piece_textures = numpy.concatenate(
+        (proc_textures[textured], numpy.zeros(has_water.sum(), numpy.int64))
+    )[piece_order]
+    event_keys = piece_keys.ravel()
+    event_nodes = piece_nodes.ravel()
+    event_kinds = piece_kinds.repeat(3)
+    event_textures = piece_textures.repeat(3)
+    tex_attributes = numpy.array(
+        [texture_attributes[:3] for texture_attributes in textures],
+        dtype=numpy.int64,
+    ).reshape(-1, 3)
+    # TODO (improve fetch values)
+    ratio_fetch = 1
+
+    def number_pool_nodes(events):
+        """
+        Distinct nodes of the events (node uses, in processing order),
+        numbered by first use. Returns their DSF pool and position per
+        event, and the planes of these DSF pools.
+        """
+        (_, first_use, node_ids) = numpy.unique(
+            event_keys[events], return_index=True, return_inverse=True
+        )
+        rank = numpy.argsort(first_use)
+        first_use = events[first_use[rank]]
+        renumber = numpy.empty(len(rank), dtype=numpy.int64)
+        renumber[rank] = numpy.arange(len(rank))
+        node_ids = renumber[node_ids.ravel()]
+        nodes = event_nodes[first_use]
+        kinds = event_kinds[first_use]
+        pools = node_pools[nodes] + numpy.array([0, 1, 1, 1, 2])[kinds] * (
+            pool_nbr
+        )
+        # position in pool by first use
+        by_pool = numpy.argsort(pools, kind="stable")
+        (pool_ids, pool_starts, pool_lengths) = numpy.unique(
+            pools[by_pool], return_index=True, return_counts=True
+        )
+        positions = numpy.empty(len(nodes), dtype=numpy.int64)
+        positions[by_pool] = numpy.arange(len(nodes)) - numpy.repeat(
+            pool_starts, pool_lengths
+        )
+        # pool planes of the nodes
+        planes = numpy.zeros((len(nodes), 9), dtype=numpy.uint16)
+        planes[:, :5] = node_icoords[nodes]
+        # BEWARE : normal coordinates are pointing (EAST,SOUTH) in
+        # X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
+        (s, t) = GEO.st_coord_array(
+            lat[nodes],
+            lon[nodes],
+            *tex_attributes[event_textures[first_use]].T
+        )
+        s = numpy.round(s * 65535)
+        t = numpy.round(t * 65535)
+        ratio_bathy = numpy.where(
+            node_is_coast[nodes],
+            0,
+            numpy.maximum(
+                numpy.minimum(
+                    10 * tile.ratio_bathy * node_bathy[nodes] / 255, 1
+                ),
+                0.1,
+            ),
+        )
+        ratio_bathy = numpy.floor(65535 * ratio_bathy)
+        kind = kinds == node_kinds.index("land")
+        planes[kind, 5] = s[kind]
+        planes[kind, 6] = t[kind]
+        kind = kinds == node_kinds.index("inland water")
+        planes[kind, 3:9] = numpy.column_stack(
+            (
+                numpy.full((kind.sum(), 2), 32768),
+                s[kind],
+                t[kind],
+                numpy.zeros(kind.sum()),
+                numpy.full(kind.sum(), round(tile.ratio_water * 65535)),
             )
-            bTERT += bytes("terrain/" + terrain_file_name + "\0", "ascii")
-        # We put the tri in the right terrain
-        # First the ones associated to the dico_customzl
-        tri_p = array.array("H")
-        for n in (n1, n3, n2):  # beware of ordering for orientation !
-            idx_pool = idx_node_to_idx_pool[n]
-            node_hash = (
-                idx_pool,
-                *node_icoords[5 * n : 5 * n + 2],
-                terrain_idx,
+        )
+        kind = kinds == node_kinds.index("masked overlay")
+        planes[kind, 5:9] = numpy.column_stack((s[kind], t[kind]) * 2)
+        kind = kinds == node_kinds.index("masked water")
+        planes[kind, 5:9] = numpy.column_stack(
+            (
+                numpy.full(kind.sum(), int(65535 * ratio_fetch)),
+                ratio_bathy[kind],
+                s[kind],
+                t[kind],
             )
-            if node_hash in textured_nodes:
-                (idx_dsfpool, pos_in_pool) = textured_nodes[node_hash]
-            else:
-                (s, t) = GEO.st_coord(
-                    node_coords[5 * n + 1],
-                    node_coords[5 * n],
-                    *texture_attributes
-                )
-                # BEWARE : normal coordinates are pointing (EAST,SOUTH) in 
-                # X-Plane, not (EAST,NORTH) ! (cfr DSF specs), so v -> -v
-                if not tri_type:  # land
-                    idx_dsfpool = idx_pool
-                    dsf_pools[idx_dsfpool].extend(
-                        node_icoords[5 * n : 5 * n + 5]
-                    )
-                    dsf_pools[idx_dsfpool].extend(
-                        (int(round(s * 65535)), int(round(t * 65535)))
-                    )
-                else:  # inland water
-                    idx_dsfpool = idx_pool + pool_nbr
-                    # constant alpha overlay with flat shading
-                    dsf_pools[idx_dsfpool].extend(
-                        node_icoords[5 * n : 5 * n + 3]
-                    )
-                    dsf_pools[idx_dsfpool].extend(
-                        (
-                            32768,
-                            32768,
-                            int(round(s * 65535)),
-                            int(round(t * 65535)),
-                            0,
-                            int(round(tile.ratio_water * 65535)),
-                        )
-                    )
-                len_textured_nodes += 1
-                pos_in_pool = dsf_pool_length[idx_dsfpool]
-                textured_nodes[node_hash] = (idx_dsfpool, pos_in_pool)
-                dsf_pool_length[idx_dsfpool] += 1
-            tri_p.extend((idx_dsfpool, pos_in_pool))
-        # some triangles could be reduced to nothing by the pool snapping,
-        # we skip them (possible killer to X-Plane's drapping of roads ?)
-        if (
-            tri_p[:2] == tri_p[2:4]
-            or tri_p[2:4] == tri_p[4:]
-            or tri_p[4:] == tri_p[:2]
-        ):
-            continue
-        if tri_p[0] == tri_p[2] == tri_p[4]:
-            textured_tris[terrain_idx][tri_p[0]].extend(
-                (tri_p[1], tri_p[3], tri_p[5])
+        )
+        kind = kinds == node_kinds.index("water")
+        planes[kind, 3:7] = numpy.column_stack(
+            (
+                numpy.full((kind.sum(), 2), 32768),
+                numpy.full(kind.sum(), int(65535 * ratio_fetch)),
+                ratio_bathy[kind],
+            )
+        )
+        pool_planes = {
+            k: planes[by_pool[start : start + length], : dsf_pool_plane[k]]
+            for (k, start, length) in zip(
+                pool_ids.tolist(), pool_starts.tolist(), pool_lengths.tolist()
+            )
+        }
+        return (pools[node_ids], positions[node_ids], pool_planes)
+
+    (event_pools, event_positions, pool_planes) = number_pool_nodes(
+        numpy.arange(len(event_keys))
+    )
+    dsf_pools = {k: array.array("H") for k in range(dsf_pool_nbr)}
+    dsf_pool_length = numpy.zeros(dsf_pool_nbr, "int")
+    for (k, planes) in pool_planes.items():
+        dsf_pools[k].frombytes(planes.tobytes())
+        dsf_pool_length[k] = len(planes)
+    len_textured_nodes = int(dsf_pool_length.sum())
+    UI.progress_bar(1, 80)
+    # triangles of each terrain, grouped by pool (by first use) unless
+    # their nodes are in distinct pools
+    kept = ~piece_skipped
+    tri_pools = event_pools.reshape(-1, 3)[kept]
+    tri_positions = event_positions.reshape(-1, 3)[kept]
+    tri_terrains = piece_terrains[kept]
+    cross_pool = (tri_pools[:, 0] != tri_pools[:, 1]) | (
+        tri_pools[:, 1] != tri_pools[:, 2]
+    )
+    total_cross_pool = int(cross_pool.sum())
+    groups = tri_terrains * (dsf_pool_nbr + 1) + numpy.where(
+        cross_pool, dsf_pool_nbr, tri_pools[:, 0]
+    )
+    (group_keys, first_use, group_counts) = numpy.unique(
+        groups, return_index=True, return_counts=True
+    )
+    group_starts = numpy.cumsum(group_counts) - group_counts
+    by_group = numpy.argsort(groups, kind="stable")
+    textured_tris = {
+        terrain_idx: {} for terrain_idx in range(len(dico_terrains))
+    }
+    for g in numpy.argsort(first_use).tolist():
+        (terrain_idx, idx_dsfpool) = divmod(
+            int(group_keys[g]), dsf_pool_nbr + 1
+        )
+        group = by_group[group_starts[g] : group_starts[g] + group_counts[g]]
+        if idx_dsfpool == dsf_pool_nbr:
+            textured_tris[terrain_idx]["cross-pool"] = array.array(
+                "H",
+                numpy.dstack(
+                    (tri_pools[group], tri_positions[group])
+                ).ravel().tolist(),
             )
         else:
-            total_cross_pool += 1
-            textured_tris[terrain_idx]["cross-pool"].extend(tri_p)
-        
-        # XP water
-        if is_overlay: 
-            tri_p = array.array("H")
-            for n in (n1, n3, n2):  # beware of ordering for orientation !
-                node_hash = (n, 0)
-                if node_hash in textured_nodes:
-                    (idx_dsfpool, pos_in_pool) = textured_nodes[node_hash]
-                else:
-                    idx_dsfpool = idx_node_to_idx_pool[n] + 2 * pool_nbr
-                    len_textured_nodes += 1
-                    pos_in_pool = dsf_pool_length[idx_dsfpool]
-                    textured_nodes[node_hash] = [idx_dsfpool, pos_in_pool]
-                    # in some cases we might prefer to use normal shading for
-                    # some sea triangles too (albedo continuity with elevation
-                    # derived masks)
-                    # dsf_pools[idx_dsfpool].extend(node_icoords[5*n:5*n+5])
-                    dsf_pools[idx_dsfpool].extend(
-                        node_icoords[5 * n : 5 * n + 3]
-                    )
-                    dsf_pools[idx_dsfpool].extend((32768, 32768))
-                    ratio_bathy = BATHY.set_depth_ratio(n, node_is_coast,
-                                                        node_bathy, tile)
-                    ratio_fetch = 1
-                    dsf_pools[idx_dsfpool].extend((int(65535 * ratio_fetch),
-                                                   int(65535 * ratio_bathy))) 
-                    dsf_pool_length[idx_dsfpool] += 1
-                tri_p.extend((idx_dsfpool, pos_in_pool))
-            if tri_p[0] == tri_p[2] == tri_p[4]:
-                textured_tris[0][tri_p[0]].extend(
-                    (tri_p[1], tri_p[3], tri_p[5])
-                )
-            else:
-                total_cross_pool += 1
-                textured_tris[0]["cross-pool"].extend(tri_p)
-    
+            textured_tris[terrain_idx][idx_dsfpool] = array.array(
+                "H", tri_positions[group].ravel().tolist()
+            )
+    UI.progress_bar(1, 90)
+
     download_queue.put("quit")
 
     UI.vprint(1, "-> Encoding of the DSF file")
@@ -1084,273 +1249,88 @@ def build_dsf(tile, download_queue):
         bPROP += b"sim/creation_agent\0Patched by Ortho4XP\0"
 
     # Transfer DEM and bathymetry raster from Global Scenery tiles
+    TRACE.phase("9 Global Scenery rasters")
     (bDEMN, bDEMS) = extract_elevation_and_bathymetry_data(tile.lat, tile.lon)
 
     # Computation of intermediate and of total length
+    TRACE.phase("10 encoding")
+    # Since we possibly skipped some pools, and since we possibly
+    # get pools from elsewhere, we rebuild a dico
+    # which tells the pool position in the dsf of a pool prior
+    # to the stripping :
+    used_pools = numpy.flatnonzero(dsf_pool_length)
+    new_dsf_pool = numpy.zeros(dsf_pool_nbr, dtype=numpy.int64)
+    new_dsf_pool[used_pools] = nbr_dsfpools_yet_in + numpy.arange(
+        len(used_pools)
+    )
+    (bPOOL, bSCAL) = encode_pool_atoms(
+        dsf_pools, dsf_pool_length, dsf_pool_plane, pool_param, pool_nbr
+    )
+    bCMDS += encode_terrain_commands(
+        textured_tris, overlay_terrains, new_dsf_pool, tile.overlay_lod
+    )
     size_of_head_atom = 16 + len(bPROP)
     size_of_prop_atom = 8 + len(bPROP)
     size_of_defn_atom = (
         48 + len(bTERT) + len(bOBJT) + len(bPOLY) + len(bNETW) + len(bDEMN)
     )
-    size_of_geod_atom = 8 + len(bGEOD)
-    size_of_dems_atom = 8 + len(bDEMS)
-    for k in range(dsf_pool_nbr):
-        if dsf_pool_length[k] > 0:
-            size_of_geod_atom += 21 + dsf_pool_plane[k] * (
-                9 + 2 * dsf_pool_length[k]
-            )
+    size_of_geod_atom = 8 + len(bGEOD) + len(bPOOL) + len(bSCAL)
+    size_of_dems_atom = 8 + len(bDEMS) if bDEMS != b"" else 0
+    size_of_cmds_atom = 8 + len(bCMDS)
     UI.vprint(
         2, "     Size of DEFN atom : " + str(size_of_defn_atom) + " bytes."
     )
     UI.vprint(
         2, "     Size of GEOD atom : " + str(size_of_geod_atom) + " bytes."
     )
-    f = open(dsf_file_name + ".tmp", "wb")
-    f.write(b"XPLNEDSF")
-    f.write(struct.pack("<I", 1))
-
-    # Head super-atom
-    f.write(b"DAEH")
-    f.write(struct.pack("<I", size_of_head_atom))
-    f.write(b"PORP")
-    f.write(struct.pack("<I", size_of_prop_atom))
-    f.write(bPROP)
-
-    # Definitions super-atom
-    f.write(b"NFED")
-    f.write(struct.pack("<I", size_of_defn_atom))
-    f.write(b"TRET")
-    f.write(struct.pack("<I", 8 + len(bTERT)))
-    f.write(bTERT)
-    f.write(b"TJBO")
-    f.write(struct.pack("<I", 8 + len(bOBJT)))
-    f.write(bOBJT)
-    f.write(b"YLOP")
-    f.write(struct.pack("<I", 8 + len(bPOLY)))
-    f.write(bPOLY)
-    f.write(b"WTEN")
-    f.write(struct.pack("<I", 8 + len(bNETW)))
-    f.write(bNETW)
-    f.write(b"NMED")
-    f.write(struct.pack("<I", 8 + len(bDEMN)))
-    f.write(bDEMN)
-
-    # Geodata super-atom
-    f.write(b"DOEG")
-    f.write(struct.pack("<I", size_of_geod_atom))
-    f.write(bGEOD)
-    for k in range(dsf_pool_nbr):
-        if dsf_pool_length[k] == 0:
-            continue
-        f.write(b"LOOP")
-        f.write(
-            struct.pack(
-                "<I",
-                13
-                + dsf_pool_plane[k]
-                + 2 * dsf_pool_plane[k] * dsf_pool_length[k],
-            )
-        )
-        f.write(struct.pack("<I", dsf_pool_length[k]))
-        f.write(struct.pack("<B", dsf_pool_plane[k]))
-        for l in range(dsf_pool_plane[k]):
-            f.write(struct.pack("<B", 0))
-            for m in range(dsf_pool_length[k]):
-                f.write(
-                    struct.pack("<H", dsf_pools[k][dsf_pool_plane[k] * m + l])
-                )
-    for k in range(dsf_pool_nbr):
-        if dsf_pool_length[k] == 0:
-            continue
-        f.write(b"LACS")
-        f.write(struct.pack("<I", 8 + 8 * dsf_pool_plane[k]))
-        for l in range(2 * dsf_pool_plane[k]):
-            f.write(struct.pack("<f", pool_param[k % pool_nbr][l]))
-
+    UI.vprint(
+        2, "     Size of CMDS atom : " + str(size_of_cmds_atom) + " bytes."
+    )
     UI.progress_bar(1, 95)
     if UI.red_flag:
         UI.vprint(1, "DSF construction interrupted.")
         return 0
 
-    # Since we possibly skipped some pools, and since we possibly
-    # get pools from elsewhere, we rebuild a dico
-    # which tells the pool position in the dsf of a pool prior
-    # to the stripping :
+    # The md5 checksum of the DSF is computed along
+    md5 = hashlib.md5()
+    f = open(dsf_file_name + ".tmp", "wb")
 
-    dico_new_dsf_pool = {}
-    new_idx_dsfpool = nbr_dsfpools_yet_in
-    for k in range(dsf_pool_nbr):
-        if dsf_pool_length[k] != 0:
-            dico_new_dsf_pool[k] = new_idx_dsfpool
-            new_idx_dsfpool += 1
+    def write(*chunks):
+        for chunk in chunks:
+            f.write(chunk)
+            md5.update(chunk)
 
+    write(b"XPLNEDSF", struct.pack("<I", 1))
+    # Head super-atom
+    write(b"DAEH", struct.pack("<I", size_of_head_atom))
+    write(b"PORP", struct.pack("<I", size_of_prop_atom), bPROP)
+    # Definitions super-atom
+    write(b"NFED", struct.pack("<I", size_of_defn_atom))
+    write(b"TRET", struct.pack("<I", 8 + len(bTERT)), bTERT)
+    write(b"TJBO", struct.pack("<I", 8 + len(bOBJT)), bOBJT)
+    write(b"YLOP", struct.pack("<I", 8 + len(bPOLY)), bPOLY)
+    write(b"WTEN", struct.pack("<I", 8 + len(bNETW)), bNETW)
+    write(b"NMED", struct.pack("<I", 8 + len(bDEMN)), bDEMN)
+    # Geodata super-atom
+    write(b"DOEG", struct.pack("<I", size_of_geod_atom), bGEOD, bPOOL, bSCAL)
     # Commands atom
-    # we first compute its size :
-    size_of_cmds_atom = 8 + len(bCMDS)
-    for terrain_idx in textured_tris:
-        if len(textured_tris[terrain_idx]) == 0:
-            continue
-        size_of_cmds_atom += 3
-        for idx_dsfpool in textured_tris[terrain_idx]:
-            if idx_dsfpool != "cross-pool":
-                size_of_cmds_atom += 13 + 2 * (
-                    len(textured_tris[terrain_idx][idx_dsfpool])
-                    + ceil(len(textured_tris[terrain_idx][idx_dsfpool]) / 255)
-                )
-            else:
-                size_of_cmds_atom += 13 + 2 * (
-                    len(textured_tris[terrain_idx][idx_dsfpool])
-                    + ceil(len(textured_tris[terrain_idx][idx_dsfpool]) / 510)
-                )
-    UI.vprint(
-        2, "     Size of CMDS atom : " + str(size_of_cmds_atom) + " bytes."
-    )
-    f.write(b"SDMC")  # CMDS header
-    f.write(struct.pack("<I", size_of_cmds_atom))  # CMDS length
-    f.write(bCMDS)
-    for terrain_idx in textured_tris:
-        if len(textured_tris[terrain_idx]) == 0:
-            continue
-        # print("terrain_idx = "+str(terrain_idx))
-        f.write(struct.pack("<B", 4))  # SET DEFINITION 16
-        f.write(struct.pack("<H", terrain_idx))  # TERRAIN INDEX
-        flag = (
-            1 if terrain_idx not in overlay_terrains else 2
-        )  # physical or overlay
-        lod = -1 if flag == 1 else tile.overlay_lod
-        for idx_dsfpool in textured_tris[terrain_idx]:
-            if idx_dsfpool != "cross-pool":
-                f.write(struct.pack("<B", 1))  # POOL SELECT
-                f.write(
-                    struct.pack("<H", dico_new_dsf_pool[idx_dsfpool])
-                )  # POOL INDEX
-
-                f.write(struct.pack("<B", 18))  # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack("<B", flag))  # FLAG
-                f.write(struct.pack("<f", 0))  # NEAR LOD
-                f.write(struct.pack("<f", lod))  # FAR LOD
-
-                blocks = floor(
-                    len(textured_tris[terrain_idx][idx_dsfpool]) / 255
-                )
-                for j in range(blocks):
-                    f.write(struct.pack("<B", 23))  # PATCH TRIANGLE
-                    f.write(struct.pack("<B", 255))  # COORDINATE COUNT
-
-                    for k in range(255):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    255 * j + k
-                                ],
-                            )
-                        )  # COORDINATE IDX
-                remaining_tri_p = (
-                    len(textured_tris[terrain_idx][idx_dsfpool]) % 255
-                )
-                if remaining_tri_p != 0:
-                    f.write(struct.pack("<B", 23))  # PATCH TRIANGLE
-                    f.write(
-                        struct.pack("<B", remaining_tri_p)
-                    )  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    255 * blocks + k
-                                ],
-                            )
-                        )  # COORDINATE IDX
-            else:  # idx_dsfpool == 'cross-pool'
-                pool_idx_init = textured_tris[terrain_idx][idx_dsfpool][0]
-                f.write(struct.pack("<B", 1))  # POOL SELECT
-                f.write(
-                    struct.pack("<H", dico_new_dsf_pool[pool_idx_init])
-                )  # POOL INDEX
-                f.write(struct.pack("<B", 18))  # TERRAIN PATCH FLAGS AND LOD
-                f.write(struct.pack("<B", flag))  # FLAG
-                f.write(struct.pack("<f", 0))  # NEAR LOD
-                f.write(struct.pack("<f", lod))  # FAR LOD
-
-                blocks = floor(
-                    len(textured_tris[terrain_idx][idx_dsfpool]) / 510
-                )
-                for j in range(blocks):
-                    f.write(struct.pack("<B", 24))  # PATCH TRIANGLE CROSS-POOL
-                    f.write(struct.pack("<B", 255))  # COORDINATE COUNT
-                    for k in range(255):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                dico_new_dsf_pool[
-                                    textured_tris[terrain_idx][idx_dsfpool][
-                                        510 * j + 2 * k
-                                    ]
-                                ],
-                            )
-                        )  # POOL IDX
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    510 * j + 2 * k + 1
-                                ],
-                            )
-                        )  # POS_IN_POOL IDX
-                remaining_tri_p = int(
-                    (len(textured_tris[terrain_idx][idx_dsfpool]) % 510) / 2
-                )
-                if remaining_tri_p != 0:
-                    f.write(struct.pack("<B", 24))  # PATCH TRIANGLE CROSS-POOL
-                    f.write(
-                        struct.pack("<B", remaining_tri_p)
-                    )  # COORDINATE COUNT
-                    for k in range(remaining_tri_p):
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                dico_new_dsf_pool[
-                                    textured_tris[terrain_idx][idx_dsfpool][
-                                        510 * blocks + 2 * k
-                                    ]
-                                ],
-                            )
-                        )  # POOL IDX
-                        f.write(
-                            struct.pack(
-                                "<H",
-                                textured_tris[terrain_idx][idx_dsfpool][
-                                    510 * blocks + 2 * k + 1
-                                ],
-                            )
-                        )  # POS_IN_PO0L IDX
-
+    write(b"SDMC", struct.pack("<I", size_of_cmds_atom), bCMDS)
     # DEMS atom
     if bDEMS != b"":
-        f.write(b"SMED")
-        f.write(struct.pack("<I", 8 + len(bDEMS)))
-        f.write(bDEMS)
+        write(b"SMED", struct.pack("<I", size_of_dems_atom), bDEMS)
 
     UI.progress_bar(1, 98)
     if UI.red_flag:
+        f.close()
         UI.vprint(1, "DSF construction interrupted.")
         return 0
 
-    f.close()
-
-    f = open(dsf_file_name + ".tmp", "rb")
-    data = f.read()
-    m = hashlib.md5()
-    m.update(data)
-    md5sum = m.digest()
-    f.close()
-    f = open(dsf_file_name + ".tmp", "ab")
-    f.write(md5sum)
+    TRACE.phase("11 md5")
+    f.write(md5.digest())
     f.close()
     
     UI.progress_bar(1, 100)
+    TRACE.end_phase()
     
     size_of_dsf = (
         28
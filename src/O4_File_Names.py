@@ -31,6 +31,8 @@ Tile_dir = resource_path("Tiles")
 Tmp_dir = resource_path("tmp")
 Overlay_dir = resource_path("yOrtho4XP_Overlays")
 
+tiled_mask_ext = ".o4m"
+
 ##############################################################################
 def short_latlon(lat, lon):
     strlat = "{:+.0f}".format(lat).zfill(3)
@@ -204,6 +206,31 @@ def mesh_file(build_dir, lat, lon):
     return os.path.join(build_dir, "Data" + short_latlon(lat, lon) + ".mesh")
 
 
+def mesh_bin_file(mesh_file):
+    # binary companion of a .mesh file, see MESH.write_mesh_bin
+    return mesh_file + ".bin"
+
+
+def global_scenery_cache_file(lat, lon, source_key, stamp_key):
+    # DEMN/DEMS rasters extracted from a Global Scenery DSF, see
+    # DSF.extract_elevation_and_bathymetry_data
+    return os.path.join(
+        Tmp_dir,
+        "Global_Scenery_rasters",
+        short_latlon(lat, lon) + "_" + source_key + "_" + stamp_key + ".bin",
+    )
+
+
+def state_file(build_dir, lat, lon):
+    return os.path.join(build_dir, "Data" + short_latlon(lat, lon) + ".state")
+
+
+def trace_file(build_dir, lat, lon, extension):
+    return os.path.join(
+        build_dir, "Trace" + short_latlon(lat, lon) + "." + extension
+    )
+
+
 def dsf_file(build_dir, lat, lon):
     return os.path.join(
         build_dir, "Earth nav data", long_latlon(lat, lon) + ".dsf"
@@ -348,6 +375,12 @@ def legacy_mask(m_til_x_left, m_til_y_top):
 def distance_mask(m_til_x_left, m_til_y_top):
     return str(m_til_y_top) + "_" + str(m_til_x_left) + "_dist.png"
 
+def tiled_mask(mask_file):
+    return os.path.splitext(mask_file)[0] + tiled_mask_ext
+
+def masks_state_file(dest_dir):
+    return os.path.join(dest_dir, "masks.state")
+
 
 def mask_file(til_x_left, til_y_top, zoomlevel, provider_code):
     return (
@@ -0,0 +1,147 @@
+"""Separable filters over whole 2D arrays.
+
+The hat function of half width w (weights (w - |d|) / w**2 for |d| < w) is
+the convolution of two boxes of width w, each computed as the difference
+of a running sum: the cost of a filter does not depend on its width.
+The Euclidean distance transform lets profiles of any width be applied as
+a function of the distance to a set of pixels.
+"""
+
+import numpy
+
+filter_chunk_lines = 32
+
+
+################################################################################
+def _lines(array, axis, start, stop):
+    index = [slice(None)] * array.ndim
+    index[axis] = slice(start, stop)
+    return array[tuple(index)]
+
+
+################################################################################
+def box_sums(array, width, axis, before, after):
+    """
+    Sums of width consecutive values along axis of the array padded with
+    before zeros at its start and after zeros at its end, the i-th one
+    starting at index i of the padded array.
+    """
+    pad = [(0, 0)] * array.ndim
+    pad[axis] = (before + 1, after)
+    sums = numpy.cumsum(numpy.pad(array, pad), axis=axis, dtype=numpy.float64)
+    length = sums.shape[axis] - width
+    return _lines(sums, axis, width, None) - _lines(sums, axis, 0, length)
+
+
+################################################################################
+def hat_filter_1d(array, width, axis):
+    """
+    Convolution along axis with the hat function of half width `width`,
+    zero padded and centered, so that the output has the shape of the input
+    (same as numpy.convolve in "same" mode, in float64).
+    """
+    boxes = box_sums(array, width, axis, width - 1, width - 1)
+    return box_sums(boxes, width, axis, 0, 0) / width ** 2
+
+
+################################################################################
+def hat_filter(array, width, dtype=None):
+    """
+    Convolution of a 2D array with the hat function of half width `width`
+    along its rows and then its columns (see hat_filter_1d). The result of
+    each pass is stored with dtype (default float64), chunk by chunk, so that
+    integer types are truncated in between as an assignment would do.
+    """
+    if width <= 1:
+        return numpy.array(array, dtype=dtype or numpy.float64)
+    rows = numpy.empty(array.shape, dtype=dtype or numpy.float64)
+    for start in range(0, array.shape[0], filter_chunk_lines):
+        stop = start + filter_chunk_lines
+        rows[start:stop] = hat_filter_1d(array[start:stop], width, 1)
+    result = numpy.empty_like(rows)
+    for start in range(0, array.shape[1], filter_chunk_lines):
+        stop = start + filter_chunk_lines
+        result[:, start:stop] = hat_filter_1d(rows[:, start:stop], width, 0)
+    return result
+
+
+################################################################################
+def distance_transform(features):
+    """
+    Euclidean distance (in pixels, float32) of each pixel of a 2D boolean
+    array to the closest True one, inf if there is none. It is exact, by the
+    separable algorithm of Felzenszwalb and Huttenlocher: distances along the
+    rows first, then lower envelopes of parabolas along the columns, all
+    columns being processed together row after row. The top of the stack of
+    parabolas of each column is kept apart, so that only the columns whose
+    envelope changes read their stack.
+    """
+    (height, width) = features.shape
+    if not features.any():
+        return numpy.full(features.shape, numpy.inf, dtype=numpy.float32)
+    # distances along the rows, capped at far_away for rows without feature
+    far_away = 2 * (height + width)
+    x = numpy.arange(width, dtype=numpy.int32)
+    before = numpy.maximum.accumulate(
+        numpy.where(features, x, numpy.int32(-far_away)), axis=1
+    )
+    after = numpy.minimum.accumulate(
+        numpy.where(features[:, ::-1], x[::-1], numpy.int32(far_away)), axis=1
+    )[:, ::-1]
+    row_dist = numpy.minimum(
+        numpy.minimum(x - before, after - x), far_away
+    ).astype(numpy.int32 if far_away > 32767 else numpy.int16)
+    del before, after
+    cols = numpy.arange(width)
+
+    def parabola_heights(rows, columns):
+        # f(row) + row ** 2 of the parabolas of these rows in these columns
+        return row_dist[rows, columns].astype(numpy.float64) ** 2 + rows * rows
+
+    # stacks of the rows (v) and starts (z) of the parabolas of the lower
+    # envelope of each column, stored column after column
+    stride = height + 1
+    v = numpy.empty(stride * width, dtype=numpy.int32)
+    z = numpy.empty(stride * width)
+    top = cols * stride
+    v[top] = 0
+    z[top] = -numpy.inf
+    v_top = numpy.zeros(width, dtype=numpy.int64)
+    h_top = parabola_heights(v_top, cols)
+    z_top = numpy.full(width, -numpy.inf)
+    for q in range(1, height):
+        h_q = parabola_heights(q, cols)
+        s = (h_q - h_top) / (2 * (q - v_top))
+        popped = numpy.flatnonzero(s <= z_top)
+        while len(popped):
+            top[popped] -= 1
+            v_p = v[top[popped]].astype(numpy.int64)
+            h_p = parabola_heights(v_p, popped)
+            z_p = z[top[popped]]
+            s_p = (h_q[popped] - h_p) / (2 * (q - v_p))
+            (v_top[popped], h_top[popped], s[popped]) = (v_p, h_p, s_p)
+            popped = popped[s_p <= z_p]
+        top += 1
+        v[top] = q
+        z[top] = s
+        v_top[:] = q
+        (h_top, z_top) = (h_q, s)
+    z[top + 1] = numpy.inf
+    # walk up the envelopes
+    distances = numpy.empty((height, width), dtype=numpy.float32)
+    current = cols * stride
+    v_cur = v[current].astype(numpy.int64)
+    z_next = z[current + 1]
+    for q in range(height):
+        moved = numpy.flatnonzero(z_next < q)
+        while len(moved):
+            current[moved] += 1
+            v_cur[moved] = v[current[moved]]
+            z_m = z[current[moved] + 1]
+            z_next[moved] = z_m
+            moved = moved[z_m < q]
+        distances[q] = numpy.sqrt(
+            parabola_heights(v_cur, cols) - 2 * q * v_cur + q * q
+        )
+    distances[distances >= far_away] = numpy.inf
+    return distances
@@ -1,4 +1,5 @@
 from math import log, tan, pi, atan, exp, cos, sin, sqrt, atan2
+import numpy
 from pyproj import CRS, Transformer
 
 earth_radius = 6378137
@@ -96,6 +97,18 @@ def wgs84_to_pix(lat, lon, zoomlevel):
     return (pix_x, pix_y)
 ################################################################################
 
+################################################################################
+def wgs84_to_pix_array(lat, lon, zoomlevel):
+    """
+    Array version of wgs84_to_pix.
+    """
+    rat_x = numpy.asarray(lon) / 180
+    rat_y = numpy.log(numpy.tan((90 + numpy.asarray(lat)) * pi / 360)) / pi
+    pix_x = numpy.round((rat_x + 1) * (2 ** (zoomlevel + 7)))
+    pix_y = numpy.round((1 - rat_y) * (2 ** (zoomlevel + 7)))
+    return (pix_x.astype(numpy.int64), pix_y.astype(numpy.int64))
+################################################################################
+
 ################################################################################
 def pix_to_wgs84(pix_x, pix_y, zoomlevel):
     rat_x = pix_x / (2 ** (zoomlevel + 7)) - 1
@@ -149,3 +162,29 @@ def st_coord(lat, lon, tex_x, tex_y, zoomlevel, provider_code):
     t = t if t <= 1 else 1
     return (s, t)
 ################################################################################
+
+################################################################################
+def wgs84_to_orthogrid_array(lat, lon, zoomlevel):
+    """
+    Array version of wgs84_to_orthogrid.
+    """
+    ratio_x = numpy.asarray(lon) / 180
+    ratio_y = numpy.log(numpy.tan((90 + numpy.asarray(lat)) * pi / 360)) / pi
+    mult = 2 ** (zoomlevel - 5)
+    til_x = ((ratio_x + 1) * mult).astype(numpy.int64) * 16
+    til_y = ((1 - ratio_y) * mult).astype(numpy.int64) * 16
+    return (til_x, til_y)
+################################################################################
+
+################################################################################
+def st_coord_array(lat, lon, tex_x, tex_y, zoomlevel):
+    """
+    Array version of st_coord, the texture attributes can be arrays too.
+    """
+    ratio_x = numpy.asarray(lon) / 180
+    ratio_y = numpy.log(numpy.tan((90 + numpy.asarray(lat)) * pi / 360)) / pi
+    mult = 2.0 ** (numpy.asarray(zoomlevel) - 5)
+    s = (ratio_x + 1) * mult - (numpy.asarray(tex_x) // 16)
+    t = 1 - ((1 - ratio_y) * mult - numpy.asarray(tex_y) // 16)
+    return (numpy.clip(s, 0, 1), numpy.clip(t, 0, 1))
+################################################################################
@@ -6,6 +6,8 @@ import O4_Vector_Utils as VECT
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_UI_Utils as UI
+import O4_Trace_Utils as TRACE
+import O4_Filter_Utils as FILTER
 import time
 import os
 import sys
@@ -763,21 +765,11 @@ def initialize_local_combined_providers_dict(tile):
                         )
                 if mask_width:
                     mask_width += 1
-                    img_array = numpy.array(mask_im, dtype=numpy.uint8)
-                    kernel = numpy.ones(int(mask_width)) / int(mask_width)
-                    kernel = numpy.array(range(1, 2 * mask_width))
-                    kernel[mask_width:] = range(mask_width - 1, 0, -1)
-                    kernel = kernel / mask_width ** 2
-                    for i in range(0, len(img_array)):
-                        img_array[i] = numpy.convolve(
-                            img_array[i], kernel, "same"
-                        )
-                    img_array = img_array.transpose()
-                    for i in range(0, len(img_array)):
-                        img_array[i] = numpy.convolve(
-                            img_array[i], kernel, "same"
-                        )
-                    img_array = img_array.transpose()
+                    img_array = FILTER.hat_filter(
+                        numpy.array(mask_im, dtype=numpy.uint8),
+                        mask_width,
+                        numpy.uint8,
+                    )
                     img_array[img_array >= 128] = 255
                     img_array[img_array < 128] *= 2
                     img_array = numpy.array(img_array, dtype=numpy.uint8)
@@ -931,9 +923,10 @@ def has_data(
                 )
             else:
                 check_dir = FNAMES.mask_dir(lat, lon)
-            if not os.path.isfile(
-                os.path.join(check_dir, FNAMES.legacy_mask(m_tilx, m_tily))
-            ):
+            mask_file = os.path.join(
+                check_dir, FNAMES.legacy_mask(m_tilx, m_tily)
+            )
+            if not MASK.mask_exists(mask_file):
                 return False
             # build extent mask_im
             if extent_code != "global":
@@ -963,17 +956,15 @@ def has_data(
             # build sea mask_im2
             (ymax, xmin) = GEO.gtile_to_wgs84(m_tilx, m_tily, mask_zl)
             (ymin, xmax) = GEO.gtile_to_wgs84(m_tilx + 16, m_tily + 16, mask_zl)
-            mask_im2 = Image.open(
-                os.path.join(check_dir, FNAMES.legacy_mask(m_tilx, m_tily))
-            ).convert("L")
-            (sizex, sizey) = mask_im2.size
+            (sizex, sizey) = MASK.mask_shape(mask_file)
             pxx0 = int((x0 - xmin) / (xmax - xmin) * sizex)
             pxx1 = int((x1 - xmin) / (xmax - xmin) * sizex)
             pxy0 = int((ymax - y0) / (ymax - ymin) * sizey)
             pxy1 = int((ymax - y1) / (ymax - ymin) * sizey)
-            mask_im2 = mask_im2.crop((pxx0, pxy0, pxx1, pxy1)).resize(
-                mask_size, Image.BICUBIC
-            )
+            # only the part of the mask under the texture is decoded
+            mask_im2 = Image.fromarray(
+                MASK.read_mask_window(mask_file, pxx0, pxy0, pxx1, pxy1)[0]
+            ).resize(mask_size, Image.BICUBIC)
             # invert it
             mask_array2 = 255 - numpy.array(mask_im2, dtype=numpy.uint8)
             # let full sea down (if you wish to...)
@@ -1611,6 +1602,7 @@ def download_jpeg_ortho(
 ################################################################################
 
 ################################################################################
+@TRACE.traced("download")
 def build_jpeg_ortho(
     tile, til_x_left, til_y_top, zoomlevel, provider_code, out_file_name=""
 ):
@@ -2292,6 +2284,7 @@ def combine_textures(tile, til_x_left, til_y_top, zoomlevel, provider_code):
 ################################################################################
 
 ################################################################################
+@TRACE.traced("convert")
 def convert_texture(
     tile, til_x_left, til_y_top, zoomlevel, provider_code, type="dds"
 ):
@@ -2340,26 +2333,10 @@ def convert_texture(
                 )
             ).convert("L")
     elif tile.imprint_masks_to_dds:  # type = 'tif'
-        if int(zoomlevel) >= tile.mask_zl:
-            factor = 2 ** (zoomlevel - tile.mask_zl)
-            m_til_x = (int(til_x_left / factor) // 16) * 16
-            m_til_y = (int(til_y_top / factor) // 16) * 16
-            rx = int((til_x_left - factor * m_til_x) / 16)
-            ry = int((til_y_top - factor * m_til_y) / 16)
-            mask_file = os.path.join(
-                FNAMES.mask_dir(tile.lat, tile.lon),
-                FNAMES.legacy_mask(m_til_x, m_til_y),
-            )
-            if os.path.isfile(mask_file):
-                big_img = Image.open(mask_file)
-                x0 = int(rx * 4096 / factor)
-                y0 = int(ry * 4096 / factor)
-                mask_im = big_img.crop(
-                    (x0, y0, x0 + 4096 // factor, y0 + 4096 // factor)
-                )
-                small_array = numpy.array(mask_im, dtype=numpy.uint8)
-                if small_array.max() > 30:
-                    masked_texture = True
+        mask = MASK.texture_mask(tile, til_x_left, til_y_top, zoomlevel)
+        if mask is not None and mask[1] > 30:
+            mask_im = Image.fromarray(mask[0])
+            masked_texture = True
 
     if provider_code in providers_dict:
         jpeg_file_name = FNAMES.jpeg_file_name_from_attributes(
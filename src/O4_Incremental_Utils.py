@@ -0,0 +1,317 @@
+"""Skip build steps whose inputs did not change since their last run.
+
+Each step is described by the files and tile variables it reads. After a
+successful run, a digest of their content is stored in the tile state file
+(Data<lat><lon>.state); when skip_unchanged_steps is set, a step whose
+digest is unchanged and whose outputs are still present is not run again.
+Since Step 2 hashes the .node/.poly files produced by Step 1 (and so on),
+redoing a step which yields identical outputs does not trigger the next
+ones either.
+
+File digests are cached by (path, size, mtime), in memory and in the state
+file, so that unchanged files are not read twice.
+"""
+
+import functools
+import glob
+import hashlib
+import json
+import os
+import threading
+import O4_UI_Utils as UI
+import O4_File_Names as FNAMES
+import O4_DEM_Utils as DEM
+from O4_Cfg_Vars import (
+    list_vector_vars,
+    list_mesh_vars,
+    list_mask_vars,
+    list_dsf_vars,
+    list_other_vars,
+)
+
+skip_unchanged_steps = False
+
+step_names = {
+    "osm": "Step 1",
+    "mesh": "Step 2",
+    "mask": "Step 2.5",
+    "dsf": "Step 3",
+}
+
+osm_cached_suffixes = (
+    "airports",
+    "big_roads",
+    "small_roads",
+    "coastline",
+    "water",
+)
+
+_digest_cache = {}
+_lock = threading.Lock()
+
+
+################################################################################
+def _list_files(path):
+    if os.path.isdir(path):
+        return sorted(
+            os.path.join(root, file_name)
+            for (root, _, file_names) in os.walk(path)
+            for file_name in file_names
+        )
+    return [path]
+
+
+################################################################################
+def file_digest(file_name, known=None):
+    """
+    Digest of a file content, "missing" if it does not exist. `known` maps
+    file names to [size, mtime_ns, digest] records from a previous run.
+    """
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return "missing"
+    key = (file_name, stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        if key in _digest_cache:
+            return _digest_cache[key]
+    if known and known.get(file_name, [None, None])[:2] == list(key[1:]):
+        digest = known[file_name][2]
+    else:
+        hasher = hashlib.sha256()
+        try:
+            with open(file_name, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    hasher.update(chunk)
+        except OSError:
+            return "missing"
+        digest = hasher.hexdigest()
+    with _lock:
+        _digest_cache[key] = digest
+    return digest
+
+
+################################################################################
+def custom_extent_files(tile):
+    if not tile.masks_custom_extent:
+        return []
+    return sorted(
+        glob.glob(
+            os.path.join(
+                FNAMES.Extent_dir, "*", tile.masks_custom_extent + ".*"
+            )
+        )
+    )
+
+
+################################################################################
+def step_inputs(tile, step):
+    """Files and tile variables read by a step."""
+    (lat, lon) = (tile.lat, tile.lon)
+    files = []
+    if step == "osm":
+        files += [
+            FNAMES.osm_cached(lat, lon, suffix)
+            for suffix in osm_cached_suffixes
+        ]
+        for path in (
+            FNAMES.custom_coastline(lat, lon),
+            FNAMES.custom_coastline_dir(lat, lon),
+            FNAMES.custom_water(lat, lon),
+            FNAMES.custom_water_dir(lat, lon),
+            FNAMES.patch_dir(lat, lon),
+        ):
+            files += _list_files(path)
+        files += DEM.elevation_files(lat, lon, tile.custom_dem)
+        variables = list_vector_vars + list_other_vars
+    elif step == "mesh":
+        files += [
+            FNAMES.input_node_file(tile),
+            FNAMES.input_poly_file(tile),
+            FNAMES.alt_file(tile),
+            FNAMES.apt_file(tile),
+        ]
+        # the elevation source O4_Mesh_Utils.build_mesh reads
+        source = (
+            (";" in tile.custom_dem)
+            and tile.custom_dem.split(";")[tile.iterate or 0]
+        ) or tile.custom_dem
+        files += DEM.elevation_files(lat, lon, source)
+        variables = list_mesh_vars + list_other_vars
+    elif step == "mask":
+        for close_lat in range(lat - 1, lat + 2):
+            for close_lon in range(lon - 1, lon + 2):
+                close_build_dir = (
+                    tile.build_dir
+                    if tile.grouped
+                    else tile.build_dir.replace(
+                        FNAMES.tile_dir(lat, lon),
+                        FNAMES.tile_dir(close_lat, close_lon),
+                    )
+                )
+                files.append(
+                    FNAMES.mesh_file(close_build_dir, close_lat, close_lon)
+                )
+        if tile.masks_use_DEM_too:
+            files += DEM.elevation_files(lat, lon, tile.custom_dem)
+        files += custom_extent_files(tile)
+        variables = list_mask_vars + ["ratio_water", "custom_dem"]
+    elif step == "dsf":
+        files.append(FNAMES.mesh_file(tile.build_dir, lat, lon))
+        files.append(FNAMES.apt_file(tile))
+        files += _list_files(FNAMES.mask_dir(lat, lon))
+        variables = list_dsf_vars + list_mask_vars + [
+            "default_website",
+            "default_zl",
+            "zone_list",
+        ]
+    values = {var: getattr(tile, var, None) for var in variables}
+    if step == "mask":
+        # local import, O4_Mask_Utils uses this module when imported
+        import O4_Mask_Utils as MASK
+
+        # an application setting, but switching it rebuilds the masks
+        values["masks_tiled_storage"] = MASK.masks_tiled_storage
+    return (files, values)
+
+
+################################################################################
+def step_outputs_exist(tile, step):
+    if step == "osm":
+        files = [
+            FNAMES.input_node_file(tile),
+            FNAMES.input_poly_file(tile),
+            FNAMES.alt_file(tile),
+        ]
+    elif step == "mesh":
+        files = [FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)]
+    elif step == "mask":
+        files = [FNAMES.mask_dir(tile.lat, tile.lon)]
+    elif step == "dsf":
+        if missing_textures(tile):
+            return False
+        files = [FNAMES.dsf_file(tile.build_dir, tile.lat, tile.lon)]
+    return all(os.path.exists(file_name) for file_name in files)
+
+
+################################################################################
+def missing_textures(tile):
+    """Textures referenced by the terrain files which are not present."""
+    import O4_Tile_Utils as TILE
+
+    if TILE.skip_downloads or TILE.skip_converts:
+        return []
+    terrain_dir = os.path.join(tile.build_dir, "terrain")
+    if not os.path.isdir(terrain_dir):
+        return [terrain_dir]
+    missing = []
+    for ter_file in os.listdir(terrain_dir):
+        if not ter_file.endswith(".ter"):
+            continue
+        with open(os.path.join(terrain_dir, ter_file), "r") as f:
+            for line in f:
+                if "../textures/" not in line:
+                    continue
+                texture = os.path.join(
+                    tile.build_dir,
+                    "textures",
+                    line.split("../textures/")[1].strip(),
+                )
+                if not os.path.exists(texture):
+                    missing.append(texture)
+    return missing
+
+
+################################################################################
+def read_state(tile):
+    try:
+        with open(
+            FNAMES.state_file(tile.build_dir, tile.lat, tile.lon), "r"
+        ) as f:
+            state = json.load(f)
+        if isinstance(state, dict):
+            state.setdefault("files", {})
+            state.setdefault("steps", {})
+            return state
+    except (OSError, ValueError):
+        pass
+    return {"files": {}, "steps": {}}
+
+
+################################################################################
+def write_state(tile, state):
+    state_file = FNAMES.state_file(tile.build_dir, tile.lat, tile.lon)
+    try:
+        with open(state_file + ".tmp", "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(state_file + ".tmp", state_file)
+    except OSError as e:
+        UI.vprint(1, "WARNING: Could not write the build state file:", e)
+
+
+################################################################################
+def step_digest(tile, step, state):
+    (files, variables) = step_inputs(tile, step)
+    hasher = hashlib.sha256()
+    for file_name in files:
+        digest = file_digest(file_name, state["files"])
+        hasher.update((file_name + "=" + digest + "\n").encode())
+        if digest != "missing":
+            stat = os.stat(file_name)
+            state["files"][file_name] = [
+                stat.st_size,
+                stat.st_mtime_ns,
+                digest,
+            ]
+    hasher.update(
+        json.dumps({k: repr(v) for (k, v) in variables.items()}, sort_keys=True)
+        .encode()
+    )
+    return hasher.hexdigest()
+
+
+################################################################################
+def is_unchanged(tile, step):
+    state = read_state(tile)
+    if step not in state["steps"] or not step_outputs_exist(tile, step):
+        return False
+    return step_digest(tile, step, state) == state["steps"][step]
+
+
+################################################################################
+def record_step(tile, step):
+    state = read_state(tile)
+    state["steps"][step] = step_digest(tile, step, state)
+    write_state(tile, state)
+
+
+################################################################################
+def skip_if_unchanged(step):
+    """
+    Decorator for the step functions (first argument is the tile): skips the
+    step when its inputs are unchanged, and records them after a successful
+    run.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(tile, *args, **kwargs):
+            if UI.is_working or args or kwargs:
+                return func(tile, *args, **kwargs)
+            if skip_unchanged_steps and is_unchanged(tile, step):
+                UI.lvprint(
+                    0,
+                    "\n" + step_names[step],
+                    "for tile",
+                    FNAMES.short_latlon(tile.lat, tile.lon),
+                    ": inputs unchanged since its last run, skipped.",
+                )
+                return 1
+            result = func(tile, *args, **kwargs)
+            if skip_unchanged_steps and result and not UI.red_flag:
+                record_step(tile, step)
+            return result
+
+        return wrapper
+
+    return decorator
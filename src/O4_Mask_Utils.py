@@ -1,23 +1,67 @@
 import os
 import sys
+import io
+import hashlib
+import json
+import struct
 import time
+import types
 import queue
-from math import atan, ceil, floor
+import threading
+import zlib
+import multiprocessing
+import concurrent.futures
+from collections import OrderedDict
+from math import atan, ceil, erf, floor
 import numpy
 from PIL import Image, ImageDraw, ImageFilter, ImageOps
 import skfmm
 import O4_DEM_Utils as DEM
 import O4_File_Names as FNAMES
 import O4_UI_Utils as UI
+import O4_Trace_Utils as TRACE
+import O4_Incremental_Utils as INCR
 import O4_Geo_Utils as GEO
 import O4_Imagery_Utils as IMG
 import O4_OSM_Utils as OSM
 import O4_Vector_Utils as VECT
 import O4_Mesh_Utils as MESH
+import O4_Filter_Utils as FILTER
 from O4_Parallel_Utils import parallel_execute
+from O4_Cfg_Vars import list_mask_vars
 
 mask_altitude_above = 0.5
 masks_build_slots = 4
+masks_build_processes = False
+
+# in MB, decoded masks kept in memory for the textures using them
+mask_cache_size = 256
+mask_cache_block = 256
+
+_mask_cache = OrderedDict()
+_mask_cache_lock = threading.Lock()
+_worker_dem = {}
+
+water_tris_cache_meshes = 9
+_water_tris_cache = OrderedDict()
+_water_tris_lock = threading.Lock()
+
+# to be increased when the masks built from the same inputs change
+masks_state_version = 1
+
+# masks stored as zlib compressed blocks rather than PNG, see encode_tiled_mask
+masks_tiled_storage = False
+tiled_mask_block = 256
+tiled_mask_magic = b"O4XPMASK"
+# version 1 had no row differences, it is still read
+tiled_mask_version = 2
+tiled_mask_header = struct.Struct("<8sHHII")
+tiled_mask_index = numpy.dtype([
+    ("offset", "<u8"),
+    ("size", "<u4"),
+    ("max", "u1"),
+    ("value", "u1"),
+])
 
 ################################################################################
 def mask_name_for_texture(tile, til_x_left, til_y_top, zl, *args):
@@ -35,32 +79,311 @@ def mask_name_for_texture(tile, til_x_left, til_y_top, zl, *args):
 ################################################################################
 
 ################################################################################
-def needs_mask(tile, til_x_left, til_y_top, zl, *args):
+def read_mask(mask_file):
+    """
+    Decoded mask and the maximum of each of its mask_cache_block wide
+    squares, or None if the mask does not exist. The mask is read from its
+    PNG file or else from the tiled one. The least recently used masks
+    beyond mask_cache_size MB are dropped from the cache, which is keyed by
+    file size and modification time so that rebuilt masks are read again.
+    The returned array is read only.
+    """
+    (mask_file, stamp) = mask_stamp(mask_file)
+    if mask_file is None:
+        return None
+    cached = cache_get(mask_file, stamp)
+    if cached is not None:
+        return cached
+    if mask_file.endswith(FNAMES.tiled_mask_ext):
+        index = read_tiled_index(mask_file, stamp)
+        (height, width) = index["shape"]
+        mask_array = read_tiled_window(mask_file, stamp, 0, 0, width, height)
+    else:
+        mask_array = numpy.array(Image.open(mask_file).convert("L"))
+    mask_array.flags.writeable = False
+    (height, width) = mask_array.shape
+    block = mask_cache_block
+    if height % block or width % block:
+        block_max = None
+    else:
+        block_max = mask_array.reshape(
+            height // block, block, width // block, block
+        ).max(axis=(1, 3))
+    cache_put(mask_file, stamp, (mask_array, block_max), mask_array.nbytes)
+    return (mask_array, block_max)
+################################################################################
+
+################################################################################
+def read_mask_window(mask_file, x0, y0, x1, y1):
+    """
+    Part [y0:y1, x0:x1] of a mask, padded with zeros where out of it, and
+    its maximum, or None if the mask does not exist. Only the blocks needed
+    are decoded from a tiled mask, a PNG mask is read as a whole through the
+    cache and the window is then a read only view of it when inside.
+    """
+    (mask_file, stamp) = mask_stamp(mask_file)
+    if mask_file is None:
+        return None
+    if mask_file.endswith(FNAMES.tiled_mask_ext):
+        index = read_tiled_index(mask_file, stamp)
+        (height, width) = index["shape"]
+        block = index["block"]
+        block_max = index["max"]
+    else:
+        (mask_array, block_max) = read_mask(mask_file)
+        (height, width) = mask_array.shape
+        block = mask_cache_block
+    inside = x0 >= 0 and y0 >= 0 and x1 <= width and y1 <= height
+    if inside:
+        if mask_file.endswith(FNAMES.tiled_mask_ext):
+            window = read_tiled_window(mask_file, stamp, x0, y0, x1, y1)
+        else:
+            window = mask_array[y0:y1, x0:x1]
+    else:
+        window = numpy.zeros((max(y1 - y0, 0), max(x1 - x0, 0)),
+                             dtype=numpy.uint8)
+        (cx0, cy0) = (min(max(x0, 0), width), min(max(y0, 0), height))
+        (cx1, cy1) = (max(min(x1, width), cx0), max(min(y1, height), cy0))
+        if cx1 > cx0 and cy1 > cy0:
+            window[cy0 - y0 : cy1 - y0, cx0 - x0 : cx1 - x0] = (
+                read_mask_window(mask_file, cx0, cy0, cx1, cy1)[0])
+    if not window.size:
+        return (window, 0)
+    if inside and block_max is not None and not (
+            x0 % block or y0 % block or x1 % block or y1 % block):
+        window_max = block_max[y0 // block : y1 // block,
+                               x0 // block : x1 // block].max()
+    else:
+        window_max = window.max()
+    return (window, int(window_max))
+################################################################################
+
+################################################################################
+def read_mask_pixels(mask_file, rows, cols):
+    """
+    Values of a mask at the given arrays of pixel coordinates, or None if
+    the mask does not exist. Only the blocks holding them are decoded from
+    a tiled mask, a PNG mask is read through the cache.
+    """
+    (mask_file, stamp) = mask_stamp(mask_file)
+    if mask_file is None:
+        return None
+    if not mask_file.endswith(FNAMES.tiled_mask_ext):
+        return read_mask(mask_file)[0][rows, cols]
+    index = read_tiled_index(mask_file, stamp)
+    block = index["block"]
+    blocks = (rows // block) * index["blocks_x"] + cols // block
+    values = numpy.empty(len(blocks), dtype=numpy.uint8)
+    with open(mask_file, "rb") as f:
+        for number in numpy.unique(blocks).tolist():
+            inside = blocks == number
+            block_array = read_tiled_block(f, index, number)
+            values[inside] = block_array[rows[inside] % block,
+                                         cols[inside] % block]
+    return values
+################################################################################
+
+################################################################################
+def mask_exists(mask_file):
+    return mask_stamp(mask_file)[0] is not None
+################################################################################
+
+################################################################################
+def mask_shape(mask_file):
+    """
+    (width, height) of a mask, read from the header of its file only, or
+    None if the mask does not exist.
+    """
+    (mask_file, stamp) = mask_stamp(mask_file)
+    if mask_file is None:
+        return None
+    if mask_file.endswith(FNAMES.tiled_mask_ext):
+        (height, width) = read_tiled_index(mask_file, stamp)["shape"]
+        return (width, height)
+    with Image.open(mask_file) as im:
+        return im.size
+################################################################################
+
+################################################################################
+def mask_stamp(mask_file):
+    """
+    The file actually holding a mask given by the name of its PNG file,
+    which is looked for first (so that a mask edited by hand is used), then
+    the tiled file, along with its size and modification time. (None, None)
+    when there is neither.
+    """
+    for file_name in (mask_file, FNAMES.tiled_mask(mask_file)):
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            continue
+        return (file_name, (stat.st_size, stat.st_mtime_ns))
+    return (None, None)
+################################################################################
+
+################################################################################
+def cache_get(key, stamp):
+    with _mask_cache_lock:
+        if key in _mask_cache and _mask_cache[key][0] == stamp:
+            _mask_cache.move_to_end(key)
+            return _mask_cache[key][1]
+    return None
+################################################################################
+
+################################################################################
+def cache_put(key, stamp, value, nbytes):
+    with _mask_cache_lock:
+        _mask_cache[key] = (stamp, value, nbytes)
+        _mask_cache.move_to_end(key)
+        cached = sum(entry[2] for entry in _mask_cache.values())
+        while len(_mask_cache) > 1 and cached > mask_cache_size * 2 ** 20:
+            (_, entry) = _mask_cache.popitem(last=False)
+            cached -= entry[2]
+################################################################################
+
+################################################################################
+# Tiled masks : a header, then the index of the blocks of tiled_mask_block
+# pixels wide (row by row), then the zlib compressed data of the blocks,
+# each row of which is stored as its difference with the row above (as the
+# "up" filter of PNG) since masks mostly vary smoothly.
+# Uniform blocks (mostly all 0 or all 255) have no data, their value is in
+# the index along with the maximum of each block, so that whether a texture
+# needs a mask is known without decompressing anything.
+################################################################################
+def encode_tiled_mask(img_array, block=tiled_mask_block):
+    (height, width) = img_array.shape
+    blocks_y = -(-height // block)
+    blocks_x = -(-width // block)
+    index = numpy.zeros(blocks_y * blocks_x, dtype=tiled_mask_index)
+    offset = tiled_mask_header.size + index.nbytes
+    data = []
+    for number in range(len(index)):
+        (by, bx) = divmod(number, blocks_x)
+        block_array = img_array[by * block : (by + 1) * block,
+                                bx * block : (bx + 1) * block]
+        block_max = block_array.max()
+        index["offset"][number] = offset
+        index["max"][number] = block_max
+        if block_array.min() == block_max:
+            index["value"][number] = block_max
+            continue
+        block_delta = block_array.copy()
+        block_delta[1:] -= block_array[:-1]
+        block_data = zlib.compress(block_delta, 6)
+        index["size"][number] = len(block_data)
+        data.append(block_data)
+        offset += len(block_data)
+    return b"".join([
+        tiled_mask_header.pack(tiled_mask_magic, tiled_mask_version, block,
+                               width, height),
+        index.tobytes()] + data)
+################################################################################
+
+################################################################################
+def read_tiled_index(mask_file, stamp):
+    cached = cache_get((mask_file, "index"), stamp)
+    if cached is not None:
+        return cached
+    with open(mask_file, "rb") as f:
+        (magic, version, block, width, height) = tiled_mask_header.unpack(
+            f.read(tiled_mask_header.size))
+        if magic != tiled_mask_magic or version not in (1, 2):
+            raise ValueError("Not a tiled mask file: " + mask_file)
+        blocks_y = -(-height // block)
+        blocks_x = -(-width // block)
+        entries = numpy.frombuffer(
+            f.read(blocks_y * blocks_x * tiled_mask_index.itemsize),
+            dtype=tiled_mask_index)
+    index = {
+        "version": version,
+        "shape": (height, width),
+        "block": block,
+        "blocks_x": blocks_x,
+        "entries": entries,
+        "max": entries["max"].reshape(blocks_y, blocks_x),
+    }
+    cache_put((mask_file, "index"), stamp, index, entries.nbytes)
+    return index
+################################################################################
+
+################################################################################
+def read_tiled_block(f, index, number):
+    (height, width) = index["shape"]
+    block = index["block"]
+    (by, bx) = divmod(number, index["blocks_x"])
+    shape = (min(block, height - by * block), min(block, width - bx * block))
+    entry = index["entries"][number]
+    if not entry["size"]:
+        return numpy.full(shape, entry["value"], dtype=numpy.uint8)
+    f.seek(int(entry["offset"]))
+    block_array = numpy.frombuffer(
+        zlib.decompress(f.read(int(entry["size"]))), dtype=numpy.uint8
+    ).reshape(shape)
+    if index["version"] == 1:
+        return block_array
+    return numpy.cumsum(block_array, axis=0, dtype=numpy.uint8)
+################################################################################
+
+################################################################################
+def read_tiled_window(mask_file, stamp, x0, y0, x1, y1):
+    """
+    Part [y0:y1, x0:x1] (inside the mask) of a tiled mask, decoding only
+    the blocks it overlaps.
+    """
+    index = read_tiled_index(mask_file, stamp)
+    block = index["block"]
+    window = numpy.empty((y1 - y0, x1 - x0), dtype=numpy.uint8)
+    with open(mask_file, "rb") as f:
+        for by in range(y0 // block, -(-y1 // block)):
+            for bx in range(x0 // block, -(-x1 // block)):
+                block_array = read_tiled_block(
+                    f, index, by * index["blocks_x"] + bx)
+                (bx0, by0) = (max(x0, bx * block), max(y0, by * block))
+                (bx1, by1) = (min(x1, (bx + 1) * block),
+                              min(y1, (by + 1) * block))
+                window[by0 - y0 : by1 - y0, bx0 - x0 : bx1 - x0] = (
+                    block_array[by0 - by * block : by1 - by * block,
+                                bx0 - bx * block : bx1 - bx * block])
+    return window
+################################################################################
+
+################################################################################
+def texture_mask(tile, til_x_left, til_y_top, zl, *args):
+    """
+    Part of the mask covering a texture at zl >= mask_zl and its maximum,
+    see read_mask_window. None if there is no such mask.
+    """
     if int(zl) < tile.mask_zl:
-        return False
+        return None
     factor = 2 ** (zl - tile.mask_zl)
     m_til_x = (int(til_x_left / factor) // 16) * 16
     m_til_y = (int(til_y_top / factor) // 16) * 16
     rx = int((til_x_left - factor * m_til_x) / 16)
     ry = int((til_y_top - factor * m_til_y) / 16)
-    mask_file = os.path.join(
-        FNAMES.mask_dir(tile.lat, tile.lon),
-        FNAMES.legacy_mask(m_til_x, m_til_y)
-        )
-    if not os.path.isfile(mask_file):
-        return False
-    big_img = Image.open(mask_file)
+    size = 4096 // factor
     x0 = int(rx * 4096 / factor)
     y0 = int(ry * 4096 / factor)
-    small_img = big_img.crop((x0, y0, x0 + 4096 // factor, y0 + 4096 // factor))
-    small_array = numpy.array(small_img, dtype=numpy.uint8)
-    if small_array.max() <= 30:
+    return read_mask_window(
+        os.path.join(
+            FNAMES.mask_dir(tile.lat, tile.lon),
+            FNAMES.legacy_mask(m_til_x, m_til_y),
+        ),
+        x0, y0, x0 + size, y0 + size
+    )
+################################################################################
+
+################################################################################
+def needs_mask(tile, til_x_left, til_y_top, zl, *args):
+    mask = texture_mask(tile, til_x_left, til_y_top, zl)
+    if mask is None or mask[1] <= 30:
         return False
     else:
-        return small_img
+        return Image.fromarray(mask[0])
 ################################################################################
 
 ################################################################################
+@INCR.skip_if_unchanged("mask")
+@TRACE.traced_step("Step 2.5")
 def build_masks(tile, for_imagery=False):
     
     if UI.is_working:
@@ -110,25 +433,18 @@ def build_masks(tile, for_imagery=False):
     # Select nearby meshes
     mesh_list = select_neighbor_meshes(tile)
 
-    # Delete old masks
-    UI.vprint(1, "-> Deleting existing masks")
-    delete_old_masks_in_tile(tile, dest_dir)
-    
     # Record water tris form mesh (and portions of nearby meshes)
     UI.vprint(1, "-> Reading mesh data")
-    (dico_sea, dico_inland) = record_water_tris(tile, )
+    (dico_sea, dico_inland) = record_water_tris(tile)
+    if UI.red_flag:
+        UI.exit_message_and_bottom_line()
+        return 0
 
     UI.vprint(1, "-> Construction of the masks")
 
     if tile.masks_use_DEM_too:
         try:
-            fill_nodata = tile.fill_nodata or "to zero"
-            source = (
-                (";" in tile.custom_dem) and tile.custom_dem.split(";")[0]
-            ) or tile.custom_dem
-            tile.dem = DEM.DEM(
-                tile.lat, tile.lon, source, fill_nodata, info_only=False
-            )
+            tile.dem = mask_dem(tile)
         except:
             UI.exit_message_and_bottom_line(
                 "\nERROR: Could not determine the appropriate elevation source.",
@@ -136,89 +452,250 @@ def build_masks(tile, for_imagery=False):
             )
             return 0
 
-    #################################
-    def build_mask(til_x, til_y):
-
-        (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
-            tile.lat + 1, tile.lon, tile.mask_zl)
-        (til_x_max, til_y_max) = GEO.wgs84_to_orthogrid(
-            tile.lat, tile.lon + 1, tile.mask_zl)
-        if (til_x < til_x_min or til_x > til_x_max or til_y < til_y_min or 
-            til_y > til_y_max):
-            return 1
-
-        pre_mask = build_water_pre_mask(til_x, til_y, mesh_list, dico_sea,
-                                         dico_inland, sea_level, tile) 
-        if tile.masks_use_DEM_too:
-            dem_array = build_dem_pre_mask(til_x, til_y, tile)
-            pre_mask = numpy.maximum(pre_mask, dem_array)
-            del(dem_array)
-
-        if tile.masks_custom_extent:
-            custom_array = build_custom_pre_mask(til_x, til_y, sea_level, tile)
-
-        if (pre_mask.max() == 0) and (
-                not tile.masks_custom_extent or custom_array.max() == 0):
-            return 1
-        
-        
-        blured_mask = blur_mask(pre_mask, tile, sea_level)
-
-        # Ensure land is kept to 255 on the mask to avoid unecessary ones, crop 
-        # to final size, and take the max with the possible custom extent mask
-        blured_mask = numpy.maximum(
-            (pre_mask > 0).astype(numpy.uint8) * 255, 
-            blured_mask
-        )[1024 : 4096 + 1024, 1024 : 4096 + 1024]
-        
-        if tile.masks_custom_extent:
-            blured_mask = numpy.maximum(blured_mask, custom_mask)
-
-        if not (blured_mask.max() == 0 or blured_mask.min() == 255):
-            mask_im = Image.fromarray(blured_mask)
-            mask_im.save(os.path.join(
-                dest_dir, FNAMES.legacy_mask(til_x, til_y)))
-            del blured_mask
-            
-            # Distance masks for bathymetry cut-off
-            if (tile.distance_masks_too):
-                pre_mask = (pre_mask > 0).astype(float) * 2 - 1
-                band = 255 / 2**(16 - tile.mask_zl)
-                dist_array = skfmm.distance(pre_mask, narrow = band)
-                if (isinstance(dist_array, numpy.ma.core.MaskedArray)):
-                    dist_array = dist_array.filled(-99999)
-                dist_array[pre_mask > 0] = 0
-                del(pre_mask)
-                dist_array = dist_array[1024 : 4096 + 1024, 1024 : 4096 + 1024]
-                dist_array = dist_array * (2**(16 - tile.mask_zl))
-                dist_array = numpy.minimum(-numpy.minimum(dist_array, 0), 255)
-                dist_array = dist_array.astype(numpy.uint8)
-                masks_im = Image.fromarray(dist_array)
-                masks_im.save(os.path.join(
-                    dest_dir, FNAMES.distance_mask(til_x, til_y)))
-                UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y),
-                "and", FNAMES.distance_mask(til_x, til_y))
-            else:
-                UI.vprint(1, "   Created", FNAMES.legacy_mask(til_x, til_y))
-        return 1
-    #################################
-    
-    masks_queue = queue.Queue()
-    for key in dico_sea:
-        masks_queue.put(key)
+    masks = [
+        (til_x, til_y, dico_sea[(til_x, til_y)],
+            dico_inland.get((til_x, til_y), []))
+        for (til_x, til_y) in dico_sea
+    ]
+
+    # Masks whose inputs did not change since they were built are kept,
+    # the other ones deleted
+    masks_state = read_masks_state(dest_dir)
+    if masks_state is None:
+        UI.vprint(1, "-> Deleting existing masks")
+        delete_old_masks_in_tile(tile, dest_dir)
+        masks_state = {}
+    inputs_digest = masks_inputs_digest(tile, mesh_list, sea_level)
+    fingerprints = {
+        mask_key(til_x, til_y): mask_fingerprint(
+            inputs_digest, sea_tris, inland_tris)
+        for (til_x, til_y, sea_tris, inland_tris) in masks
+    }
+    for key in list(masks_state):
+        if key not in fingerprints:
+            delete_masks(dest_dir, masks_state.pop(key)[1])
+    masks = [
+        mask for mask in masks
+        if not is_mask_unchanged(dest_dir, masks_state,
+                                 mask_key(*mask[:2]), fingerprints)
+    ]
+    if len(masks) < len(fingerprints):
+        UI.vprint(1, "   Kept", len(fingerprints) - len(masks),
+                  "masks whose inputs are unchanged.")
     dico_progress = {"done": 0, "bar": 1}
+    state_lock = threading.Lock()
 
-    parallel_execute(build_mask, masks_queue, masks_build_slots,
-                     progress=dico_progress)
+    def save_mask(til_x, til_y, mask_files):
+        if UI.red_flag and not mask_files:
+            return 0
+        key = mask_key(til_x, til_y)
+        with state_lock:
+            delete_masks(dest_dir, masks_state.pop(key, [None, []])[1])
+        for (file_name, file_data) in mask_files:
+            with open(os.path.join(dest_dir, file_name), "wb") as f:
+                f.write(file_data)
+        if mask_files:
+            UI.vprint(1, "   Created", " and ".join(
+                file_name for (file_name, _) in mask_files))
+        with state_lock:
+            masks_state[key] = [
+                fingerprints[key],
+                [file_name for (file_name, _) in mask_files],
+            ]
+        return 1
+
+    if masks_build_processes and len(masks) > 1:
+        build_masks_in_processes(masks, mesh_list, sea_level, tile,
+                                 save_mask, dico_progress)
+    else:
+        masks_queue = queue.Queue()
+        for mask in masks:
+            masks_queue.put(mask)
+        parallel_execute(
+            lambda til_x, til_y, sea_tris, inland_tris: save_mask(
+                til_x, til_y, build_mask(til_x, til_y, sea_tris, inland_tris,
+                                         mesh_list, sea_level, tile)),
+            masks_queue, masks_build_slots, progress=dico_progress)
+    write_masks_state(dest_dir, masks_state)
 
     UI.progress_bar(1, 100)
     UI.timings_and_bottom_line(timer)
     UI.logprint(
         "Step 2.5 for tile lat=", tile.lat, ", lon=", tile.lon, ": normal exit."
     )
-    return
+    return 1
 ################################################################################
     
+################################################################################
+def mask_dem(tile):
+    fill_nodata = tile.fill_nodata or "to zero"
+    source = (
+        (";" in tile.custom_dem) and tile.custom_dem.split(";")[0]
+    ) or tile.custom_dem
+    return DEM.DEM(tile.lat, tile.lon, source, fill_nodata, info_only=False)
+################################################################################
+
+################################################################################
+def build_mask(til_x, til_y, sea_tris, inland_tris, mesh_list, sea_level,
+               tile):
+    """
+    Water mask (and distance mask if requested) of a mask cell, as a list of
+    (file name, file data) pairs, empty if the mask would be uniform.
+    """
+    (til_x_min, til_y_min) = GEO.wgs84_to_orthogrid(
+        tile.lat + 1, tile.lon, tile.mask_zl)
+    (til_x_max, til_y_max) = GEO.wgs84_to_orthogrid(
+        tile.lat, tile.lon + 1, tile.mask_zl)
+    if (til_x < til_x_min or til_x > til_x_max or til_y < til_y_min or
+        til_y > til_y_max) or UI.red_flag:
+        return []
+
+    pre_mask = build_water_pre_mask(til_x, til_y, mesh_list, sea_tris,
+                                    inland_tris, sea_level, tile)
+    if tile.masks_use_DEM_too:
+        dem_array = build_dem_pre_mask(til_x, til_y, tile)
+        pre_mask = numpy.maximum(pre_mask, dem_array)
+        del(dem_array)
+
+    if tile.masks_custom_extent:
+        custom_array = build_custom_pre_mask(til_x, til_y, sea_level, tile)
+
+    if (pre_mask.max() == 0) and (
+            not tile.masks_custom_extent or custom_array.max() == 0):
+        return []
+    if UI.red_flag:
+        return []
+
+    blured_mask = blur_mask(pre_mask, tile, sea_level)
+    if UI.red_flag:
+        return []
+
+    # Ensure land is kept to 255 on the mask to avoid unecessary ones, crop
+    # to final size, and take the max with the possible custom extent mask
+    blured_mask = numpy.maximum(
+        (pre_mask > 0).astype(numpy.uint8) * 255,
+        blured_mask
+    )[1024 : 4096 + 1024, 1024 : 4096 + 1024]
+
+    if tile.masks_custom_extent:
+        blured_mask = numpy.maximum(blured_mask, custom_array)
+
+    if blured_mask.max() == 0 or blured_mask.min() == 255:
+        return []
+    mask_files = [
+        encode_mask(FNAMES.legacy_mask(til_x, til_y), blured_mask)]
+    del blured_mask
+
+    # Distance masks for bathymetry cut-off
+    if (tile.distance_masks_too):
+        pre_mask = (pre_mask > 0).astype(float) * 2 - 1
+        band = 255 / 2**(16 - tile.mask_zl)
+        dist_array = skfmm.distance(pre_mask, narrow = band)
+        if (isinstance(dist_array, numpy.ma.core.MaskedArray)):
+            dist_array = dist_array.filled(-99999)
+        dist_array[pre_mask > 0] = 0
+        del(pre_mask)
+        dist_array = dist_array[1024 : 4096 + 1024, 1024 : 4096 + 1024]
+        dist_array = dist_array * (2**(16 - tile.mask_zl))
+        dist_array = numpy.minimum(-numpy.minimum(dist_array, 0), 255)
+        dist_array = dist_array.astype(numpy.uint8)
+        mask_files.append(
+            encode_mask(FNAMES.distance_mask(til_x, til_y), dist_array))
+    return mask_files
+################################################################################
+
+################################################################################
+def encode_mask(file_name, img_array):
+    """
+    (file name, file data) of a mask given the name of its PNG file, stored
+    as PNG or tiled depending on masks_tiled_storage.
+    """
+    if masks_tiled_storage:
+        return (FNAMES.tiled_mask(file_name), encode_tiled_mask(img_array))
+    return (file_name, encode_png(img_array))
+################################################################################
+
+################################################################################
+def encode_png(img_array):
+    png_data = io.BytesIO()
+    Image.fromarray(img_array).save(png_data, format="PNG")
+    return png_data.getvalue()
+################################################################################
+
+################################################################################
+def build_mask_worker(til_x, til_y, sea_tris, inland_tris, mesh_list,
+                      sea_level, tile_vars):
+    tile = types.SimpleNamespace(**tile_vars)
+    if tile.masks_use_DEM_too:
+        key = (tile.lat, tile.lon, tile.custom_dem, tile.fill_nodata)
+        if _worker_dem.get("key") != key:
+            _worker_dem["key"] = key
+            _worker_dem["dem"] = mask_dem(tile)
+        tile.dem = _worker_dem["dem"]
+    output = io.StringIO()
+    sys.stdout = output
+    try:
+        mask_files = build_mask(til_x, til_y, sea_tris, inland_tris,
+                                mesh_list, sea_level, tile)
+    finally:
+        sys.stdout = sys.__stdout__
+    return (mask_files, output.getvalue())
+################################################################################
+
+################################################################################
+def build_masks_in_processes(masks, mesh_list, sea_level, tile, save_mask,
+                             progress):
+    """
+    Build the masks in a pool of masks_build_slots processes, each being
+    sent the water triangles of its mask cell only. The file data are sent
+    back and written by the calling process. UI.red_flag cancels the masks
+    which are not started yet, the running ones stop at their next check.
+    """
+    import O4_Tile_Utils as TILE
+
+    tile_vars = dict(vars(tile))
+    tile_vars["dem"] = None
+    mp_context = multiprocessing.get_context("spawn")
+    stop_event = mp_context.Event()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(masks_build_slots, len(masks)),
+        mp_context=mp_context,
+        initializer=TILE.init_batch_worker,
+        initargs=(TILE.batch_app_vars(), stop_event),
+    ) as executor:
+        running = {
+            executor.submit(build_mask_worker, *mask, mesh_list, sea_level,
+                            tile_vars): mask[:2]
+            for mask in masks
+        }
+        while running:
+            (done, _) = concurrent.futures.wait(
+                running,
+                timeout=0.5,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                (til_x, til_y) = running.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    (mask_files, output) = future.result()
+                except Exception as e:
+                    UI.lvprint(0, "ERROR: Mask worker crashed :", e)
+                    UI.red_flag = True
+                    continue
+                print(output, end="")
+                save_mask(til_x, til_y, mask_files)
+                progress["done"] += 1
+                UI.progress_bar(
+                    progress["bar"], int(100 * progress["done"] / len(masks))
+                )
+            if UI.red_flag and not stop_event.is_set():
+                stop_event.set()
+                for future in running:
+                    future.cancel()
+################################################################################
+
 ################################################################################
 def select_neighbor_meshes(tile):
     mesh_list = []
@@ -248,16 +725,104 @@ def delete_old_masks_in_tile(tile, dest_dir):
 
     for til_x in range(til_x_min, til_x_max + 1, 16):
         for til_y in range(til_y_min, til_y_max + 1, 16):
-            try:
-                os.remove(
-                    os.path.join(dest_dir, FNAMES.legacy_mask(til_x, til_y))
-                )
-            except:
-                pass
+            file_names = [FNAMES.legacy_mask(til_x, til_y),
+                          FNAMES.distance_mask(til_x, til_y)]
+            delete_masks(dest_dir, file_names +
+                         [FNAMES.tiled_mask(name) for name in file_names])
+################################################################################
+
+################################################################################
+def read_masks_state(dest_dir):
+    """
+    Fingerprint of the inputs and names of the files of each mask built in
+    dest_dir, keyed by mask_key, None if unknown.
+    """
+    try:
+        with open(FNAMES.masks_state_file(dest_dir), "r") as f:
+            state = json.load(f)
+        if state.get("version") == masks_state_version:
+            return state["masks"]
+    except (OSError, ValueError, AttributeError, KeyError):
+        pass
+    return None
+################################################################################
+
+################################################################################
+def write_masks_state(dest_dir, masks_state):
+    state_file = FNAMES.masks_state_file(dest_dir)
+    try:
+        with open(state_file + ".tmp", "w") as f:
+            json.dump({"version": masks_state_version, "masks": masks_state},
+                      f, indent=1, sort_keys=True)
+        os.replace(state_file + ".tmp", state_file)
+    except OSError as e:
+        UI.vprint(1, "WARNING: Could not write the masks state file:", e)
+################################################################################
+
+################################################################################
+def mask_key(til_x, til_y):
+    return str(til_y) + "_" + str(til_x)
+################################################################################
+
+################################################################################
+def masks_inputs_digest(tile, mesh_list, sea_level):
+    """
+    Digest of what all masks of a tile depend on besides their own water
+    triangles : the mask variables, which meshes are around (their extent
+    is drawn as land) and the elevation and custom extent files.
+    """
+    variables = {
+        var: getattr(tile, var, None)
+        for var in list_mask_vars + ["ratio_water", "custom_dem",
+                                     "fill_nodata"]
+    }
+    variables["sea_level"] = sea_level
+    variables["masks_tiled_storage"] = masks_tiled_storage
+    variables["meshes"] = sorted(
+        os.path.basename(mesh_file_name) for mesh_file_name in mesh_list)
+    hasher = hashlib.sha256(
+        json.dumps({k: repr(v) for (k, v) in variables.items()},
+                   sort_keys=True).encode()
+    )
+    files = INCR.custom_extent_files(tile)
+    if tile.masks_use_DEM_too:
+        files += DEM.elevation_files(tile.lat, tile.lon, tile.custom_dem)
+    for file_name in files:
+        hasher.update(
+            (file_name + "=" + INCR.file_digest(file_name) + "\n").encode())
+    return hasher.hexdigest()
+################################################################################
+
+################################################################################
+def mask_fingerprint(inputs_digest, sea_tris, inland_tris):
+    hasher = hashlib.sha256(inputs_digest.encode())
+    for tris in (sea_tris, inland_tris):
+        tris = numpy.array(tris, dtype=numpy.float64)
+        hasher.update(str(tris.shape).encode())
+        hasher.update(tris.tobytes())
+    return hasher.hexdigest()
+################################################################################
+
+################################################################################
+def is_mask_unchanged(dest_dir, masks_state, key, fingerprints):
+    if key not in masks_state or masks_state[key][0] != fingerprints[key]:
+        return False
+    return all(os.path.isfile(os.path.join(dest_dir, file_name))
+               for file_name in masks_state[key][1])
+################################################################################
+
+################################################################################
+def delete_masks(dest_dir, file_names):
+    for file_name in file_names:
+        try:
+            os.remove(os.path.join(dest_dir, file_name))
+        except OSError:
+            pass
 ################################################################################
     
 ################################################################################
-def build_water_pre_mask(til_x, til_y, mesh_list, dico_sea, dico_inland,
+@TRACE.traced("build_water_pre_mask")
+def build_water_pre_mask(til_x, til_y, mesh_list, sea_tris, inland_tris,
                          sea_level, tile):
     (latm0, lonm0) = GEO.gtile_to_wgs84(til_x, til_y, tile.mask_zl)
     (px0, py0) = GEO.wgs84_to_pix(latm0, lonm0, tile.mask_zl)
@@ -291,44 +856,33 @@ def build_water_pre_mask(til_x, til_y, mesh_list, dico_sea, dico_inland,
         )
     # 3a)  We overwrite the white part of the mask with grey (ratio_water 
     # dependent) where inland water was detected in the first part above
-    if (til_x, til_y) in dico_inland:
-        for (lat1, lon1, lat2, lon2, lat3, lon3) in dico_inland[
-            (til_x, til_y)
-        ]:
-            (px1, py1) = GEO.wgs84_to_pix(lat1, lon1, tile.mask_zl)
-            (px2, py2) = GEO.wgs84_to_pix(lat2, lon2, tile.mask_zl)
-            (px3, py3) = GEO.wgs84_to_pix(lat3, lon3, tile.mask_zl)
-            px1 -= px0
-            px2 -= px0
-            px3 -= px0
-            py1 -= py0
-            py2 -= py0
-            py3 -= py0
-            mask_draw.polygon(
-                [(px1, py1), (px2, py2), (px3, py3)], fill=sea_level
-            )  # int(255*(1-tile.ratio_water)))
+    for xy in water_tris_pixels(inland_tris, px0, py0, tile).tolist():
+        mask_draw.polygon(xy, fill=sea_level)
     # 3b) We overwrite the white + grey part of the mask with black where 
     # sea water was detected in the first part above
-    for (lat1, lon1, lat2, lon2, lat3, lon3) in dico_sea[(til_x, til_y)]:
-        (px1, py1) = GEO.wgs84_to_pix(lat1, lon1, tile.mask_zl)
-        (px2, py2) = GEO.wgs84_to_pix(lat2, lon2, tile.mask_zl)
-        (px3, py3) = GEO.wgs84_to_pix(lat3, lon3, tile.mask_zl)
-        px1 -= px0
-        px2 -= px0
-        px3 -= px0
-        py1 -= py0
-        py2 -= py0
-        py3 -= py0
-        mask_draw.polygon(
-            [(px1, py1), (px2, py2), (px3, py3)], fill="black"
-        )
+    for xy in water_tris_pixels(sea_tris, px0, py0, tile).tolist():
+        mask_draw.polygon(xy, fill="black")
     del mask_draw
-    # mask_im=mask_im.convert("L")
     img_array = numpy.array(mask_im, dtype=numpy.uint8)
     return img_array
 ################################################################################
 
 ################################################################################
+def water_tris_pixels(tris, px0, py0, tile):
+    """
+    Rows (lat1, lon1, lat2, lon2, lat3, lon3) of tris as pixel coordinates
+    x1, y1, x2, y2, x3, y3 of the mask starting at pixel (px0, py0), all
+    projected at once.
+    """
+    tris = numpy.asarray(tris, dtype=numpy.float64).reshape(-1, 6)
+    (pix_x, pix_y) = GEO.wgs84_to_pix_array(
+        tris[:, 0::2], tris[:, 1::2], tile.mask_zl
+    )
+    return numpy.stack((pix_x - px0, pix_y - py0), axis=2).reshape(-1, 6)
+################################################################################
+
+################################################################################
+@TRACE.traced("build_dem_pre_mask")
 def build_dem_pre_mask(til_x, til_y, tile):
     (latm0, lonm0) = GEO.gtile_to_wgs84(til_x, til_y, tile.mask_zl)
     (px0, py0) = GEO.wgs84_to_pix(latm0, lonm0, tile.mask_zl)
@@ -391,260 +945,177 @@ def build_custom_pre_mask(til_x, til_y, sea_level, tile):
 ################################################################################
 
 ################################################################################
+def mesh_water_tris(mesh_file_name):
+    """
+    Water triangles of a mesh, as rows (lat1, lon1, lat2, lon2, lat3, lon3),
+    and their water bits (1 for inland water, 2 or more for sea water). The
+    last water_tris_cache_meshes meshes read are cached, so that the meshes
+    around the tiles of a batch are only read once.
+    """
+    key = (mesh_file_name, MESH.text_stamp(mesh_file_name))
+    with _water_tris_lock:
+        if key in _water_tris_cache:
+            _water_tris_cache.move_to_end(key)
+            return _water_tris_cache[key]
+    (
+        mesh_version,
+        nbr_pt_in,
+        pt_in,
+        nbr_tri_in,
+        tri_idx,
+        tri_types,
+    ) = MESH.read_mesh_file(mesh_file_name)
+    has_water = 7 if mesh_version >= 1.3 else 3
+    water = numpy.asarray(tri_types[:nbr_tri_in]) & has_water
+    is_water = water != 0
+    lat_lon = numpy.asarray(pt_in).reshape(-1, 5)[:, 1::-1]
+    tris = lat_lon[
+        numpy.asarray(tri_idx).reshape(-1, 3)[:nbr_tri_in][is_water]
+    ].reshape(-1, 6)
+    water_tris = (tris, water[is_water])
+    with _water_tris_lock:
+        _water_tris_cache[key] = water_tris
+        while len(_water_tris_cache) > water_tris_cache_meshes:
+            _water_tris_cache.popitem(last=False)
+    return water_tris
+################################################################################
+
+################################################################################
+def bucket_tris(tris, rows, cells_x, cells_y):
+    """
+    Dict of the rows of tris going to each mask cell, in their order in
+    tris, row rows[i] going to cell (cells_x[i], cells_y[i]).
+    """
+    order = numpy.lexsort((rows, cells_x, cells_y))
+    (rows, cells_x, cells_y) = (rows[order], cells_x[order], cells_y[order])
+    starts = numpy.flatnonzero(
+        numpy.diff(cells_x, prepend=-1) | numpy.diff(cells_y, prepend=-1)
+    )
+    return {
+        (int(cells_x[start]), int(cells_y[start])): tris[cell_rows]
+        for (start, cell_rows) in zip(
+            starts.tolist(), numpy.split(rows, starts[1:])
+        )
+    }
+################################################################################
+
+################################################################################
+@TRACE.traced("record_water_tris")
 def record_water_tris(tile):
-    mesh_list = []
-    for close_lat in range(tile.lat - 1, tile.lat + 2):
-        for close_lon in range(tile.lon - 1, tile.lon + 2):
-            close_build_dir = (
-                tile.build_dir
-                if tile.grouped
-                else tile.build_dir.replace(
-                    FNAMES.tile_dir(tile.lat, tile.lon),
-                    FNAMES.tile_dir(close_lat, close_lon),
-                )
-            )
-            close_mesh_file_name = FNAMES.mesh_file(
-                close_build_dir, close_lat, close_lon
-            )
-            if os.path.isfile(close_mesh_file_name):
-                mesh_list.append(close_mesh_file_name)
-    ####################
-    dico_sea = {}
-    dico_inland = {}
-    ####################
+    """
+    Sea and inland water triangles of the meshes around the tile, bucketed
+    by mask cell. Sea triangles also go to the neighbour cells when they are
+    within a quarter of a cell from them (as the masks are blurred beyond
+    their own cell), inland ones only to their own cell, and only if it has
+    sea triangles (else use_masks_for_inland makes them sea triangles).
+    """
     [til_x_min, til_y_min] = GEO.wgs84_to_orthogrid(
         tile.lat + 1, tile.lon, tile.mask_zl
     )
     [til_x_max, til_y_max] = GEO.wgs84_to_orthogrid(
         tile.lat, tile.lon + 1, tile.mask_zl
     )
-    UI.vprint(1, "-> Deleting existing masks")
-    for til_x in range(til_x_min, til_x_max + 1, 16):
-        for til_y in range(til_y_min, til_y_max + 1, 16):
-            try:
-                os.remove(
-                    os.path.join(dest_dir, FNAMES.legacy_mask(til_x, til_y))
-                )
-            except:
-                pass
-    UI.vprint(1, "-> Reading mesh data")
-    for mesh_file_name in mesh_list:
+    sea_tris = []
+    inland_tris = []
+    for mesh_file_name in select_neighbor_meshes(tile):
+        if UI.red_flag:
+            return ({}, {})
         try:
-            f_mesh = open(mesh_file_name, "r")
+            (tris, water) = mesh_water_tris(mesh_file_name)
             UI.vprint(1, "   * ", mesh_file_name)
         except:
             UI.lvprint(
                 1, "Mesh file ", mesh_file_name, " could not be read. Skipped."
             )
             continue
-        mesh_version = float(f_mesh.readline().strip().split()[-1])
-        has_water = 7 if mesh_version >= 1.3 else 3
-        for i in range(3):
-            f_mesh.readline()
-        nbr_pt_in = int(f_mesh.readline())
-        pt_in = numpy.zeros(5 * nbr_pt_in, "float")
-        for i in range(0, nbr_pt_in):
-            pt_in[5 * i : 5 * i + 3] = [
-                float(x) for x in f_mesh.readline().split()[:3]
-            ]
-        for i in range(0, 3):
-            f_mesh.readline()
-        for i in range(0, nbr_pt_in):
-            pt_in[5 * i + 3 : 5 * i + 5] = [
-                float(x) for x in f_mesh.readline().split()[:2]
-            ]
-        for i in range(0, 2):  # skip 2 lines
-            f_mesh.readline()
-        nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
-        step_stones = nbr_tri_in // 100
-        percent = -1
-        UI.vprint(
-            2,
-            " Attribution process of masks buffers to water triangles for "
-            + str(mesh_file_name)
-            + ".",
+        if tile.use_masks_for_inland:
+            sea_tris.append(tris)
+        else:
+            sea_tris.append(tris[water >= 2])
+            inland_tris.append(tris[water == 1])
+    dico_sea = {}
+    dico_inland = {}
+    for (kind, tris) in (("sea", sea_tris), ("inland", inland_tris)):
+        tris = numpy.concatenate(tris) if tris else numpy.zeros((0, 6))
+        bary_lat = (tris[:, 0] + tris[:, 2] + tris[:, 4]) / 3
+        bary_lon = (tris[:, 1] + tris[:, 3] + tris[:, 5]) / 3
+        (til_x, til_y) = GEO.wgs84_to_orthogrid_array(
+            bary_lat, bary_lon, tile.mask_zl
+        )
+        rows = numpy.flatnonzero(
+            (til_x >= til_x_min - 16)
+            & (til_x <= til_x_max + 16)
+            & (til_y >= til_y_min - 16)
+            & (til_y <= til_y_max + 16)
+        )
+        (til_x, til_y) = (til_x[rows], til_y[rows])
+        if kind == "inland":
+            dico_inland = {
+                cell: cell_tris
+                for (cell, cell_tris) in bucket_tris(
+                    tris, rows, til_x, til_y
+                ).items()
+                if cell in dico_sea
+            }
+            break
+        # triangles in the first or last quarter of their cell also go to
+        # the neighbour cell(s) on that side
+        (til_x2, til_y2) = GEO.wgs84_to_orthogrid_array(
+            bary_lat[rows], bary_lon[rows], tile.mask_zl + 2
+        )
+        quarter_x = (til_x2 // 16) % 4
+        quarter_y = (til_y2 // 16) % 4
+        shift_x = numpy.select([quarter_x == 0, quarter_x == 3], [-16, 16])
+        shift_y = numpy.select([quarter_y == 0, quarter_y == 3], [-16, 16])
+        near_x = numpy.flatnonzero(shift_x)
+        near_y = numpy.flatnonzero(shift_y)
+        near_xy = numpy.flatnonzero((shift_x != 0) & (shift_y != 0))
+        dico_sea = bucket_tris(
+            tris,
+            numpy.concatenate(
+                (rows, rows[near_x], rows[near_y], rows[near_xy])
+            ),
+            numpy.concatenate((
+                til_x,
+                til_x[near_x] + shift_x[near_x],
+                til_x[near_y],
+                til_x[near_xy] + shift_x[near_xy],
+            )),
+            numpy.concatenate((
+                til_y,
+                til_y[near_x],
+                til_y[near_y] + shift_y[near_y],
+                til_y[near_xy] + shift_y[near_xy],
+            )),
         )
-        for i in range(0, nbr_tri_in):
-            if i % step_stones == 0:
-                percent += 1
-                UI.progress_bar(1, int(percent * 5 / 10))
-                if UI.red_flag:
-                    UI.exit_message_and_bottom_line()
-                    return 0
-            (n1, n2, n3, tri_type) = [
-                int(x) - 1 for x in f_mesh.readline().split()[:4]
-            ]
-            tri_type += 1
-            if (
-                (not tri_type)
-                or (not (tri_type & has_water))
-                or (
-                    (tri_type & has_water) < 2 and not tile.use_masks_for_inland
-                )
-            ):
-                continue
-            (lon1, lat1) = pt_in[5 * n1 : 5 * n1 + 2]
-            (lon2, lat2) = pt_in[5 * n2 : 5 * n2 + 2]
-            (lon3, lat3) = pt_in[5 * n3 : 5 * n3 + 2]
-            bary_lat = (lat1 + lat2 + lat3) / 3
-            bary_lon = (lon1 + lon2 + lon3) / 3
-            (til_x, til_y) = GEO.wgs84_to_orthogrid(
-                bary_lat, bary_lon, tile.mask_zl
-            )
-            if (
-                til_x < til_x_min - 16
-                or til_x > til_x_max + 16
-                or til_y < til_y_min - 16
-                or til_y > til_y_max + 16
-            ):
-                continue
-            (til_x2, til_y2) = GEO.wgs84_to_orthogrid(
-                bary_lat, bary_lon, tile.mask_zl + 2
-            )
-            a = (til_x2 // 16) % 4
-            b = (til_y2 // 16) % 4
-            if (til_x, til_y) in dico_sea:
-                dico_sea[(til_x, til_y)].append(
-                    (lat1, lon1, lat2, lon2, lat3, lon3)
-                )
-            else:
-                dico_sea[(til_x, til_y)] = [
-                    (lat1, lon1, lat2, lon2, lat3, lon3)
-                ]
-            if a == 0:
-                if (til_x - 16, til_y) in dico_sea:
-                    dico_sea[(til_x - 16, til_y)].append(
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    )
-                else:
-                    dico_sea[(til_x - 16, til_y)] = [
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    ]
-                if b == 0:
-                    if (til_x - 16, til_y - 16) in dico_sea:
-                        dico_sea[(til_x - 16, til_y - 16)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_sea[(til_x - 16, til_y - 16)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-                elif b == 3:
-                    if (til_x - 16, til_y + 16) in dico_sea:
-                        dico_sea[(til_x - 16, til_y + 16)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_sea[(til_x - 16, til_y + 16)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-            elif a == 3:
-                if (til_x + 16, til_y) in dico_sea:
-                    dico_sea[(til_x + 16, til_y)].append(
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    )
-                else:
-                    dico_sea[(til_x + 16, til_y)] = [
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    ]
-                if b == 0:
-                    if (til_x + 16, til_y - 16) in dico_sea:
-                        dico_sea[(til_x + 16, til_y - 16)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_sea[(til_x + 16, til_y - 16)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-                elif b == 3:
-                    if (til_x + 16, til_y + 16) in dico_sea:
-                        dico_sea[(til_x + 16, til_y + 16)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_sea[(til_x + 16, til_y + 16)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-            if b == 0:
-                if (til_x, til_y - 16) in dico_sea:
-                    dico_sea[(til_x, til_y - 16)].append(
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    )
-                else:
-                    dico_sea[(til_x, til_y - 16)] = [
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    ]
-            elif b == 3:
-                if (til_x, til_y + 16) in dico_sea:
-                    dico_sea[(til_x, til_y + 16)].append(
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    )
-                else:
-                    dico_sea[(til_x, til_y + 16)] = [
-                        (lat1, lon1, lat2, lon2, lat3, lon3)
-                    ]
-        f_mesh.close()
-        if not tile.use_masks_for_inland:
-            UI.vprint(2, "   Taking care of inland water near shoreline")
-            f_mesh = open(mesh_file_name, "r")
-            for i in range(0, 4):
-                f_mesh.readline()
-            nbr_pt_in = int(f_mesh.readline())
-            for i in range(0, 2 * nbr_pt_in + 5):
-                f_mesh.readline()
-            nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
-            step_stones = nbr_tri_in // 100
-            percent = -1
-            for i in range(0, nbr_tri_in):
-                if i % step_stones == 0:
-                    percent += 1
-                    UI.progress_bar(1, int(percent * 5 / 10))
-                    if UI.red_flag:
-                        UI.exit_message_and_bottom_line()
-                        return 0
-                (n1, n2, n3, tri_type) = [
-                    int(x) - 1 for x in f_mesh.readline().split()[:4]
-                ]
-                tri_type += 1
-                if not (tri_type & has_water) == 1:
-                    continue
-                (lon1, lat1) = pt_in[5 * n1 : 5 * n1 + 2]
-                (lon2, lat2) = pt_in[5 * n2 : 5 * n2 + 2]
-                (lon3, lat3) = pt_in[5 * n3 : 5 * n3 + 2]
-                bary_lat = (lat1 + lat2 + lat3) / 3
-                bary_lon = (lon1 + lon2 + lon3) / 3
-                (til_x, til_y) = GEO.wgs84_to_orthogrid(
-                    bary_lat, bary_lon, tile.mask_zl
-                )
-                if (
-                    til_x < til_x_min - 16
-                    or til_x > til_x_max + 16
-                    or til_y < til_y_min - 16
-                    or til_y > til_y_max + 16
-                ):
-                    continue
-                (til_x2, til_y2) = GEO.wgs84_to_orthogrid(
-                    bary_lat, bary_lon, tile.mask_zl + 2
-                )
-                a = (til_x2 // 16) % 4
-                b = (til_y2 // 16) % 4
-                # Here an inland water tri is added ONLY if sea water tri were 
-                # already added for this mask extent
-                if (til_x, til_y) in dico_sea:
-                    if (til_x, til_y) in dico_inland:
-                        dico_inland[(til_x, til_y)].append(
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        )
-                    else:
-                        dico_inland[(til_x, til_y)] = [
-                            (lat1, lon1, lat2, lon2, lat3, lon3)
-                        ]
-            f_mesh.close()
-    
     return (dico_sea, dico_inland)
 ################################################################################
         
 ################################################################################
+def erf_array(x):
+    return numpy.vectorize(erf, otypes=[numpy.float64])(x)
+
+
+################################################################################
+def apply_distance_profile(img_array, profile, steps_per_pixel, land=None):
+    """
+    Sea pixels (value 0) of img_array replaced by profile[d], where d is their
+    distance to the closest non zero pixel, in units of 1/steps_per_pixel
+    pixel and capped to the last entry of the profile. Other pixels are set
+    to land, or kept if it is None.
+    """
+    distances = FILTER.distance_transform(img_array > 0)
+    numpy.multiply(distances, steps_per_pixel, out=distances)
+    numpy.minimum(distances, len(profile) - 1, out=distances)
+    return numpy.where(
+        img_array == 0,
+        profile[distances.astype(numpy.int32)],
+        img_array if land is None else land,
+    ).astype(numpy.uint8)
+
+
+################################################################################
+@TRACE.traced("blur_mask")
 def blur_mask(img_array, tile, sea_level):
     ##########################################
     def transition_profile(ratio, ttype):
@@ -665,49 +1136,30 @@ def blur_mask(img_array, tile, sea_level):
     # Sand mode
     if tile.masking_mode == "sand" and blur_width:
         # convolution with a hat function
-        b_img_array = numpy.array(img_array)
-        kernel = numpy.array(range(1, 2 * blur_width))
-        kernel[blur_width:] = range(blur_width - 1, 0, -1)
-        kernel = kernel / blur_width ** 2
-        for i in range(0, len(b_img_array)):
-            b_img_array[i] = numpy.convolve(b_img_array[i], kernel, "same")
-        b_img_array = b_img_array.transpose()
-        for i in range(0, len(b_img_array)):
-            b_img_array[i] = numpy.convolve(b_img_array[i], kernel, "same")
-        b_img_array = b_img_array.transpose()
+        b_img_array = FILTER.hat_filter(img_array, blur_width, numpy.uint8)
         b_img_array = 2 * numpy.minimum(b_img_array, 127)
         b_img_array = numpy.array(b_img_array, dtype=numpy.uint8)
     # Rocks mode
     elif tile.masking_mode == "rocks" and blur_width:
-        # slight increase of the mask, then gaussian blur, nonlinear map and
-        # a tiny bit of smoothing again on a short scale along the shore
-        b_img_array = (
-            numpy.array(
-                Image.fromarray(img_array)
-                .convert("L")
-                .filter(ImageFilter.GaussianBlur(blur_width / 1.7)),
-                dtype=numpy.uint8,
-            )
-            > 0
-        ).astype(numpy.uint8) * 255
-        # blur it
-        b_img_array = numpy.array(
-            Image.fromarray(b_img_array)
-            .convert("L")
-            .filter(ImageFilter.GaussianBlur(blur_width)),
-            dtype=numpy.uint8,
+        # the former slight increase of the mask, gaussian blur and nonlinear
+        # map, as a function of the distance to the shore : a gaussian blur
+        # of width w of a shore moved by dilation pixels is a normal
+        # distribution function of (dilation - distance) / w
+        dilation = 2.5 * blur_width / 1.7
+        # (the last entry stands for land pixels)
+        distances = numpy.arange(ceil(dilation + 5 * blur_width) * 4 + 1) / 4
+        distances[-1] = -numpy.inf
+        blurred = numpy.round(
+            127.5
+            * (1 + erf_array((dilation - distances) / (blur_width * 2 ** 0.5)))
         )
         # nonlinear transform to make the transition quicker at the shore 
         # (gaussian is too flat)
         gamma = 2.5
-        b_img_array = (
+        profile = (
             (
                 (
-                    numpy.tan(
-                        (b_img_array.astype(numpy.float32) - 127.5)
-                        / 128
-                        * atan(3)
-                    )
+                    numpy.tan((blurred - 127.5) / 128 * atan(3))
                     - numpy.tan(-127.5 / 128 * atan(3))
                 )
                 * 254
@@ -716,6 +1168,9 @@ def blur_mask(img_array, tile, sea_level):
             ** gamma
             / (255 ** (gamma - 1))
         ).astype(numpy.uint8)
+        b_img_array = apply_distance_profile(
+            img_array, profile[:-1], 4, profile[-1]
+        )
         # still some slight smoothing at the shore
         b_img_array = numpy.maximum(
             b_img_array,
@@ -729,73 +1184,37 @@ def blur_mask(img_array, tile, sea_level):
     # 3 steps
     elif tile.masking_mode == "3steps":
         # why trying something so complicated...
-        transin = blur_width[0]
-        midzone = blur_width[1]
-        transout = blur_width[2]
+        (transin, midzone, transout) = blur_width
         shore_level = 255
-        b_img_array = b_mask_array = numpy.array(img_array)
+        # profile of the sea pixels as a function of their distance to the
+        # shore, by quarters of pixels
+        distances = numpy.arange(ceil(transin + midzone + transout + 1) * 4) / 4
+        profile = numpy.zeros(len(distances))
         # First the transition at the shore
         # We go from shore_level to sea_level in transin meters
-        stepsin = int(transin / 3)
-        for i in range(stepsin):
-            value = shore_level + transition_profile(
-                (i + 1) / stepsin, "parabolic"
-            ) * (sea_level - shore_level)
-            b_mask_array = (
-                numpy.array(
-                    Image.fromarray(b_mask_array)
-                    .convert("L")
-                    .filter(ImageFilter.GaussianBlur(1)),
-                    dtype=numpy.uint8,
-                )
-                > 0
-            ).astype(numpy.uint8) * 255
-            b_img_array[(b_img_array == 0) * (b_mask_array != 0)] = value
-            UI.vprint(2, value)
+        zone = distances <= transin
+        profile[zone] = shore_level + transition_profile(
+            distances[zone] / max(transin, 1e-6), "parabolic"
+        ) * (sea_level - shore_level)
         # Next the intermediate zone at constant transparency
-        sea_b_radius = midzone / 3
-        sea_b_radius_buffered = (midzone + transout) / 3
-        b_mask_array = (
-            numpy.array(
-                Image.fromarray(b_mask_array)
-                .convert("L")
-                .filter(ImageFilter.GaussianBlur(sea_b_radius_buffered)),
-                dtype=numpy.uint8,
-            )
-            > 0
-        ).astype(numpy.uint8) * 255
-        b_mask_array = (
-            numpy.array(
-                Image.fromarray(b_mask_array)
-                .convert("L")
-                .filter(
-                    ImageFilter.GaussianBlur(
-                        sea_b_radius_buffered - sea_b_radius
-                    )
-                ),
-                dtype=numpy.uint8,
-            )
-            == 255
-        ).astype(numpy.uint8) * 255
-        b_img_array[(b_img_array == 0) * (b_mask_array != 0)] = sea_level
+        zone = (distances > transin) & (distances <= transin + midzone)
+        profile[zone] = sea_level
         # Finally the transition to the X-Plane sea
         # We go from sea_level to 0 in transout meters
-        stepsout = int(transout / 3)
-        for i in range(stepsout):
-            value = sea_level * (
-                1 - transition_profile((i + 1) / stepsout, "linear")
+        zone = distances > transin + midzone
+        profile[zone] = sea_level * (
+            1
+            - transition_profile(
+                numpy.minimum(
+                    (distances[zone] - transin - midzone) / max(transout, 1e-6),
+                    1,
+                ),
+                "linear",
             )
-            b_mask_array = (
-                numpy.array(
-                    Image.fromarray(b_mask_array)
-                    .convert("L")
-                    .filter(ImageFilter.GaussianBlur(1)),
-                    dtype=numpy.uint8,
-                )
-                > 0
-            ).astype(numpy.uint8) * 255
-            b_img_array[(b_img_array == 0) * (b_mask_array != 0)] = value
-            UI.vprint(2, value)
+        )
+        b_img_array = apply_distance_profile(
+            img_array, numpy.round(profile).astype(numpy.uint8), 4
+        )
         # To smoothen the thresolding introduced above we do a global short 
         # extent gaussian blur
         b_img_array = numpy.array(
@@ -1024,17 +1443,9 @@ if __name__ == "__main__":
     if mask_width:
         mask_width += 1
         UI.vprint(1, "Blur of the mask...")
-        img_array = numpy.array(mask_im, dtype=numpy.uint8)
-        kernel = numpy.ones(int(mask_width)) / int(mask_width)
-        kernel = numpy.array(range(1, 2 * mask_width))
-        kernel[mask_width:] = range(mask_width - 1, 0, -1)
-        kernel = kernel / mask_width ** 2
-        for i in range(0, len(img_array)):
-            img_array[i] = numpy.convolve(img_array[i], kernel, "same")
-        img_array = img_array.transpose()
-        for i in range(0, len(img_array)):
-            img_array[i] = numpy.convolve(img_array[i], kernel, "same")
-        img_array = img_array.transpose()
+        img_array = FILTER.hat_filter(
+            numpy.array(mask_im, dtype=numpy.uint8), mask_width, numpy.uint8
+        )
         img_array[img_array >= 128] = 255
         img_array[img_array < 128] *= 2
         img_array = numpy.array(img_array, dtype=numpy.uint8)
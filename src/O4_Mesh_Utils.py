@@ -1,13 +1,17 @@
+import itertools
 import time
 import sys
 import os
 import pickle
+import struct
 import subprocess
 import numpy
 import requests
-from math import sqrt, cos, pi
+from math import sqrt, cos, pi, floor
 import O4_DEM_Utils as DEM
 import O4_UI_Utils as UI
+import O4_Trace_Utils as TRACE
+import O4_Incremental_Utils as INCR
 import O4_File_Names as FNAMES
 import O4_Geo_Utils as GEO
 import O4_Vector_Utils as VECT
@@ -229,142 +233,112 @@ def build_curv_tol_weight_map(tile, weight_array):
 
 
 ################################################################################
+@TRACE.traced("post_process_nodes_altitudes")
 def post_process_nodes_altitudes(tile):
     dico_attributes = VECT.Vector_Map.dico_attributes
     f_node = open(FNAMES.output_node_file(tile), "r")
     init_line_f_node = f_node.readline()
     nbr_pt = int(init_line_f_node.split()[0])
-    vertices = numpy.zeros(6 * nbr_pt)
     UI.vprint(1, "-> Loading of the mesh computed by Triangle4XP.")
-    for i in range(0, nbr_pt):
-        vertices[6 * i : 6 * i + 6] = [
-            float(x) for x in f_node.readline().split()[1:7]
-        ]
+    # node lines are "index x y alt nx ny alt_interp [boundary marker]"
+    vertices = numpy.ascontiguousarray(
+        read_mesh_block(f_node, nbr_pt, 7, numpy.float64)[:, 1:]
+    )
     end_line_f_node = f_node.readline()
     f_node.close()
     UI.vprint(1, "-> Post processing of altitudes according to vector data")
     f_ele = open(FNAMES.output_ele_file(tile), "r")
     nbr_tri = int(f_ele.readline().split()[0])
-    water_tris = set()
-    sea_tris = set()
-    interp_alt_tris = set()
-    for i in range(nbr_tri):
-        line = f_ele.readline()
-        # triangle attributes are powers of 2, except for the dummy attributed
-        # which doesn't require post-treatment
-        if line[-2] == "0":
-            continue
-        (v1, v2, v3, attr) = [int(x) - 1 for x in line.split()[1:5]]
-        attr += 1
-        if attr >= dico_attributes["INTERP_ALT"]:
-            interp_alt_tris.add((v1, v2, v3))
-        elif attr & dico_attributes["SEA"]:
-            sea_tris.add((v1, v2, v3))
-        elif (
-            attr & dico_attributes["WATER"]
-            or attr & dico_attributes["SEA_EQUIV"]
-        ):
-            water_tris.add((v1, v2, v3))
+    tris = read_mesh_block(f_ele, nbr_tri, 5, numpy.float64).astype(
+        numpy.int64
+    )
+    f_ele.close()
+    attrs = tris[:, 4]
+    tris = tris[:, 1:4] - 1
+    # triangle attributes are powers of 2, except for the dummy attributed
+    # which doesn't require post-treatment (the test was historically made
+    # on the last digit of the attribute)
+    treated = attrs % 10 != 0
+    interp_alt = treated & (attrs >= dico_attributes["INTERP_ALT"])
+    sea = treated & ~interp_alt & (attrs & dico_attributes["SEA"] != 0)
+    water = (
+        treated
+        & ~interp_alt
+        & ~sea
+        & (
+            attrs & (dico_attributes["WATER"] | dico_attributes["SEA_EQUIV"])
+            != 0
+        )
+    )
+    altitudes = vertices[:, 2]
     if tile.water_smoothing:
         UI.vprint(1, "   Smoothing inland water.")
-        for j in range(tile.water_smoothing):
-            for v1, v2, v3 in water_tris:
-                zmean = (
-                    vertices[6 * v1 + 2]
-                    + vertices[6 * v2 + 2]
-                    + vertices[6 * v3 + 2]
-                ) / 3
-                vertices[6 * v1 + 2] = zmean
-                vertices[6 * v2 + 2] = zmean
-                vertices[6 * v3 + 2] = zmean
+        smooth_altitudes(altitudes, tris[water], tile.water_smoothing)
     UI.vprint(1, "   Smoothing of sea water.")
-    for v1, v2, v3 in sea_tris:
-        if tile.sea_smoothing_mode == "zero":
-            vertices[6 * v1 + 2] = 0
-            vertices[6 * v2 + 2] = 0
-            vertices[6 * v3 + 2] = 0
-        elif tile.sea_smoothing_mode == "mean":
-            zmean = (
-                vertices[6 * v1 + 2]
-                + vertices[6 * v2 + 2]
-                + vertices[6 * v3 + 2]
-            ) / 3
-            vertices[6 * v1 + 2] = zmean
-            vertices[6 * v2 + 2] = zmean
-            vertices[6 * v3 + 2] = zmean
-        else:
-            vertices[6 * v1 + 2] = max(vertices[6 * v1 + 2], 0)
-            vertices[6 * v2 + 2] = max(vertices[6 * v2 + 2], 0)
-            vertices[6 * v3 + 2] = max(vertices[6 * v3 + 2], 0)
+    sea_tris = tris[sea]
+    if tile.sea_smoothing_mode == "zero":
+        altitudes[sea_tris.ravel()] = 0
+    elif tile.sea_smoothing_mode == "mean":
+        smooth_altitudes(altitudes, sea_tris, 1)
+    else:
+        sea_nodes = numpy.unique(sea_tris)
+        altitudes[sea_nodes] = numpy.maximum(altitudes[sea_nodes], 0)
     UI.vprint(1, "   Treatment of airports, roads and patches.")
-    for v1, v2, v3 in interp_alt_tris:
-        vertices[6 * v1 + 2] = vertices[6 * v1 + 5]
-        vertices[6 * v2 + 2] = vertices[6 * v2 + 5]
-        vertices[6 * v3 + 2] = vertices[6 * v3 + 5]
-        vertices[6 * v1 + 3] = 0
-        vertices[6 * v2 + 3] = 0
-        vertices[6 * v3 + 3] = 0
-        vertices[6 * v1 + 4] = 0
-        vertices[6 * v2 + 4] = 0
-        vertices[6 * v3 + 4] = 0
-    UI.vprint(1, "-> Writing output nodes file.")
-    f_node = open(FNAMES.output_node_file(tile), "w")
-    f_node.write(init_line_f_node)
-    for i in range(0, nbr_pt):
-        f_node.write(
-            str(i + 1)
-            + " "
-            + " ".join(
-                ("{:.15f}".format(x) for x in vertices[6 * i : 6 * i + 6])
-            )
-            + "\n"
+    interp_alt_nodes = numpy.unique(tris[interp_alt])
+    vertices[interp_alt_nodes, 2] = vertices[interp_alt_nodes, 5]
+    vertices[interp_alt_nodes, 3:5] = 0
+    if not UI.cleaning_level:
+        # otherwise it is removed as soon as the mesh file is written
+        UI.vprint(1, "-> Writing output nodes file.")
+        f_node = open(FNAMES.output_node_file(tile), "w")
+        f_node.write(init_line_f_node)
+        write_mesh_block(
+            f_node,
+            numpy.column_stack((numpy.arange(1, nbr_pt + 1), vertices)),
+            "%d" + " %.15f" * 6 + "\n",
         )
-    f_node.write(end_line_f_node)
-    f_node.close()
-    return vertices
+        f_node.write(end_line_f_node)
+        f_node.close()
+    return (vertices.ravel(), numpy.column_stack((tris, attrs)))
 
 
 ################################################################################
-def write_mesh_file(tile, vertices):
-    UI.vprint(
-        1,
-        "-> Writing final mesh to the file "
-        + FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon),
-    )
-    f_ele = open(FNAMES.output_ele_file(tile), "r")
-    nbr_vert = len(vertices) // 6
-    nbr_tri = int(f_ele.readline().split()[0])
-    f = open(FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon), "w")
-    f.write("MeshVersionFormatted 2\n")
-    f.write("Dimension 3\n\n")
-    f.write("Vertices\n")
-    f.write(str(nbr_vert) + "\n")
-    for i in range(0, nbr_vert):
-        f.write(
-            "{:.15f}".format(vertices[6 * i] + tile.lon)
-            + " "
-            + "{:.15f}".format(vertices[6 * i + 1] + tile.lat)
-            + " "
-            + "{:.15f}".format(vertices[6 * i + 2] / 100000)
-            + " 0\n"
+def smooth_altitudes(altitudes, tris, iterations):
+    """
+    Mean smoothing of the altitudes over the (n,3) array of node indices
+    tris: at each iteration, every node of tris gets the average of the
+    mean altitudes of the triangles it belongs to.
+    """
+    if not len(tris):
+        return
+    nodes = tris.ravel()
+    counts = numpy.bincount(nodes, minlength=len(altitudes))
+    touched = counts > 0
+    for _ in range(iterations):
+        zmean = altitudes[tris].mean(axis=1)
+        sums = numpy.bincount(
+            nodes, weights=numpy.repeat(zmean, 3), minlength=len(altitudes)
         )
-    f.write("\n")
-    f.write("Normals\n")
-    f.write(str(nbr_vert) + "\n")
-    for i in range(0, nbr_vert):
-        f.write(
-            "{:.2f}".format(vertices[6 * i + 3])
-            + " "
-            + "{:.2f}".format(vertices[6 * i + 4])
-            + " 0\n"
-        )
-    f.write("\n")
-    f.write("Triangles\n")
-    f.write(str(nbr_tri) + "\n")
-    for i in range(0, nbr_tri):
-        f.write(" ".join(f_ele.readline().split()[1:]) + "\n")
-    f_ele.close()
-    f.close()
+        altitudes[touched] = sums[touched] / counts[touched]
+    return
+
+
+################################################################################
+@TRACE.traced("write_mesh_file")
+def write_mesh_file(tile, vertices, triangles):
+    """
+    vertices is the flat array returned by post_process_nodes_altitudes,
+    triangles the (nbr_tri, 4) array of 0-based node indices and attributes.
+    """
+    mesh_file = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+    UI.vprint(1, "-> Writing final mesh to the file " + mesh_file)
+    node_coords = numpy.empty((len(vertices) // 6, 5))
+    node_coords[:, 0] = vertices[0::6] + tile.lon
+    node_coords[:, 1] = vertices[1::6] + tile.lat
+    node_coords[:, 2] = vertices[2::6]
+    node_coords[:, 3] = vertices[3::6]
+    node_coords[:, 4] = vertices[4::6]
+    write_mesh(mesh_file, 2, node_coords, triangles, tile.lat, tile.lon)
     return
 
 
@@ -386,29 +360,11 @@ def extract_mesh_to_obj(
     mtl_file_name = FNAMES.mtl_file(
         til_x_left, til_y_top, zoomlevel, provider_code
     )
-    f_mesh = open(mesh_file, "r")
-    for i in range(4):
-        f_mesh.readline()
-    nbr_pt_in = int(f_mesh.readline())
-    UI.vprint(1, "    Reading nodes...")
-    pt_in = numpy.zeros(5 * nbr_pt_in, "float")
-    for i in range(nbr_pt_in):
-        pt_in[5 * i : 5 * i + 3] = [
-            float(x) for x in f_mesh.readline().split()[:3]
-        ]
-    for i in range(3):
-        f_mesh.readline()
-    for i in range(nbr_pt_in):
-        pt_in[5 * i + 3 : 5 * i + 5] = [
-            float(x) for x in f_mesh.readline().split()[:2]
-        ]
-    for i in range(0, 2):  # skip 2 lines
-        f_mesh.readline()
+    UI.vprint(1, "    Reading mesh...")
+    (_, nbr_pt_in, pt_in, nbr_tri_in, tri_idx, _) = read_mesh_file(mesh_file)
     if UI.red_flag:
         UI.exit_message_and_bottom_line()
         return 0
-    UI.vprint(1, "    Reading triangles...")
-    nbr_tri_in = int(f_mesh.readline())  # read nbr of tris
     textured_nodes = {}
     textured_nodes_inv = {}
     nodes_st_coord = {}
@@ -416,7 +372,7 @@ def extract_mesh_to_obj(
     dico_new_tri = {}
     len_dico_new_tri = 0
     for i in range(0, nbr_tri_in):
-        (n1, n2, n3) = [int(x) - 1 for x in f_mesh.readline().split()[:3]]
+        (n1, n2, n3) = tri_idx[3 * i : 3 * i + 3]
         (lon1, lat1, z1, u1, v1) = pt_in[5 * n1 : 5 * n1 + 5]
         (lon2, lat2, z2, u2, v2) = pt_in[5 * n2 : 5 * n2 + 5]
         (lon3, lat3, z3, u3, v3) = pt_in[5 * n3 : 5 * n3 + 5]
@@ -470,7 +426,7 @@ def extract_mesh_to_obj(
             + " "
             + "{:.9f}".format(pt_in[5 * j + 1] - latmin)
             + " "
-            + "{:.9f}".format(pt_in[5 * j + 2])
+            + "{:.9f}".format(pt_in[5 * j + 2] / 100000)
             + "\n"
         )
     f.write("\n")
@@ -522,7 +478,6 @@ def extract_mesh_to_obj(
             + str(three)
             + "\n"
         )
-    f_mesh.close()
     f.close()
     # then the mtl file
     f = open(mtl_file_name, "w")
@@ -539,6 +494,8 @@ def extract_mesh_to_obj(
 
 
 ################################################################################
+@INCR.skip_if_unchanged("mesh")
+@TRACE.traced_step("Step 2")
 def build_mesh(tile):
     if UI.is_working:
         return 0
@@ -687,6 +644,7 @@ def build_mesh(tile):
     del tile.dem  # for machines with not much RAM, we do not need it anymore
     tile.dem = None
     UI.vprint(1, "-> Start of the mesh algorithm Triangle4XP.")
+    TRACE.begin("Triangle4XP")
     UI.vprint(2, "   Mesh command:", " ".join(mesh_cmd))
     fingers_crossed = subprocess.Popen(
         mesh_cmd, stdout=subprocess.PIPE, bufsize=0
@@ -736,18 +694,19 @@ def build_mesh(tile):
                 ".\n",
             )
             return 0
+    TRACE.end()
 
     if UI.red_flag:
         UI.exit_message_and_bottom_line()
         return 0
 
-    vertices = post_process_nodes_altitudes(tile)
+    (vertices, triangles) = post_process_nodes_altitudes(tile)
 
     if UI.red_flag:
         UI.exit_message_and_bottom_line()
         return 0
 
-    write_mesh_file(tile, vertices)
+    write_mesh_file(tile, vertices, triangles)
     #
     if UI.cleaning_level:
         try:
@@ -790,6 +749,11 @@ def sort_mesh(tile):
     UI.is_working = 1
     UI.red_flag = False
     mesh_file = FNAMES.mesh_file(tile.build_dir, tile.lat, tile.lon)
+    if not os.path.isfile(mesh_file) and os.path.isfile(
+        FNAMES.mesh_bin_file(mesh_file)
+    ):
+        UI.vprint(1, "-> Converting the binary mesh file to text.")
+        mesh_bin_to_text(mesh_file)
     if not os.path.isfile(mesh_file):
         UI.exit_message_and_bottom_line("\nERROR: Could not find ", mesh_file)
         return 0
@@ -847,6 +811,71 @@ def triangulate(name, path_to_Ortho4XP_dir):
 
 ##############################################################################
 def read_mesh_file(mesh_file):
+    """
+    Read a mesh, from its binary companion file when it is up to date, else
+    from the text file (writing the binary companion for the next readers).
+
+    :returns: (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx,
+        tri_types) with node_coords interleaved as lon, lat, alt (meters),
+        normal x, normal y and tri_idx 0-based
+    """
+    if mesh_bin_is_current(mesh_file):
+        try:
+            return read_mesh_bin(FNAMES.mesh_bin_file(mesh_file))
+        except (OSError, ValueError) as e:
+            UI.vprint(2, "   Could not use the binary mesh file:", e)
+    mesh_data = read_mesh_text(mesh_file)
+    try:
+        write_mesh_bin(mesh_file, *mesh_data)
+    except OSError as e:
+        UI.vprint(2, "   Could not write the binary mesh file:", e)
+    return mesh_data
+
+
+##############################################################################
+def read_mesh_block(f, nbr_lines, nbr_cols, dtype, chunk_lines=1 << 20):
+    """
+    Parse the next nbr_lines lines of f into a (nbr_lines, nbr_cols) array,
+    keeping the first nbr_cols columns. Lines are parsed in bulk by numpy,
+    chunk_lines at a time to bound the size of the intermediate strings.
+    """
+    block = numpy.empty((nbr_lines, nbr_cols), dtype=dtype)
+    if not nbr_lines:
+        return block
+    first_line = f.readline()
+    line_cols = len(first_line.split())
+    if line_cols < nbr_cols:
+        raise ValueError("unexpected mesh line: " + first_line.strip())
+    done = 0
+    while done < nbr_lines:
+        count = min(chunk_lines, nbr_lines - done)
+        text = "".join(itertools.islice(f, count - 1 if not done else count))
+        if not done:
+            text = first_line + text
+        values = numpy.fromstring(text, dtype=dtype, sep=" ")
+        if values.size != count * line_cols:
+            raise ValueError("truncated or malformed mesh file")
+        block[done : done + count] = values.reshape(count, line_cols)[
+            :, :nbr_cols
+        ]
+        done += count
+    return block
+
+
+################################################################################
+def write_mesh_block(f, block, line_format, chunk_lines=1 << 16):
+    """
+    Write the rows of the 2D array block to f, each one formatted by the
+    %-style line_format, chunk_lines rows at a time.
+    """
+    for start in range(0, len(block), chunk_lines):
+        chunk = block[start : start + chunk_lines]
+        f.write((line_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+    return
+
+
+##############################################################################
+def read_mesh_text(mesh_file):
     
     f = open(mesh_file,"r")
     mesh_version = float(f.readline().strip().split()[-1])
@@ -856,25 +885,20 @@ def read_mesh_file(mesh_file):
         f.readline()
     
     nbr_nodes = int(f.readline())
-    node_coords = numpy.zeros(5 * nbr_nodes)
+    node_coords = numpy.zeros((nbr_nodes, 5))
     
     # read positions
-    for i in range(nbr_nodes):
-        node_coords[5 * i : 5 * i + 3] = [
-            float(x) for x in f.readline().split()[:3]
-        ]
+    node_coords[:, :3] = read_mesh_block(f, nbr_nodes, 3, numpy.float64)
     # altitutes are encoded in .mesh files with a 100000 scaling factor
-    node_coords[2::5] *= 100000
+    node_coords[:, 2] *= 100000
     
     # skip 3 lines
     for i in range(3):
         f.readline()
     
     # read normals
-    for i in range(nbr_nodes):
-        node_coords[5 * i + 3 : 5 * i + 5] = [
-            float(x) for x in f.readline().split()[:2]
-        ]
+    node_coords[:, 3:] = read_mesh_block(f, nbr_nodes, 2, numpy.float64)
+    node_coords = node_coords.ravel()
     
     # skip 2 lines
     for i in range(0, 2): 
@@ -883,16 +907,261 @@ def read_mesh_file(mesh_file):
     # read nbr of tris
     nbr_tris = int(f.readline())      
 
-    tri_idx  = numpy.zeros(3 * nbr_tris, dtype = numpy.uint32)
-    tri_types = numpy.zeros(nbr_tris, dtype = numpy.uint32)
-    for i in range(nbr_tris):
-        (n1, n2, n3, t) = [
-            int(x) - 1 for x in f.readline().split()[:4]
-        ]
-        tri_idx[3 * i: 3 * i + 3] = (n1, n2, n3)
-        tri_types[i] = t + 1
+    tris = read_mesh_block(f, nbr_tris, 4, numpy.int64)
+    tri_idx = (tris[:, :3] - 1).astype(numpy.uint32).ravel()
+    tri_types = tris[:, 3].astype(numpy.uint32)
     f.close()
 
     return (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types)
+
+
+##############################################################################
+# Binary mesh files: a header followed by the arrays returned by
+# read_mesh_file, so that they can be memory mapped as is.
+#
+#   magic, format version, mesh version, lat, lon, nbr_nodes, nbr_tris,
+#   size and mtime (ns) of the text mesh file it was made from,
+#   padded to mesh_bin_header_size bytes
+#   nbr_nodes x 5 float64 : lon, lat, alt (meters), normal x, normal y
+#   nbr_tris x 3 uint32   : node indices (0-based)
+#   nbr_tris uint32       : triangle types
+##############################################################################
+mesh_bin_magic = b"O4XPMESH"
+mesh_bin_format = 1
+mesh_bin_header = struct.Struct("<8sIdiiQQQq")
+mesh_bin_header_size = 64
+
+
+##############################################################################
+def text_stamp(mesh_file):
+    try:
+        stat = os.stat(mesh_file)
+        return (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        return None
+
+
+##############################################################################
+def read_mesh_bin_header(bin_file):
+    with open(bin_file, "rb") as f:
+        header = f.read(mesh_bin_header.size)
+    if len(header) < mesh_bin_header.size:
+        raise ValueError("truncated binary mesh file " + bin_file)
+    fields = mesh_bin_header.unpack(header)
+    if fields[0] != mesh_bin_magic or fields[1] != mesh_bin_format:
+        raise ValueError("unknown binary mesh format in " + bin_file)
+    return fields[2:]
+
+
+##############################################################################
+def mesh_bin_is_current(mesh_file):
+    """
+    Whether the binary companion of mesh_file was made from it (text files
+    can be replaced behind our back, e.g. by the community mesh archives or
+    by moulinette).
+    """
+    try:
+        (*_, text_size, text_mtime_ns) = read_mesh_bin_header(
+            FNAMES.mesh_bin_file(mesh_file)
+        )
+    except (OSError, ValueError):
+        return False
+    stamp = text_stamp(mesh_file)
+    return stamp is None or stamp == (text_size, text_mtime_ns)
+
+
+##############################################################################
+def write_mesh_bin(
+    mesh_file,
+    mesh_version,
+    nbr_nodes,
+    node_coords,
+    nbr_tris,
+    tri_idx,
+    tri_types,
+    lat=None,
+    lon=None,
+):
+    if lat is None:
+        lat = floor((node_coords[1::5].min() + node_coords[1::5].max()) / 2)
+        lon = floor((node_coords[0::5].min() + node_coords[0::5].max()) / 2)
+    (text_size, text_mtime_ns) = text_stamp(mesh_file) or (0, 0)
+    bin_file = FNAMES.mesh_bin_file(mesh_file)
+    with open(bin_file + ".tmp", "wb") as f:
+        f.write(
+            mesh_bin_header.pack(
+                mesh_bin_magic,
+                mesh_bin_format,
+                mesh_version,
+                int(lat),
+                int(lon),
+                nbr_nodes,
+                nbr_tris,
+                text_size,
+                text_mtime_ns,
+            ).ljust(mesh_bin_header_size, b"\0")
+        )
+        numpy.asarray(node_coords, dtype="<f8").tofile(f)
+        numpy.asarray(tri_idx, dtype="<u4").tofile(f)
+        numpy.asarray(tri_types, dtype="<u4").tofile(f)
+    os.replace(bin_file + ".tmp", bin_file)
+
+
+##############################################################################
+def round_normals(normals):
+    """
+    Normals rounded as their "%.2f" formatting in the text mesh files.
+    """
+    rounded = numpy.round(normals, 2)
+    # numpy.round rounds x * 100, which can fall on the other side of a
+    # tie than the decimal value of x, those are formatted one by one
+    scaled = normals * 100
+    ties = numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6
+    rounded[ties] = [float("%.2f" % x) for x in normals[ties].tolist()]
+    return rounded
+
+
+##############################################################################
+def write_mesh(
+    mesh_file,
+    mesh_version,
+    node_coords,
+    triangles,
+    lat,
+    lon,
+    binary=True,
+    chunk_lines=1 << 16,
+):
+    """
+    Write the text mesh file, and its binary companion when binary is set,
+    in a single pass over the (nbr_nodes, 5) array node_coords (as returned
+    by read_mesh_file) and the (nbr_tris, 4) array triangles (0-based node
+    indices and type). Both are formatted chunk_lines rows at a time.
+    """
+    (nbr_nodes, nbr_tris) = (len(node_coords), len(triangles))
+    bin_file = FNAMES.mesh_bin_file(mesh_file)
+    f_bin = None
+    if binary:
+        try:
+            f_bin = open(bin_file + ".tmp", "wb")
+            f_bin.write(bytes(mesh_bin_header_size))
+        except OSError as e:
+            UI.vprint(1, "   WARNING: Could not write the binary mesh file:", e)
+            f_bin = None
+    f = open(mesh_file, "w")
+    f.write("MeshVersionFormatted " + "{:g}".format(mesh_version) + "\n")
+    f.write("Dimension 3\n\n")
+    f.write("Vertices\n")
+    f.write(str(nbr_nodes) + "\n")
+    for start in range(0, nbr_nodes, chunk_lines):
+        chunk = numpy.array(node_coords[start : start + chunk_lines], "<f8")
+        if f_bin:
+            # normals as read back from the text file, so that both files
+            # hold the same mesh
+            bin_chunk = chunk.copy()
+            bin_chunk[:, 3:5] = round_normals(chunk[:, 3:5])
+            bin_chunk.tofile(f_bin)
+        # altitudes are encoded in .mesh files with a 100000 scaling factor
+        chunk[:, 2] /= 100000
+        write_mesh_block(f, chunk[:, :3], "%.15f %.15f %.15f 0\n")
+    f.write("\n")
+    f.write("Normals\n")
+    f.write(str(nbr_nodes) + "\n")
+    write_mesh_block(f, node_coords[:, 3:5], "%.2f %.2f 0\n", chunk_lines)
+    f.write("\n")
+    f.write("Triangles\n")
+    f.write(str(nbr_tris) + "\n")
+    for start in range(0, nbr_tris, chunk_lines):
+        chunk = numpy.array(triangles[start : start + chunk_lines], "<u4")
+        if f_bin:
+            chunk[:, :3].tofile(f_bin)
+        chunk[:, :3] += 1
+        write_mesh_block(f, chunk, "%d %d %d %d\n")
+    f.close()
+    if not f_bin:
+        return
+    for start in range(0, nbr_tris, chunk_lines):
+        numpy.array(triangles[start : start + chunk_lines, 3], "<u4").tofile(
+            f_bin
+        )
+    f_bin.seek(0)
+    f_bin.write(
+        mesh_bin_header.pack(
+            mesh_bin_magic,
+            mesh_bin_format,
+            mesh_version,
+            int(lat),
+            int(lon),
+            nbr_nodes,
+            nbr_tris,
+            *text_stamp(mesh_file)
+        )
+    )
+    f_bin.close()
+    os.replace(bin_file + ".tmp", bin_file)
+    return
+
+
 ##############################################################################
+def read_mesh_bin(bin_file):
+    """
+    Memory mapped (copy on write) counterpart of read_mesh_text: the arrays
+    are only paged in when accessed, and can be modified by the caller.
+    """
+    (mesh_version, _, _, nbr_nodes, nbr_tris, _, _) = read_mesh_bin_header(
+        bin_file
+    )
+    if os.path.getsize(bin_file) != (
+        mesh_bin_header_size + 40 * nbr_nodes + 16 * nbr_tris
+    ):
+        raise ValueError("truncated binary mesh file " + bin_file)
+    offset = mesh_bin_header_size
+    node_coords = numpy.memmap(
+        bin_file, dtype="<f8", mode="c", offset=offset, shape=(5 * nbr_nodes,)
+    )
+    offset += 40 * nbr_nodes
+    tri_idx = numpy.memmap(
+        bin_file, dtype="<u4", mode="c", offset=offset, shape=(3 * nbr_tris,)
+    )
+    offset += 12 * nbr_tris
+    tri_types = numpy.memmap(
+        bin_file, dtype="<u4", mode="c", offset=offset, shape=(nbr_tris,)
+    )
+    return (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types)
+
 
+##############################################################################
+def mesh_bin_to_text(mesh_file):
+    """
+    (Re)write the text mesh file from its binary companion, for the external
+    tools (moulinette, medit...) which only know the text format.
+    """
+    bin_file = FNAMES.mesh_bin_file(mesh_file)
+    (mesh_version, _, lat, lon, _, _, _) = read_mesh_bin_header(bin_file)
+    (mesh_version, nbr_nodes, node_coords, nbr_tris, tri_idx, tri_types) = (
+        read_mesh_bin(bin_file)
+    )
+    write_mesh(
+        mesh_file,
+        mesh_version,
+        node_coords.reshape(nbr_nodes, 5),
+        numpy.column_stack((tri_idx.reshape(nbr_tris, 3), tri_types)),
+        lat,
+        lon,
+        binary=False,
+    )
+    del node_coords, tri_idx, tri_types
+    # the binary file now stands for the new text file
+    with open(bin_file, "r+b") as f:
+        f.write(
+            mesh_bin_header.pack(
+                mesh_bin_magic,
+                mesh_bin_format,
+                mesh_version,
+                lat,
+                lon,
+                nbr_nodes,
+                nbr_tris,
+                *text_stamp(mesh_file)
+            )
+        )
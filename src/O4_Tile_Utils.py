@@ -1,11 +1,21 @@
 import logging
 import os
+import sys
+import io
+import copy
+import types
 import time
 import shutil
 import queue
 import threading
+import multiprocessing
+import concurrent.futures
 import O4_UI_Utils as UI
+import O4_Trace_Utils as TRACE
+import O4_Incremental_Utils as INCR
 import O4_File_Names as FNAMES
+import O4_OSM_Utils as OSM
+import O4_DEM_Utils as DEM
 import O4_Imagery_Utils as IMG
 import O4_Vector_Map as VMAP
 import O4_Mesh_Utils as MESH
@@ -13,10 +23,14 @@ import O4_Mask_Utils as MASK
 import O4_DSF_Utils as DSF
 import O4_Overlay_Utils as OVL
 from O4_Parallel_Utils import parallel_launch, parallel_join
+from O4_Cfg_Vars import cfg_app_vars, list_app_vars
 
 max_convert_slots = 4
 skip_downloads = False
 skip_converts = False
+max_batch_slots = 1
+max_batch_ram = 0
+prefetch_tiles = 0
 
 ################################################################################
 def download_textures(tile, download_queue, convert_queue):
@@ -41,6 +55,8 @@ def download_textures(tile, download_queue, convert_queue):
     return 1
 
 ################################################################################
+@INCR.skip_if_unchanged("dsf")
+@TRACE.traced_step("Step 3")
 def build_tile(tile):
     if UI.is_working:
         return 0
@@ -218,8 +234,27 @@ def build_all(tile):
 
 ################################################################################
 def build_tile_list(
-    tile, list_lat_lon, do_osm, do_mesh, do_mask, do_dsf, do_ovl, override_cfg
+    tile,
+    list_lat_lon,
+    do_osm,
+    do_mesh,
+    do_mask,
+    do_dsf,
+    do_ovl,
+    override_cfg,
+    checkpoint=None,
+    overrides=None,
 ):
+    """
+    Build a list of tiles, each of them through the selected steps.
+
+    :param checkpoint: optional object with pending_steps(lat, lon, steps)
+        and record(lat, lon, step) methods (see O4_Batch_Utils.Checkpoint),
+        used to skip steps completed in a previous run and to record the
+        completed ones
+    :param dict overrides: optional tile variables applied on top of each
+        tile config
+    """
     if UI.is_working:
         return 0
     UI.red_flag = 0
@@ -227,9 +262,98 @@ def build_tile_list(
     UI.lvprint(
         0, "Batch build launched for a number of", len(list_lat_lon), "tiles."
     )
+    requested = (do_osm, do_mesh, do_mask, do_dsf, do_ovl)
+    tile_steps = {}
+    for (lat, lon) in list_lat_lon:
+        tile_steps[(lat, lon)] = (
+            checkpoint.pending_steps(lat, lon, requested)
+            if checkpoint
+            else requested
+        )
+    parallel = max_batch_slots > 1 and len(list_lat_lon) > 1
+    prefetcher = None
+    if prefetch_tiles and any(
+        steps[0] or steps[1] for steps in tile_steps.values()
+    ):
+        prefetcher = tile_prefetcher(
+            copy.copy(tile),
+            list_lat_lon,
+            tile_steps,
+            override_cfg,
+            overrides,
+            prefetch_tiles + (max_batch_slots if parallel else 1),
+        )
+        prefetcher.start()
+    try:
+        if parallel and any(
+            steps[0] or steps[1] for steps in tile_steps.values()
+        ):
+            success = build_tile_list_parallel(
+                tile,
+                list_lat_lon,
+                tile_steps,
+                override_cfg,
+                checkpoint,
+                overrides,
+                prefetcher,
+            )
+        else:
+            success = build_tile_list_serial(
+                tile,
+                list_lat_lon,
+                tile_steps,
+                override_cfg,
+                checkpoint,
+                overrides,
+                prefetcher,
+            )
+    finally:
+        if prefetcher:
+            prefetcher.stop()
+    if not success:
+        return 0
+    UI.lvprint(
+        0, "Batch process completed in", UI.nicer_timer(time.time() - timer)
+    )
+    if IMG.incomplete_imgs:
+        UI.lvprint(
+            0,
+            (
+                "\nERROR: Parts of the following images could not be obtained "
+                "and have been filled with white: "
+                f"{IMG.incomplete_imgs}"
+            ),
+        )
+    return 1
+
+################################################################################
+def build_tile_list_serial(
+    tile,
+    list_lat_lon,
+    tile_steps,
+    override_cfg,
+    checkpoint,
+    overrides,
+    prefetcher=None,
+):
     k = 0
     for (lat, lon) in list_lat_lon:
         k += 1
+        (do_osm, do_mesh, do_mask, do_dsf, do_ovl) = tile_steps[(lat, lon)]
+        if not any(tile_steps[(lat, lon)]):
+            UI.vprint(
+                1,
+                "Skipping tile ",
+                k,
+                "/",
+                len(list_lat_lon),
+                ":",
+                FNAMES.short_latlon(lat, lon),
+                "(already completed).",
+            )
+            continue
+        if prefetcher:
+            prefetcher.wait(lat, lon)
         UI.vprint(
             1,
             "Dealing with tile ",
@@ -239,69 +363,424 @@ def build_tile_list(
             ":",
             FNAMES.short_latlon(lat, lon),
         )
-        (tile.lat, tile.lon) = (lat, lon)
-        tile.build_dir = FNAMES.build_dir(
-            tile.lat, tile.lon, tile.custom_build_dir
+        prepare_batch_tile(
+            tile,
+            lat,
+            lon,
+            override_cfg,
+            do_osm or do_mesh or do_dsf,
+            overrides,
         )
-        tile.dem = None
-        if override_cfg:
-            tile.read_from_config(use_global=True)
-        else:
-            tile.read_from_config()
-        if do_osm or do_mesh or do_dsf:
-            tile.make_dirs()
         if do_osm:
-            VMAP.build_poly_file(tile)
+            success = VMAP.build_poly_file(tile)
             if UI.red_flag:
                 UI.exit_message_and_bottom_line()
                 return 0
+            if success and checkpoint:
+                checkpoint.record(lat, lon, "osm")
         if do_mesh:
-            MESH.build_mesh(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_mask:
-            MASK.build_masks(tile)
+            success = MESH.build_mesh(tile)
             if UI.red_flag:
                 UI.exit_message_and_bottom_line()
                 return 0
-        if do_dsf:
-            tile_coords = FNAMES.short_latlon(lat, lon)
-            build_tile(tile)
-            if tile_coords in IMG.incomplete_imgs:
-                UI.lvprint(
+            if success and checkpoint:
+                checkpoint.record(lat, lon, "mesh")
+        if prefetcher:
+            prefetcher.tile_completed(lat, lon)
+        if not finish_batch_tile(tile, do_mask, do_dsf, do_ovl, checkpoint):
+            return 0
+    return 1
+
+################################################################################
+class tile_prefetcher(threading.Thread):
+    """
+    Downloads in the background the OSM and elevation data needed by Step 1
+    and Step 2 of the batch tiles, at most a given number of tiles ahead of
+    those being built, so that network latency overlaps with computations.
+    """
+
+    def __init__(
+        self, tile, list_lat_lon, tile_steps, override_cfg, overrides, ahead
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self._tile = tile
+        self._tile_steps = tile_steps
+        self._override_cfg = override_cfg
+        self._overrides = overrides
+        self._tiles = [
+            key for key in list_lat_lon if tile_steps[key][0] or tile_steps[key][1]
+        ]
+        self._done = {key: threading.Event() for key in self._tiles}
+        self._slots = threading.Semaphore(ahead)
+        self._stopped = False
+
+    def run(self):
+        for (lat, lon) in self._tiles:
+            self._slots.acquire()
+            if self._stopped:
+                break
+            tile = copy.copy(self._tile)
+            try:
+                prepare_batch_tile(
+                    tile, lat, lon, self._override_cfg, False, self._overrides
+                )
+                UI.vprint(
                     1,
-                    f"Attempting to rebuild textures with white squares: {IMG.incomplete_imgs[tile_coords]}"
+                    "-> Prefetching OSM and elevation data for tile",
+                    FNAMES.short_latlon(lat, lon),
                 )
-                delete_incomplete_imgs(tile_coords)
-                build_tile(tile)
-            if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        if do_ovl:
-            OVL.build_overlay(lat, lon)
+                if self._tile_steps[(lat, lon)][0]:
+                    VMAP.prefetch_osm_data(tile)
+                DEM.prefetch_elevation(lat, lon, tile.custom_dem)
+            except Exception as e:
+                UI.vprint(
+                    1,
+                    "   Prefetch failed for tile",
+                    FNAMES.short_latlon(lat, lon),
+                    ":",
+                    e,
+                )
+            self._done[(lat, lon)].set()
+        for event in self._done.values():
+            event.set()
+
+    def wait(self, lat, lon):
+        if (lat, lon) not in self._done:
+            return
+        while not self._done[(lat, lon)].wait(0.5):
             if UI.red_flag:
-                UI.exit_message_and_bottom_line()
-                return 0
-        try:
-            UI.gui.earth_window.canvas.delete(
-                UI.gui.earth_window.dico_tiles_todo[(lat, lon)]
+                return
+
+    def is_done(self, lat, lon):
+        return (lat, lon) not in self._done or self._done[(lat, lon)].is_set()
+
+    def tile_completed(self, lat, lon):
+        if (lat, lon) in self._done:
+            self._slots.release()
+
+    def stop(self):
+        self._stopped = True
+        self._slots.release()
+
+################################################################################
+def prepare_batch_tile(tile, lat, lon, override_cfg, make_dirs, overrides=None):
+    (tile.lat, tile.lon) = (lat, lon)
+    tile.build_dir = FNAMES.build_dir(tile.lat, tile.lon, tile.custom_build_dir)
+    tile.dem = None
+    if override_cfg:
+        tile.read_from_config(use_global=True)
+    else:
+        tile.read_from_config()
+    if overrides:
+        for (var, value) in overrides.items():
+            setattr(tile, var, value)
+    if make_dirs:
+        tile.make_dirs()
+
+################################################################################
+def finish_batch_tile(tile, do_mask, do_dsf, do_ovl, checkpoint=None):
+    (lat, lon) = (tile.lat, tile.lon)
+    if do_mask:
+        success = MASK.build_masks(tile)
+        if UI.red_flag:
+            UI.exit_message_and_bottom_line()
+            return 0
+        if success and checkpoint:
+            checkpoint.record(lat, lon, "mask")
+    if do_dsf:
+        tile_coords = FNAMES.short_latlon(lat, lon)
+        success = build_tile(tile)
+        if tile_coords in IMG.incomplete_imgs:
+            UI.lvprint(
+                1,
+                f"Attempting to rebuild textures with white squares: {IMG.incomplete_imgs[tile_coords]}"
             )
-            UI.gui.earth_window.dico_tiles_todo.pop((lat, lon), None)
-        except:
-            pass
-    UI.lvprint(
-        0, "Batch process completed in", UI.nicer_timer(time.time() - timer)
+            delete_incomplete_imgs(tile_coords)
+            success = build_tile(tile)
+        if UI.red_flag:
+            UI.exit_message_and_bottom_line()
+            return 0
+        if success and checkpoint and tile_coords not in IMG.incomplete_imgs:
+            checkpoint.record(lat, lon, "dsf")
+    if do_ovl:
+        success = OVL.build_overlay(lat, lon)
+        if UI.red_flag:
+            UI.exit_message_and_bottom_line()
+            return 0
+        if success and checkpoint:
+            checkpoint.record(lat, lon, "ovl")
+    try:
+        UI.gui.earth_window.canvas.delete(
+            UI.gui.earth_window.dico_tiles_todo[(lat, lon)]
+        )
+        UI.gui.earth_window.dico_tiles_todo.pop((lat, lon), None)
+    except:
+        pass
+    return 1
+
+################################################################################
+# Parallel batch builds : Step 1 and Step 2 of distinct tiles are run in a
+# pool of worker processes (they are mostly single threaded and CPU bound),
+# while masks, DSF and overlays remain sequential in the calling process.
+# Masks of a tile are only started when the meshes of all its neighbours
+# belonging to the batch are done, since they are read through
+# MASK.select_neighbor_meshes.
+################################################################################
+def batch_app_vars():
+    modules = {
+        "UI": UI,
+        "OSM": OSM,
+        "IMG": IMG,
+        "OVL": OVL,
+        "TRACE": TRACE,
+        "INCR": INCR,
+        "MASK": MASK,
+        "TILE": sys.modules[__name__],
+    }
+    app_vars = {}
+    for var in list_app_vars:
+        module = cfg_app_vars[var].get("module")
+        if module in modules and hasattr(modules[module], var):
+            app_vars[var] = (module, getattr(modules[module], var))
+    return app_vars
+
+################################################################################
+def init_batch_worker(app_vars, stop_event):
+    modules = {
+        "UI": UI,
+        "OSM": OSM,
+        "IMG": IMG,
+        "OVL": OVL,
+        "TRACE": TRACE,
+        "INCR": INCR,
+        "MASK": MASK,
+        "TILE": sys.modules[__name__],
+    }
+    for var, (module, value) in app_vars.items():
+        setattr(modules[module], var, value)
+    UI.gui = None
+
+    def watch_stop_event():
+        # each step resets UI.red_flag when it starts, hence we keep it up
+        stop_event.wait()
+        while True:
+            UI.red_flag = True
+            time.sleep(0.2)
+
+    threading.Thread(target=watch_stop_event, daemon=True).start()
+
+################################################################################
+def batch_worker(tile_vars, do_osm, do_mesh):
+    tile = types.SimpleNamespace(**tile_vars)
+    UI.is_working = False
+    output = io.StringIO()
+    sys.stdout = output
+    (osm_done, mesh_done) = (False, False)
+    try:
+        if do_osm:
+            osm_done = VMAP.build_poly_file(tile) and not UI.red_flag
+        if do_mesh and not UI.red_flag:
+            mesh_done = MESH.build_mesh(tile) and not UI.red_flag
+    except Exception as e:
+        UI.lvprint(0, "ERROR: Batch worker crashed :", e)
+        UI.red_flag = True
+    finally:
+        sys.stdout = sys.__stdout__
+        UI.is_working = False
+    return (bool(osm_done), bool(mesh_done), output.getvalue())
+
+################################################################################
+def batch_ram_estimate(tile):
+    # Rough figures from Triangle4XP and the post-processing of its output,
+    # on top of the shapely/rtree work of Step 1.
+    try:
+        max_tris = float(tile.limit_tris) * 1e6 if tile.limit_tris else 5e6
+    except:
+        max_tris = 5e6
+    return 0.5 + max_tris * 4e-7
+
+################################################################################
+def build_tile_list_parallel(
+    tile,
+    list_lat_lon,
+    tile_steps,
+    override_cfg,
+    checkpoint,
+    overrides,
+    prefetcher=None,
+):
+    nbr_tiles = len(list_lat_lon)
+    tiles = {}
+    for (lat, lon) in list_lat_lon:
+        if not any(tile_steps[(lat, lon)]):
+            continue
+        prepare_batch_tile(tile, lat, lon, override_cfg, True, overrides)
+        tiles[(lat, lon)] = copy.copy(tile)
+        # the lists (zone_list...) would otherwise be shared with tile
+        for (var, value) in vars(tile).items():
+            if isinstance(value, list):
+                setattr(tiles[(lat, lon)], var, copy.deepcopy(value))
+    to_mesh = [key for key in tiles if tile_steps[key][0] or tile_steps[key][1]]
+    UI.vprint(
+        1,
+        "-> Building Step 1/2 of",
+        len(to_mesh),
+        "tiles with up to",
+        max_batch_slots,
+        "parallel processes.",
     )
-    if IMG.incomplete_imgs:
-        UI.lvprint(
-            0,
-            (
-                "\nERROR: Parts of the following images could not be obtained "
-                "and have been filled with white: "
-                f"{IMG.incomplete_imgs}"
-            ),
+    app_vars = batch_app_vars()
+    mp_context = multiprocessing.get_context("spawn")
+    stop_event = mp_context.Event()
+    mesh_done = {key: threading.Event() for key in tiles}
+    mesh_success = {}
+    for key in tiles:
+        if key not in to_mesh:
+            mesh_success[key] = True
+            mesh_done[key].set()
+
+    def schedule():
+        # the main loop waits on mesh_done, which must all end up being set
+        try:
+            run_schedule()
+        except Exception as e:
+            UI.lvprint(0, "ERROR: Batch scheduler crashed :", e)
+            stop_event.set()
+            UI.red_flag = True
+        finally:
+            for key in tiles:
+                if not mesh_done[key].is_set():
+                    mesh_success[key] = False
+                    mesh_done[key].set()
+
+    def run_schedule():
+        pending = list(to_mesh)
+        running = {}
+        ram_in_use = 0
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(max_batch_slots, len(to_mesh)),
+            mp_context=mp_context,
+            initializer=init_batch_worker,
+            initargs=(app_vars, stop_event),
+        ) as executor:
+            while pending or running:
+                while (
+                    pending
+                    and len(running) < max_batch_slots
+                    and not stop_event.is_set()
+                ):
+                    if prefetcher and not prefetcher.is_done(*pending[0]):
+                        if running:
+                            break
+                        prefetcher.wait(*pending[0])
+                    ram = batch_ram_estimate(tiles[pending[0]])
+                    if (
+                        max_batch_ram
+                        and running
+                        and ram_in_use + ram > max_batch_ram
+                    ):
+                        break
+                    key = pending.pop(0)
+                    tile_vars = dict(vars(tiles[key]))
+                    tile_vars["dem"] = None
+                    future = executor.submit(
+                        batch_worker, tile_vars, *tile_steps[key][:2]
+                    )
+                    running[future] = (key, ram)
+                    ram_in_use += ram
+                if stop_event.is_set():
+                    for key in pending:
+                        mesh_success[key] = False
+                        mesh_done[key].set()
+                    pending = []
+                if not running:
+                    break
+                (done, _) = concurrent.futures.wait(
+                    running,
+                    timeout=1,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    (key, ram) = running.pop(future)
+                    ram_in_use -= ram
+                    (do_osm, do_mesh) = tile_steps[key][:2]
+                    try:
+                        (osm_ok, mesh_ok, output) = future.result()
+                        print(output, end="")
+                    except Exception as e:
+                        UI.lvprint(0, "ERROR: Batch worker crashed :", e)
+                        (osm_ok, mesh_ok) = (False, False)
+                    if checkpoint and osm_ok:
+                        checkpoint.record(*key, "osm")
+                    if checkpoint and mesh_ok:
+                        checkpoint.record(*key, "mesh")
+                    success = (osm_ok or not do_osm) and (
+                        mesh_ok or not do_mesh
+                    )
+                    if not success:
+                        UI.lvprint(
+                            1,
+                            "Step 1/2 failed for tile",
+                            FNAMES.short_latlon(*key),
+                        )
+                    mesh_success[key] = success
+                    mesh_done[key].set()
+                    if prefetcher:
+                        prefetcher.tile_completed(*key)
+
+    scheduler = threading.Thread(target=schedule)
+    scheduler.start()
+    k = 0
+    for (lat, lon) in list_lat_lon:
+        k += 1
+        if (lat, lon) not in tiles:
+            UI.vprint(
+                1,
+                "Skipping tile ",
+                k,
+                "/",
+                nbr_tiles,
+                ":",
+                FNAMES.short_latlon(lat, lon),
+                "(already completed).",
+            )
+            continue
+        waited_for = [
+            (lat + i, lon + j)
+            for i in (-1, 0, 1)
+            for j in (-1, 0, 1)
+            if (lat + i, lon + j) in tiles
+        ]
+        for key in waited_for:
+            while not mesh_done[key].wait(0.5):
+                if UI.red_flag:
+                    break
+            if UI.red_flag:
+                break
+        if UI.red_flag:
+            stop_event.set()
+            scheduler.join()
+            UI.exit_message_and_bottom_line()
+            return 0
+        if not mesh_success[(lat, lon)]:
+            continue
+        UI.vprint(
+            1,
+            "Dealing with tile ",
+            k,
+            "/",
+            nbr_tiles,
+            ":",
+            FNAMES.short_latlon(lat, lon),
         )
+        (_, _, do_mask, do_dsf, do_ovl) = tile_steps[(lat, lon)]
+        if not finish_batch_tile(
+            tiles[(lat, lon)], do_mask, do_dsf, do_ovl, checkpoint
+        ):
+            stop_event.set()
+            scheduler.join()
+            return 0
+    scheduler.join()
     return 1
 
 ################################################################################
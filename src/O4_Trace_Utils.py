@@ -0,0 +1,257 @@
+"""Nested timing and resource spans for the build steps.
+
+When trace_builds is set, each step (1, 2, 2.5 and 3) opens a root span
+for its tile and every traced stage below it opens a child span, recording
+wall time, process CPU time, CPU time of the child processes (Triangle4XP,
+nvcompress, 7z...) and peak RSS. When the root span closes, the tree is
+appended to Trace<lat><lon>.json and flattened into Trace<lat><lon>.csv in
+the tile build directory.
+
+CPU times are process wide: spans running concurrently in several threads
+(downloads, conversions, masks) see each other's CPU usage.
+"""
+
+import csv
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import O4_UI_Utils as UI
+import O4_File_Names as FNAMES
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+trace_builds = False
+
+_local = threading.local()
+_lock = threading.Lock()
+_root = None
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_rss_unit = 1 / 1024 if sys.platform != "darwin" else 1 / 1024 ** 2
+
+
+################################################################################
+def _usage():
+    usage = {"wall": time.perf_counter(), "cpu": time.process_time()}
+    if resource:
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage["children_cpu"] = children.ru_utime + children.ru_stime
+        usage["peak_rss_mb"] = own.ru_maxrss * _rss_unit
+        usage["children_peak_rss_mb"] = children.ru_maxrss * _rss_unit
+    return usage
+
+
+################################################################################
+class Span:
+    def __init__(self, name, root=None, phase=False):
+        self.name = name
+        self.root = root or self
+        self.phase = phase
+        self.start_time = time.time()
+        self.thread = threading.current_thread().name
+        self.start = _usage()
+        self.end = None
+        self.children = []
+
+    def close(self, usage=None):
+        if self.end is None:
+            self.end = usage or _usage()
+        with _lock:
+            children = list(self.children)
+        for child in children:
+            # spans left open (interruptions, threads still running)
+            child.close(self.end)
+
+    def to_dict(self):
+        end = self.end or self.start
+        record = {
+            "name": self.name,
+            "start": round(self.start_time, 3),
+            "thread": self.thread,
+            "wall": round(end["wall"] - self.start["wall"], 4),
+            "cpu": round(end["cpu"] - self.start["cpu"], 4),
+        }
+        if "children_cpu" in end:
+            record["children_cpu"] = round(
+                end["children_cpu"] - self.start["children_cpu"], 4
+            )
+            record["peak_rss_mb"] = round(end["peak_rss_mb"], 1)
+            record["children_peak_rss_mb"] = round(
+                end["children_peak_rss_mb"], 1
+            )
+        record["children"] = [child.to_dict() for child in self.children]
+        return record
+
+
+################################################################################
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+################################################################################
+def begin(name, phase=False):
+    """
+    Open a span below the current one of this thread, or below the root span
+    for threads which have none. Returns None when no root span is active.
+    """
+    stack = _stack()
+    if stack and stack[-1].root is not _root:
+        # left over by an interrupted build
+        stack.clear()
+    parent = stack[-1] if stack else _root
+    if parent is None:
+        return None
+    span = Span(name, _root, phase)
+    with _lock:
+        parent.children.append(span)
+    stack.append(span)
+    return span
+
+
+################################################################################
+def end(span=None):
+    """Close the given span (default: the innermost of this thread)."""
+    stack = _stack()
+    if not stack or (span is not None and span not in stack):
+        return
+    while stack:
+        top = stack.pop()
+        top.close()
+        if span is None or top is span:
+            return
+
+
+################################################################################
+def phase(name):
+    """Close the current phase span of this thread if any, and open another."""
+    stack = _stack()
+    if stack and stack[-1].phase:
+        end(stack[-1])
+    return begin(name, phase=True)
+
+
+################################################################################
+def end_phase():
+    stack = _stack()
+    if stack and stack[-1].phase:
+        end(stack[-1])
+
+
+################################################################################
+def traced(name):
+    """Decorator recording each call of the function as a span."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            span = begin(name)
+            if span is None:
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end(span)
+
+        return wrapper
+
+    return decorator
+
+
+################################################################################
+def traced_step(name):
+    """
+    Decorator for the step functions, whose first argument is the tile: it
+    opens the root span and writes the trace files when the step returns.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(tile, *args, **kwargs):
+            global _root
+            if not trace_builds or _root is not None or UI.is_working:
+                return func(tile, *args, **kwargs)
+            root = Span(name)
+            _root = root
+            _stack().append(root)
+            try:
+                return func(tile, *args, **kwargs)
+            finally:
+                end(root)
+                _root = None
+                write_trace(tile, root)
+
+        return wrapper
+
+    return decorator
+
+
+################################################################################
+def _flatten(record, path, depth, rows):
+    path = path + "/" + record["name"] if path else record["name"]
+    rows.append(
+        [
+            path,
+            depth,
+            record["thread"],
+            record["start"],
+            record["wall"],
+            record["cpu"],
+            record.get("children_cpu", ""),
+            record.get("peak_rss_mb", ""),
+            record.get("children_peak_rss_mb", ""),
+        ]
+    )
+    for child in record["children"]:
+        _flatten(child, path, depth + 1, rows)
+
+
+################################################################################
+def write_trace(tile, root):
+    record = root.to_dict()
+    json_file = FNAMES.trace_file(tile.build_dir, tile.lat, tile.lon, "json")
+    csv_file = FNAMES.trace_file(tile.build_dir, tile.lat, tile.lon, "csv")
+    try:
+        try:
+            with open(json_file, "r") as f:
+                trace = json.load(f)
+        except (OSError, ValueError):
+            trace = {
+                "tile": FNAMES.short_latlon(tile.lat, tile.lon),
+                "runs": [],
+            }
+        trace["runs"].append(record)
+        with open(json_file + ".tmp", "w") as f:
+            json.dump(trace, f, indent=1)
+        os.replace(json_file + ".tmp", json_file)
+        rows = []
+        _flatten(record, "", 0, rows)
+        new_file = not os.path.isfile(csv_file)
+        with open(csv_file, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(
+                    [
+                        "span",
+                        "depth",
+                        "thread",
+                        "start",
+                        "wall",
+                        "cpu",
+                        "children_cpu",
+                        "peak_rss_mb",
+                        "children_peak_rss_mb",
+                    ]
+                )
+            writer.writerows(rows)
+    except Exception as e:
+        UI.vprint(1, "WARNING: Could not write the build trace:", e)
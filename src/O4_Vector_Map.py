@@ -7,6 +7,8 @@ from shapely import geometry, ops
 # from PIL import Image, ImageDraw, ImageFilter
 import O4_DEM_Utils as DEM
 import O4_UI_Utils as UI
+import O4_Trace_Utils as TRACE
+import O4_Incremental_Utils as INCR
 import O4_OSM_Utils as OSM
 import O4_Vector_Utils as VECT
 import O4_File_Names as FNAMES
@@ -15,7 +17,32 @@ import O4_Airport_Utils as APT
 
 good_imagery_list = ()
 
+# Overpass queries and tags of interest of the OSM data cached for Step 1
+airports_queries = [('node["aeroway"]', 'way["aeroway"]', 'rel["aeroway"]')]
+airports_tags = ["all"]
+big_roads_queries = [
+    'way["highway"="motorway"]',
+    'way["highway"="trunk"]',
+    'way["highway"="primary"]',
+    'way["highway"="secondary"]',
+    'way["railway"="rail"]',
+    'way["railway"="narrow_gauge"]',
+]
+roads_tags = ["bridge", "tunnel"]
+coastline_queries = ['way["natural"="coastline"]']
+coastline_tags = []
+water_queries = [
+    'rel["natural"="water"]',
+    'rel["waterway"="riverbank"]',
+    'way["natural"="water"]',
+    'way["waterway"="riverbank"]',
+    'way["waterway"="dock"]',
+]
+water_tags = ["name"]
+
 ################################################################################
+@INCR.skip_if_unchanged("osm")
+@TRACE.traced_step("Step 1")
 def build_poly_file(tile):
     if UI.is_working:
         return 0
@@ -179,17 +206,76 @@ def build_poly_file(tile):
 
 
 ################################################################################
+def small_roads_queries(road_level):
+    queries = ['way["highway"="tertiary"]']
+    if road_level >= 3:
+        queries += [
+            'way["highway"="unclassified"]',
+            'way["highway"="residential"]',
+        ]
+    if road_level >= 4:
+        queries += ['way["highway"="service"]']
+    if road_level >= 5:
+        queries += ['way["highway"="track"]']
+    return queries
+
+
+################################################################################
+def prefetch_osm_data(tile):
+    """
+    Fill the OSM caches used by Step 1 for the tile, without building
+    anything, so that a later Step 1 only recycles them.
+    """
+    cached = [("airports", airports_queries, airports_tags)]
+    if tile.road_level:
+        cached.append(("big_roads", big_roads_queries, roads_tags))
+    if tile.road_level >= 2:
+        cached.append(
+            ("small_roads", small_roads_queries(tile.road_level), roads_tags)
+        )
+    if not (
+        os.path.isfile(FNAMES.custom_coastline(tile.lat, tile.lon))
+        or os.path.isdir(FNAMES.custom_coastline_dir(tile.lat, tile.lon))
+    ):
+        cached.append(("coastline", coastline_queries, coastline_tags))
+    if not (
+        os.path.isfile(FNAMES.custom_water(tile.lat, tile.lon))
+        or os.path.isdir(FNAMES.custom_water_dir(tile.lat, tile.lon))
+    ):
+        cached.append(("water", water_queries, water_tags))
+    if not os.path.exists(FNAMES.osm_dir(tile.lat, tile.lon)):
+        os.makedirs(FNAMES.osm_dir(tile.lat, tile.lon))
+    success = 1
+    for (cached_suffix, queries, tags_of_interest) in cached:
+        if os.path.isfile(FNAMES.osm_cached(tile.lat, tile.lon, cached_suffix)):
+            continue
+        if UI.red_flag:
+            return 0
+        success = (
+            OSM.OSM_queries_to_OSM_layer(
+                queries,
+                OSM.OSM_layer(),
+                tile.lat,
+                tile.lon,
+                tags_of_interest,
+                cached_suffix=cached_suffix,
+            )
+            and success
+        )
+    return success
+
+
+################################################################################
+@TRACE.traced("include_airports")
 def include_airports(vector_map, tile):
     UI.vprint(0, "-> Dealing with airports")
     airport_layer = OSM.OSM_layer()
-    queries = [('node["aeroway"]', 'way["aeroway"]', 'rel["aeroway"]')]
-    tags_of_interest = ["all"]
     if not OSM.OSM_queries_to_OSM_layer(
-        queries,
+        airports_queries,
         airport_layer,
         tile.lat,
         tile.lon,
-        tags_of_interest,
+        airports_tags,
         cached_suffix="airports",
     ):
         return (0, 0)
@@ -225,6 +311,7 @@ def include_airports(vector_map, tile):
 
 
 ################################################################################
+@TRACE.traced("include_roads")
 def include_roads(vector_map, tile, apt_array, apt_area):
     def road_is_too_much_banked(way, filtered_segs):
         (col, row) = numpy.minimum(
@@ -253,21 +340,13 @@ def include_roads(vector_map, tile, apt_array, apt_area):
     if not tile.road_level:
         return
     UI.vprint(0, "-> Dealing with roads")
-    tags_of_interest = ["bridge", "tunnel"]
+    tags_of_interest = roads_tags
     # Need to evaluate if including bridges is better or worse
     tags_for_exclusion = set(["bridge", "tunnel"])
     # tags_for_exclusion=set(["tunnel"])
     road_layer = OSM.OSM_layer()
-    queries = [
-        'way["highway"="motorway"]',
-        'way["highway"="trunk"]',
-        'way["highway"="primary"]',
-        'way["highway"="secondary"]',
-        'way["railway"="rail"]',
-        'way["railway"="narrow_gauge"]',
-    ]
     if not OSM.OSM_queries_to_OSM_layer(
-        queries,
+        big_roads_queries,
         road_layer,
         tile.lat,
         tile.lon,
@@ -287,18 +366,8 @@ def include_roads(vector_map, tile, apt_array, apt_area):
         return 0
     if tile.road_level >= 2:
         road_layer = OSM.OSM_layer()
-        queries = ['way["highway"="tertiary"]']
-        if tile.road_level >= 3:
-            queries += [
-                'way["highway"="unclassified"]',
-                'way["highway"="residential"]',
-            ]
-        if tile.road_level >= 4:
-            queries += ['way["highway"="service"]']
-        if tile.road_level >= 5:
-            queries += ['way["highway"="track"]']
         if not OSM.OSM_queries_to_OSM_layer(
-            queries,
+            small_roads_queries(tile.road_level),
             road_layer,
             tile.lat,
             tile.lon,
@@ -360,6 +429,7 @@ def include_roads(vector_map, tile, apt_array, apt_area):
 
 
 ################################################################################
+@TRACE.traced("include_sea")
 def include_sea(vector_map, tile):
     UI.vprint(0, "-> Dealing with coastline")
     sea_layer = OSM.OSM_layer()
@@ -388,14 +458,12 @@ def include_sea(vector_map, tile):
             sea_layer.write_to_file(custom_coastline)
         custom_source = True
     else:
-        queries = ['way["natural"="coastline"]']
-        tags_of_interest = []
         if not OSM.OSM_queries_to_OSM_layer(
-            queries,
+            coastline_queries,
             sea_layer,
             tile.lat,
             tile.lon,
-            tags_of_interest,
+            coastline_tags,
             cached_suffix="coastline",
         ):
             return 0
@@ -451,6 +519,7 @@ def include_sea(vector_map, tile):
 
 
 ################################################################################
+@TRACE.traced("include_water")
 def include_water(vector_map, tile):
     large_lake_threshold = (
         tile.max_area * 1e6 / (GEO.lat_to_m * GEO.lon_to_m(tile.lat + 0.5))
@@ -522,20 +591,12 @@ def include_water(vector_map, tile):
             )
             water_layer.write_to_file(custom_water)
     else:
-        queries = [
-            'rel["natural"="water"]',
-            'rel["waterway"="riverbank"]',
-            'way["natural"="water"]',
-            'way["waterway"="riverbank"]',
-            'way["waterway"="dock"]',
-        ]
-        tags_of_interest = ["name"]
         if not OSM.OSM_queries_to_OSM_layer(
-            queries,
+            water_queries,
             water_layer,
             tile.lat,
             tile.lon,
-            tags_of_interest,
+            water_tags,
             cached_suffix="water",
         ):
             return 0
@@ -636,6 +697,7 @@ def include_water(vector_map, tile):
 
 
 ################################################################################
+@TRACE.traced("include_patches")
 def include_patches(vector_map, tile):
     def tanh_profile(alpha, x):
         return (numpy.tanh((x - 0.5) * alpha) / numpy.tanh(0.5 * alpha) + 1) / 2